@@ -0,0 +1,63 @@
+"""
+Benchmark schema-typed ADC parsing against inferred-type parsing.
+
+Synthesizes large ADC files by repeating the rows of the test data
+and times ``parse_adc_file`` with and without ``typed=True``.
+
+Usage: python benchmarks/adc_parse.py [n_rows]
+"""
+
+import os
+import sys
+import tempfile
+import shutil
+import timeit
+
+from ifcb.data.adc import parse_adc_file
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'ifcb', 'tests', 'data', 'test_data')
+
+SOURCES = [
+    os.path.join(TEST_DATA_DIR, 'data', '2012', 'IFCB5_2012_028', 'IFCB5_2012_028_081515.adc'),
+    os.path.join(TEST_DATA_DIR, 'white', 'D2013', 'D201305', 'D20130526', 'D20130526T095207_IFCB013.adc'),
+]
+
+def synthesize_adc(source_path, dest_dir, n_rows):
+    with open(source_path) as fin:
+        lines = [line for line in fin if line.strip()]
+    dest_path = os.path.join(dest_dir, os.path.basename(source_path))
+    with open(dest_path, 'w') as fout:
+        for i in range(n_rows):
+            _, rest = lines[i % len(lines)].split(',', 1)
+            fout.write('%d,%s' % (i + 1, rest))
+    return dest_path
+
+def engines():
+    yield 'c'
+    try:
+        import pyarrow
+        yield 'pyarrow'
+    except ImportError:
+        pass
+
+def main(n_rows=200000, repeat=5):
+    d = tempfile.mkdtemp()
+    try:
+        for source in SOURCES:
+            path = synthesize_adc(source, d, n_rows)
+            size_mb = os.path.getsize(path) / 1e6
+            print('%s (%d rows, %.1f MB)' % (os.path.basename(path), n_rows, size_mb))
+            t = min(timeit.repeat(lambda: parse_adc_file(path), number=1, repeat=repeat))
+            print('  inferred       %.3fs' % t)
+            for engine in engines():
+                t = min(timeit.repeat(lambda: parse_adc_file(path, typed=True, engine=engine), number=1, repeat=repeat))
+                print('  typed %-8s %.3fs' % (engine, t))
+            mem = parse_adc_file(path).memory_usage().sum() / 1e6
+            typed_mem = parse_adc_file(path, typed=True).memory_usage().sum() / 1e6
+            print('  memory         %.1f MB inferred, %.1f MB typed' % (mem, typed_mem))
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    main(n_rows)
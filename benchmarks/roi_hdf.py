@@ -0,0 +1,63 @@
+"""
+Benchmark the packed HDF image layout against the one-dataset-per-image layout.
+
+Synthesizes a large bin by repeating the images of the test data and
+compares ``roi2hdf`` write time, single-image and full read time
+through ``HdfRoi``, and file size for each layout.
+
+Usage: python benchmarks/roi_hdf.py [n_images]
+"""
+
+import os
+import sys
+import random
+import tempfile
+import shutil
+import timeit
+
+from ifcb.data.files import Fileset, FilesetBin
+from ifcb.data.hdf import roi2hdf, HdfRoi, ROI_LAYOUT_DATASETS, ROI_LAYOUT_PACKED
+from ifcb.data.h5utils import hdfopen
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'ifcb', 'tests', 'data', 'test_data')
+
+SOURCE = os.path.join(TEST_DATA_DIR, 'white', 'D2013', 'D201305', 'D20130526', 'D20130526T095207_IFCB013')
+
+LAYOUTS = [
+    ('datasets', ROI_LAYOUT_DATASETS),
+    ('packed', ROI_LAYOUT_PACKED),
+]
+
+def synthesize_images(n_images):
+    with FilesetBin(Fileset(SOURCE)) as b:
+        source = [im for _, im in b.images.items()]
+    return { i + 1: source[i % len(source)] for i in range(n_images) }
+
+def main(n_images=20000, n_random=1000, repeat=3):
+    images = synthesize_images(n_images)
+    sample = random.Random(0).sample(sorted(images), min(n_random, n_images))
+    d = tempfile.mkdtemp()
+    try:
+        print('%d images' % n_images)
+        for name, layout in LAYOUTS:
+            path = os.path.join(d, name + '.h5')
+            t = min(timeit.repeat(lambda: roi2hdf(images, path, layout=layout), number=1, repeat=repeat))
+            size_mb = os.path.getsize(path) / 1e6
+            print('%-9s write %.3fs, %.1f MB' % (name, t, size_mb))
+            with hdfopen(path) as h:
+                def read_random():
+                    roi = HdfRoi(h)
+                    for k in sample:
+                        roi[k]
+                def read_all():
+                    HdfRoi(h).pack()
+                t = min(timeit.repeat(read_random, number=1, repeat=repeat))
+                print('%-9s read %d random images %.3fs' % (name, len(sample), t))
+                t = min(timeit.repeat(read_all, number=1, repeat=repeat))
+                print('%-9s read all images %.3fs' % (name, t))
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    main(n_images)
@@ -0,0 +1,67 @@
+"""
+Benchmark and check infilling of stitched images.
+
+Compares ``infill`` against the reference implementation based on
+``scipy.ndimage.correlate`` (``dilate``, ``find_boundary`` and
+``chop_boundary_edges``) on the stitched images in the test data and
+on synthetic stitched pairs, checking that the output is identical.
+
+Usage: python benchmarks/stitch_infill.py [n_images]
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from ifcb.data.files import DataDirectory
+from ifcb.data.stitching import (Stitcher, stitch_images, infill, infill_many,
+    dilate, find_boundary, chop_boundary_edges)
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'ifcb', 'tests', 'data', 'test_data')
+
+def reference_infill(raw_stitch):
+    # infill as computed before the boolean slicing implementation
+    boundary = find_boundary(dilate(raw_stitch.mask))
+    boundary = chop_boundary_edges(boundary)
+    if np.sum(boundary) > 0:
+        infill_value = int(round(np.mean(raw_stitch[boundary])))
+        fill_image = np.full(raw_stitch.shape, dtype=np.uint8, fill_value=infill_value)
+    else:
+        fill_image = np.zeros(raw_stitch.shape, dtype=np.uint8)
+    infill = np.ma.array(fill_image, mask=np.logical_not(raw_stitch.mask))
+    return raw_stitch.filled(0) + infill.filled(0)
+
+def test_data_stitches():
+    for b in DataDirectory(TEST_DATA_DIR):
+        for _, raw_stitch in Stitcher(b).iter_stitched():
+            yield raw_stitch
+
+def synthesize_stitches(n_images, seed=0):
+    # overlapping pairs of random boxes, as in revision 1 stitched ROIs
+    rng = np.random.default_rng(seed)
+    stitches = []
+    for _ in range(n_images):
+        ah, aw, bh, bw = rng.integers(20, 200, size=4)
+        by, bx = rng.integers(-bh + 4, ah - 4), rng.integers(-bw + 4, aw - 4)
+        sy, sx = min(0, by), min(0, bx)
+        shape = (max(ah, by + bh) - sy, max(aw, bx + bw) - sx)
+        boxes = [(-sy, -sx, ah - sy, aw - sx), (by - sy, bx - sx, by + bh - sy, bx + bw - sx)]
+        images = [rng.integers(0, 256, size=(h, w), dtype=np.uint8) for h, w in [(ah, aw), (bh, bw)]]
+        stitches.append(stitch_images(shape, boxes, images))
+    return stitches
+
+def main(n_images=2000, repeat=3):
+    stitches = list(test_data_stitches()) + synthesize_stitches(n_images)
+    for raw_stitch in stitches:
+        assert np.array_equal(infill(raw_stitch), reference_infill(raw_stitch))
+    print('%d stitched images, output identical' % len(stitches))
+    t = min(timeit.repeat(lambda: [reference_infill(s) for s in stitches], number=1, repeat=repeat))
+    print('reference %.3fs' % t)
+    t = min(timeit.repeat(lambda: infill_many(stitches), number=1, repeat=repeat))
+    print('infill    %.3fs' % t)
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    main(n_images)
@@ -5,6 +5,7 @@ Support for parsing and accessing IFCB ADC data.
 import os
 from io import BytesIO
 
+import numpy as np
 import pandas as pd
 from pandas.errors import EmptyDataError
 
@@ -44,6 +45,7 @@ class SCHEMA_VERSION_1(object):
     ROI_HEIGHT = 12
     START_BYTE = 13
     VALVE_STATUS = 14
+    _int_cols = (TRIGGER, ROI_X, ROI_Y, ROI_WIDTH, ROI_HEIGHT, START_BYTE)
 
 class SCHEMA_VERSION_2(object):
     """
@@ -75,6 +77,7 @@ class SCHEMA_VERSION_2(object):
     STATUS = 21
     RUN_TIME = 22
     INHIBIT_TIME = 23
+    _int_cols = (TRIGGER, ROI_X, ROI_Y, ROI_WIDTH, ROI_HEIGHT, START_BYTE)
 
 SCHEMA = {
     1: SCHEMA_VERSION_1,
@@ -90,23 +93,117 @@ def schema_names(schema):
 IFCB schemas
 """
 
-def parse_adc_file(adc_file):
+def schema_dtypes(schema):
+    """
+    Return the column types for a schema, as a dict mapping
+    column number to NumPy dtype. Byte offsets are 64-bit, other
+    integer columns (trigger number, ROI position and size) are
+    32-bit, and all remaining columns are 64-bit floats.
+
+    :param schema: the ADC schema
+    """
+    dtypes = { c: np.float64 for c in schema._cols }
+    for c in schema._int_cols:
+        dtypes[c] = np.int32
+    dtypes[schema.START_BYTE] = np.int64
+    return dtypes
+
+def cast_to_schema(df, schema):
+    """
+    Cast the columns of parsed ADC data to the schema's
+    column types (see ``schema_dtypes``).
+
+    :param df: the ADC data, with columns numbered as in the schema
+    :param schema: the ADC schema
+    :returns pandas.DataFrame: the data with the schema's types
+    :raises ValueError: if an integer column contains non-integer data
+    """
+    dtypes = { c: t for c, t in schema_dtypes(schema).items() if c in df.columns }
+    for c in schema._int_cols:
+        if c in df.columns and df[c].dtype.kind != 'i':
+            raise ValueError('non-integer data in ADC column %d' % c)
+    return df.astype(dtypes, copy=False)
+
+def _is_local(adc_file):
+    # local files can be opened directly and read more than once
+    return isinstance(adc_file, (str, os.PathLike)) and os.path.isfile(adc_file)
+
+def _count_columns(adc_path):
+    # count the columns in the first line of a local file
+    with open(adc_path, 'rb') as fin:
+        line = fin.readline()
+    if not line.strip():
+        raise EmptyDataError('no columns to parse')
+    return line.count(b',') + 1
+
+def _read_adc_csv(adc_file, schema, typed=False, engine='c', columns=None):
+    kw = {}
+    if engine == 'c':
+        kw['index_col'] = False
+    if columns is not None:
+        # columns absent from the file are silently skipped
+        n_cols = _count_columns(adc_file)
+        if schema == SCHEMA_VERSION_1:
+            n_cols = min(n_cols, len(schema._cols))
+        kw['usecols'] = sorted(c for c in set(columns) if c < n_cols)
+    elif typed and schema == SCHEMA_VERSION_1:
+        # skip the bogus final column without materializing it
+        kw['usecols'] = list(schema._cols)
+    df = pd.read_csv(adc_file, header=None, engine=engine, **kw)
+    if not typed:
+        if schema == SCHEMA_VERSION_1 and columns is None:
+            df.pop(df.columns[-1]) # remove bogus final column
+        return df
+    # casting after parsing is faster than passing dtypes to the C parser
+    return cast_to_schema(df, schema)
+
+def _parse_once(adc_file, schema, typed, engine, columns):
+    # URLs and buffers may only be readable once, so they are parsed
+    # with a single call, selecting and casting columns afterwards
+    df = _read_adc_csv(adc_file, schema, engine=engine)
+    if columns is not None:
+        df = df[[c for c in df.columns if c in set(columns)]]
+    if typed:
+        try:
+            df = cast_to_schema(df, schema)
+        except ValueError: # data does not match schema
+            pass
+    return df
+
+def parse_adc_file(adc_file, typed=False, engine='c', columns=None):
     """
     Parse an ADC file and return it as a Pandas
     DataFrame, indexed by target number.
 
     :param adc_file: the pathname or URL of the ADC file,
       or a buffer containing the ADC data
+    :param typed: whether to take column types from the
+      schema rather than inferring them. Falls back to
+      inferring types if the data does not match the schema
+    :param engine: the ``pandas.read_csv`` parser engine
+      (e.g., ``'c'`` or ``'pyarrow'``)
+    :param columns: (optional) the column numbers to read. Other
+      columns are skipped by the parser, and requested columns
+      that are not present in the file are omitted
     """
     s = SCHEMA[Pid(adc_file).schema_version]
     try:
-        df = pd.read_csv(adc_file, header=None, index_col=False)
-        if s == SCHEMA_VERSION_1:
-            df.pop(df.columns[-1]) # remove bogus final column
+        if not _is_local(adc_file):
+            df = _parse_once(adc_file, s, typed, engine, columns)
+            df.index += 1 # index by 1-based ROI number
+            return df
+        df = None
+        if typed:
+            try:
+                df = _read_adc_csv(adc_file, s, typed=True, engine=engine, columns=columns)
+            except ValueError: # data does not match schema
+                pass
+        if df is None:
+            df = _read_adc_csv(adc_file, s, columns=columns)
         df.index += 1 # index by 1-based ROI number
         return df
     except EmptyDataError:
-        cols = s._cols
+        cols = s._cols if columns is None else [c for c in s._cols if c in columns]
         return pd.DataFrame({c:[] for c in cols}, columns=cols)
     
 class AdcFile(BaseDictlike):
@@ -125,13 +222,16 @@ class AdcFile(BaseDictlike):
     135
 
     """
-    def __init__(self, adc_path, parse=False):
+    def __init__(self, adc_path, parse=False, typed=False):
         """
         :param adc_path: the path of the ``.adc`` file.
         :param parse: whether to parse the file
           (if not, parsing is deferred until data is accessed)
+        :param typed: whether to parse using the schema's
+          column types (see ``parse_adc_file``)
         """
         self.path = adc_path
+        self.typed = typed
         self.pid = Pid(adc_path, parse=parse)
         self.schema_version = self.pid.schema_version
         self.schema = SCHEMA[self.schema_version]
@@ -154,7 +254,7 @@ class AdcFile(BaseDictlike):
         """
         The underlying CSV data as a ``pandas.DataFrame``
         """
-        return parse_adc_file(self.path)
+        return parse_adc_file(self.path, typed=self.typed)
     def to_dataframe(self):
         """
         Return the ADC data as a ``pandas.DataFrame``. If the
@@ -203,28 +303,119 @@ class AdcFile(BaseDictlike):
     def __str__(self):
         return self.path
 
+# line offset index for random access to ADC files
+
+ADC_INDEX_SUFFIX = '.idx.npy'
+
+def _index_lines(path):
+    with open(path, 'rb') as fin:
+        data = np.frombuffer(fin.read(), dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord('\n')) + 1
+    offsets = np.concatenate(([0], newlines)).astype(np.int64)
+    if offsets[-1] != len(data): # no trailing newline
+        offsets = np.append(offsets, len(data))
+    return offsets
+
+@lru_cache(maxsize=512)
+def _line_offsets(path, mtime_ns, size, sidecar):
+    if sidecar:
+        index_path = path + ADC_INDEX_SUFFIX
+        try:
+            stored = np.load(index_path)
+            if stored[0] == mtime_ns and stored[1] == size:
+                return stored[2:]
+        except (OSError, ValueError, IndexError):
+            pass # missing, stale, or corrupt
+    offsets = _index_lines(path)
+    if sidecar:
+        try:
+            np.save(index_path, np.concatenate(([mtime_ns, size], offsets)))
+        except OSError:
+            pass # e.g., read-only data directory
+    return offsets
+
+def adc_line_offsets(adc_path, sidecar=False):
+    """
+    Index the lines of an ADC file. Returns an array of the byte offset
+    of the start of each line, followed by the size of the file, so
+    that the lines for targets ``m`` through ``n`` (inclusive) are found
+    between offsets ``m-1`` and ``n``.
+
+    The index is computed in one pass over the file and cached in memory.
+    It is recomputed if the file's modification time or size changes.
+
+    :param adc_path: the path of the ``.adc`` file
+    :param sidecar: whether to also store the index in a file next
+      to the ADC file (with the suffix ``.idx.npy``), so that it
+      persists between processes
+    """
+    path = os.path.abspath(adc_path)
+    st = os.stat(path)
+    return _line_offsets(path, st.st_mtime_ns, st.st_size, sidecar)
+
+def read_adc_lines(adc_path, start=1, end=None, sidecar=False):
+    """
+    Read the raw ADC lines for a range of targets, using the
+    line offset index.
+
+    :param adc_path: the path of the ``.adc`` file
+    :param start: the first (1-based) target number to read
+    :param end: the target number to stop before (default: read
+      to the end of the file)
+    :param sidecar: see ``adc_line_offsets``
+    :returns bytes: the lines
+    """
+    if start < 1:
+        raise ValueError('target numbers start at 1, not %d' % start)
+    offsets = adc_line_offsets(adc_path, sidecar=sidecar)
+    n_lines = len(offsets) - 1
+    if end is None or end > n_lines + 1:
+        end = n_lines + 1
+    if start > n_lines or end <= start:
+        return b''
+    begin, stop = offsets[start-1], offsets[end-1]
+    with open(adc_path, 'rb') as fin:
+        fin.seek(begin)
+        return fin.read(stop - begin)
+
 class AdcFragment(AdcFile):
     """
     Represents a specific range of targets in an ADC file.
     Skips parsing other lines from the ADC file, for performance
     reasons.
+
+    Lines are located with a line offset index (see ``adc_line_offsets``),
+    so the cost of reading a fragment does not depend on its position
+    in the file.
     """
-    def __init__(self, adc_path, start=1, end=None, parse=False):
+    def __init__(self, adc_path, start=1, end=None, parse=False, sidecar=False):
+        """
+        :param adc_path: the path of the ``.adc`` file.
+        :param start: the first target number in the fragment
+        :param end: the target number to stop before (default: the
+          end of the file)
+        :param parse: whether to parse the file
+          (if not, parsing is deferred until data is accessed)
+        :param sidecar: whether to persist the line offset index
+          in a sidecar file
+        """
         self.start = start
         self.end = end
+        self.sidecar = sidecar
+        self._csv_cache = None
         super(AdcFragment, self).__init__(adc_path, parse=parse)
     @property
     def csv(self):
-        with open(self.path) as adc_file:
-            n, buf = 1, BytesIO()
-            for line in adc_file:
-                if n >= self.start:
-                    buf.write(line.rstrip(',').encode('utf8'))
-                n += 1
-                if n == self.end:
-                    break
-        buf.seek(0)
-        df = pd.read_csv(buf, header=None, index_col=False)
+        # cached on the instance, so that fragments can be collected
+        if self._csv_cache is None:
+            self._csv_cache = self._parse_fragment()
+        return self._csv_cache
+    def _parse_fragment(self):
+        lines = read_adc_lines(self.path, self.start, self.end, sidecar=self.sidecar)
+        try:
+            df = _read_adc_csv(BytesIO(lines), self.schema)
+        except EmptyDataError:
+            cols = self.schema._cols
+            return pd.DataFrame({c:[] for c in cols}, columns=cols)
         df.index += self.start # index by 1-based ROI number
         return df
-
@@ -8,6 +8,7 @@ from .adc import SCHEMA
 from .hdr import TEMPERATURE, HUMIDITY
 
 from .utils import BaseDictlike
+from .packed import pack_images
 
 from ..metrics.ml_analyzed import compute_ml_analyzed
 
@@ -111,12 +112,18 @@ class BaseBin(BaseDictlike):
         return self.header(HUMIDITY)
     # convenience APIs for writing in different formats
     def read(self):
+        """
+        Read the entire bin into memory. Images are held in
+        a single buffer (see ``PackedImages``).
+
+        :returns BaseBin: an in-memory copy of the bin
+        """
         with self:
             new_bin = BaseBin()
             new_bin.pid = self.pid.copy()
             new_bin.headers = self.headers.copy()
             new_bin.adc = self.adc
-            new_bin.images = { k:v for k,v in self.images.items() }
+            new_bin.images = pack_images(self.images)
             return new_bin
     def to_hdf(self, hdf_file, group=None, replace=True):
         from .hdf import bin2hdf
@@ -0,0 +1,255 @@
+"""
+Persistent SQLite catalog of the filesets in a data directory.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+import pandas as pd
+
+from .identifiers import Pid
+from .files import scan_directory, directory_validator
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS filesets (
+    dirpath TEXT NOT NULL,
+    basename TEXT NOT NULL,
+    lid TEXT NOT NULL,
+    timestamp TEXT,
+    instrument INTEGER,
+    hdr_size INTEGER,
+    adc_size INTEGER,
+    roi_size INTEGER,
+    PRIMARY KEY (dirpath, basename)
+);
+CREATE INDEX IF NOT EXISTS filesets_lid ON filesets (lid);
+CREATE INDEX IF NOT EXISTS filesets_timestamp ON filesets (timestamp);
+"""
+
+# incremented when the schema changes, so that older catalogs are rebuilt
+CATALOG_VERSION = 2
+
+def _getsize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+class FilesetCatalog(object):
+    """
+    Persistent index of the filesets in a ``DataDirectory``, stored
+    in a SQLite database. Records each fileset's LID, location,
+    timestamp, instrument number, and file sizes.
+
+    Filesets are found with the same whitelist, blacklist, and
+    ``require_roi_files`` rules as ``list_filesets``, and are listed
+    in the same order. If those settings differ from the ones the
+    catalog was built with, the catalog is rebuilt.
+
+    Rescanning is incremental: every directory is checked with a
+    single ``stat``, and only directories whose modification time
+    has changed are listed. Note that a directory's modification
+    time does not change when a file in it grows, so file sizes
+    are only updated when the directory's contents change.
+    """
+    def __init__(self, db_path, data_directory):
+        """
+        :param db_path: the path of the SQLite database file
+        :param data_directory: the ``DataDirectory`` to catalog
+        """
+        self.db_path = db_path
+        self.dd = data_directory
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(CATALOG_SCHEMA)
+            if self._get_meta('settings') != self._settings():
+                self._clear()
+    def _settings(self):
+        return json.dumps({
+            'version': CATALOG_VERSION,
+            'whitelist': list(self.dd.whitelist),
+            'blacklist': list(self.dd.blacklist),
+            'require_roi_files': self.dd.require_roi_files,
+        })
+    def _get_meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return None if row is None else row[0]
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+    def _clear(self):
+        # recreate the tables, in case they were created by an older version
+        self._conn.execute('DROP TABLE directories')
+        self._conn.execute('DROP TABLE filesets')
+        self._conn.execute('DELETE FROM meta')
+        self._conn.executescript(CATALOG_SCHEMA)
+        self._set_meta('settings', self._settings())
+    def _ensure_scanned(self):
+        with self._lock:
+            scanned = self._get_meta('scanned') is not None
+        if not scanned:
+            self.update()
+    def _dirpath(self, reldir):
+        return os.path.join(self.dd.path, reldir) if reldir else self.dd.path
+    def _fileset_rows(self, reldir, basenames):
+        dirpath = os.path.join(self.dd.path, reldir)
+        valid = directory_validator(reldir, blacklist=self.dd.blacklist, whitelist=self.dd.whitelist)
+        for basename in basenames:
+            if not valid(basename):
+                continue
+            pid = Pid(basename, parse=False)
+            if pid.isvalid():
+                lid, timestamp, instrument = pid.bin_lid, pid.timestamp.isoformat(), pid.instrument
+            else:
+                # listed like any other fileset, but never matches a query
+                lid, timestamp, instrument = basename, None, None
+            basepath = os.path.join(dirpath, basename)
+            yield (reldir, basename, lid, timestamp, instrument,
+                   _getsize(basepath + '.hdr'), _getsize(basepath + '.adc'), _getsize(basepath + '.roi'))
+    def update(self):
+        """
+        Rescan the data directory, listing only directories that
+        are new or whose modification time has changed.
+
+        :returns int: the number of directories listed
+        """
+        root = self.dd.path
+        n_listed = 0
+        with self._lock, self._conn:
+            known, children = {}, {}
+            for path, parent, mtime_ns in self._conn.execute('SELECT path, parent, mtime_ns FROM directories'):
+                known[path] = mtime_ns
+                children.setdefault(parent, []).append(path)
+            seen = set()
+            stack = ['']
+            while stack:
+                reldir = stack.pop()
+                try:
+                    mtime_ns = os.stat(os.path.join(root, reldir)).st_mtime_ns
+                except OSError:
+                    continue # removed since last scan
+                seen.add(reldir)
+                if known.get(reldir) == mtime_ns:
+                    # contents unchanged, but descendants may have changed
+                    stack.extend(children.get(reldir, []))
+                    continue
+                subdirs, basenames = scan_directory(os.path.join(root, reldir), blacklist=self.dd.blacklist, require_roi_files=self.dd.require_roi_files)
+                n_listed += 1
+                self._conn.execute('DELETE FROM filesets WHERE dirpath=?', (reldir,))
+                self._conn.executemany('INSERT OR REPLACE INTO filesets VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._fileset_rows(reldir, basenames))
+                parent = None if reldir == '' else os.path.dirname(reldir)
+                self._conn.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)', (reldir, parent, mtime_ns))
+                subpaths = [os.path.join(reldir, d) for d in subdirs]
+                children[reldir] = subpaths
+                stack.extend(subpaths)
+            # forget directories that no longer exist or are no longer reachable
+            for reldir in set(known) - seen:
+                self._conn.execute('DELETE FROM directories WHERE path=?', (reldir,))
+                self._conn.execute('DELETE FROM filesets WHERE dirpath=?', (reldir,))
+            count = self._conn.execute('SELECT COUNT(*) FROM filesets').fetchone()[0]
+            self._set_meta('count', str(count))
+            self._set_meta('scanned', 'true')
+        return n_listed
+    def list_filesets(self):
+        """
+        Yield the directory path and basename of each fileset,
+        in the same order as ``list_filesets``.
+        """
+        self._ensure_scanned()
+        with self._lock:
+            directories = self._conn.execute('SELECT path, parent FROM directories').fetchall()
+            rows = self._conn.execute('SELECT dirpath, basename FROM filesets').fetchall()
+        children, basenames = {}, {}
+        for path, parent in directories:
+            children.setdefault(parent, []).append(path)
+        for reldir, basename in rows:
+            basenames.setdefault(reldir, []).append(basename)
+        # like list_filesets, visit subdirectories in reverse order
+        # and list each directory's filesets in reverse order
+        stack = ['']
+        while stack:
+            reldir = stack.pop()
+            dirpath = self._dirpath(reldir)
+            for basename in sorted(basenames.get(reldir, []), reverse=True):
+                yield dirpath, basename
+            stack.extend(sorted(children.get(reldir, [])))
+    def query(self, start=None, end=None, instrument=None):
+        """
+        Yield the directory path and basename of each fileset with
+        a timestamp in the given range, in timestamp order.
+
+        :param start: the earliest timestamp to include (default: no limit)
+        :param end: the timestamp before which to stop (default: no limit)
+        :param instrument: (optional) the instrument number to include
+        """
+        self._ensure_scanned()
+        where, params = ['timestamp IS NOT NULL'], []
+        if start is not None:
+            where.append('timestamp >= ?')
+            params.append(pd.to_datetime(start, utc=True).isoformat())
+        if end is not None:
+            where.append('timestamp < ?')
+            params.append(pd.to_datetime(end, utc=True).isoformat())
+        if instrument is not None:
+            where.append('instrument = ?')
+            params.append(int(instrument))
+        sql = 'SELECT dirpath, basename FROM filesets WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY timestamp, lid'
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        for reldir, basename in rows:
+            yield self._dirpath(reldir), basename
+    def find(self, lid):
+        """
+        Look up a fileset by LID.
+
+        :param lid: the bin LID
+        :returns: the directory path and basename of the fileset,
+          or ``None`` if it is not in the catalog
+        """
+        self._ensure_scanned()
+        with self._lock:
+            row = self._conn.execute('SELECT dirpath, basename FROM filesets WHERE lid=?', (lid,)).fetchone()
+        if row is None:
+            return None
+        reldir, basename = row
+        return self._dirpath(reldir), basename
+    def has_key(self, lid):
+        return self.find(lid) is not None
+    def __contains__(self, lid):
+        return self.has_key(lid)
+    def getsizes(self, lid):
+        """
+        Get the recorded file sizes of a fileset.
+
+        :param lid: the bin LID
+        :returns dict: sizes with keys 'hdr', 'adc', and 'roi'
+        """
+        self._ensure_scanned()
+        with self._lock:
+            row = self._conn.execute('SELECT hdr_size, adc_size, roi_size FROM filesets WHERE lid=?', (lid,)).fetchone()
+        if row is None:
+            raise KeyError(lid)
+        return dict(zip(['hdr', 'adc', 'roi'], row))
+    def __len__(self):
+        self._ensure_scanned()
+        with self._lock:
+            return int(self._get_meta('count'))
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self._conn.close()
+    def __repr__(self):
+        return '<FilesetCatalog %s>' % self.db_path
@@ -1,15 +1,28 @@
 from zipfile import ZipFile
 
-from PIL import Image
 import pandas as pd
 from io import BytesIO
 
 import ifcb
 from ifcb.data.adc import SCHEMA_VERSION_1
 from ifcb.data.stitching import InfilledImages
+from ifcb.data.imageio import encode_images
 
 
-def to_ecotaxa(b, zip_path=None):
+def to_ecotaxa(b, zip_path=None, workers=1, processes=False, **kw):
+    """
+    Write a bin's images and metadata to a ZIP file for import
+    into EcoTaxa. Other keywords are passed to the PNG encoder
+    (see ``png_options``).
+
+    :param b: the bin
+    :param zip_path: the path of the ZIP file (default: the bin's
+      LID plus ``.zip``)
+    :param workers: the number of workers with which to encode
+      images (see ``encode_images``)
+    :param processes: whether to encode images in processes
+      rather than threads
+    """
 
     if zip_path is None:
         zip_path = f'{b.lid}.zip'
@@ -21,8 +34,10 @@ def to_ecotaxa(b, zip_path=None):
             images = InfilledImages(b)
         else:
             images = b.images
+
+        pngs = encode_images(images.items(), workers=workers, processes=processes, mimetype='image/png', **kw)
     
-        for roi_number, image_data in images.items():
+        for roi_number, img_byte_arr in pngs:
 
             object_id = ifcb.Pid(b.lid).with_target(roi_number)
             img_file_name = f'{object_id}.png'
@@ -36,13 +51,6 @@ def to_ecotaxa(b, zip_path=None):
             }
 
             records.append(record)
-
-            image = Image.fromarray(image_data)
-            
-            # Convert the image to bytes
-            img_byte_arr = BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
             
             # Write the bytes to the zip file
             fout.writestr(img_file_name, img_byte_arr)
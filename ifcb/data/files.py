@@ -3,6 +3,8 @@ Access to IFCB raw data files, including directory operations.
 """
 
 import os
+import re
+import heapq
 from functools import lru_cache
 
 import pandas as pd
@@ -114,13 +116,15 @@ class FilesetBin(BaseBin):
     Context manager support opens and closes the ``.roi`` file for image
     access.
     """
-    def __init__(self, fileset):
+    def __init__(self, fileset, use_mmap=False):
         """
         :param fileset: the ``Fileset`` to represent
+        :param use_mmap: whether to memory-map the ``.roi`` file
+          (see ``RoiFile``)
         """
         self.fileset = fileset
         self.adc_file = AdcFile(fileset.adc_path)
-        self.roi_file = RoiFile(self.adc_file, fileset.roi_path)
+        self.roi_file = RoiFile(self.adc_file, fileset.roi_path, use_mmap=use_mmap)
     # oo interface to fileset
     @property
     @lru_cache()
@@ -192,10 +196,9 @@ class FilesetBin(BaseBin):
         return self.roi_file.isopen()
     def close(self):
         """
-        Close the ``.roi`` file, if it is open.
+        Close the ``.roi`` file, if it is open or mapped.
         """
-        if self.isopen():
-            self.roi_file.close()
+        self.roi_file.close()
     def __enter__(self):
         if not self.isopen():
             self.roi_file._open()
@@ -210,7 +213,7 @@ class FilesetBin(BaseBin):
         entire ADC file. Otherwise it will raise ValueError."""
         if self.isopen():
             raise ValueError('as_single must be called before opening FilesetBin')
-        return FilesetFragmentBin(self.fileset, target)
+        return FilesetFragmentBin(self.fileset, target, use_mmap=self.roi_file.use_mmap)
     def __repr__(self):
         return '<FilesetBin %s>' % self
     def __str__(self):
@@ -219,13 +222,39 @@ class FilesetBin(BaseBin):
 # special fileset bin subclass for reading one image fast
 
 class FilesetFragmentBin(FilesetBin):
-    def __init__(self, fileset, target):
+    def __init__(self, fileset, target, use_mmap=False):
         self.fileset = fileset
         self.adc_file = AdcFragment(fileset.adc_path, target, target+2)
-        self.roi_file = RoiFile(self.adc_file, fileset.roi_path)
+        self.roi_file = RoiFile(self.adc_file, fileset.roi_path, use_mmap=use_mmap)
 
 # listing and finding raw filesets and associated bin objects
 
+def directory_validator(reldir, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST):
+    """
+    Prepare to validate the paths of many files in one directory
+    (see ``validate_path``). The checks that do not depend on the
+    file's basename are done once, here.
+
+    :param reldir: the directory path, relative to the data root
+    :param blacklist: directory names to ignore
+    :param whitelist: directory names to include, even if they
+      do not match the path's basename
+    :returns: a function that takes a basename (without extension)
+      and returns whether a file with that name in the directory is valid
+    """
+    components = reldir.split(os.sep)
+    if not set(blacklist).isdisjoint(components):
+        return lambda lid: False
+    whitelist = set(whitelist)
+    # components that must be part of the basename
+    required = [c for c in components if c not in whitelist]
+    def inner(lid):
+        for c in required:
+            if c not in lid:
+                return False
+        return True
+    return inner
+
 def validate_path(filepath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST):
     """
     Validate an IFCB raw data file path.
@@ -246,44 +275,216 @@ def validate_path(filepath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITE
         raise ValueError('whitelist and blacklist must be disjoint')
     dirname, basename = os.path.split(filepath)
     lid, ext = os.path.splitext(basename)
-    components = dirname.split(os.sep)
-    for c in components:
-        if c in blacklist:
-            return False
-        if c not in whitelist and c not in lid:
-            return False
-    return True
+    return directory_validator(dirname, blacklist=blacklist, whitelist=whitelist)(lid)
+
+def scan_directory(dirpath, blacklist=DEFAULT_BLACKLIST, require_roi_files=True):
+    """
+    List the contents of a single directory (non-recursively).
 
-def list_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST, sort=True, validate=True, require_roi_files=True):
+    :param dirpath: the directory to list
+    :param blacklist: list of directory names to ignore
+    :param require_roi_files: bool, whether to require the .roi file
+    :returns tuple: the names of non-blacklisted subdirectories, and
+      the basenames of filesets found in the directory, both sorted
+    """
+    subdirs = []
+    files_by_ext = { 'adc': set(), 'hdr': set(), 'roi': set() }
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            name = entry.name
+            if entry.is_dir():
+                # like os.walk, do not descend into symbolic links
+                if name not in blacklist and not entry.is_symlink():
+                    subdirs.append(name)
+            else:
+                exts = files_by_ext.get(name[-3:])
+                if exts is not None and name[-4:-3] == '.':
+                    exts.add(name[:-4])
+    basenames = files_by_ext['adc'] & files_by_ext['hdr']
+    if require_roi_files:
+        basenames &= files_by_ext['roi']
+    return sorted(subdirs), sorted(basenames)
+
+class _Scanned(object):
+    # stands in for a Future when scanning without a thread pool
+    def __init__(self, result):
+        self._result = result
+    def result(self):
+        return self._result
+
+def list_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST, sort=True, validate=True, require_roi_files=True, workers=None):
     """
     Iterate over entire directory tree and yield a Fileset
     object for each .adc/.hdr/.roi fileset found. Warning: for
     large directories, this is slow.
 
+    Directories are listed with ``os.scandir``. If ``workers`` is
+    given, subdirectories are listed concurrently by a thread pool
+    (useful on network filesystems); the output order is the same
+    either way.
+
     :param blacklist: list of directory names to ignore
     :param whitelist: list of directory names to include, even if they
       do not match a file's basename
     :param sort: whether to sort output (sorts by alpha)
     :param validate: whether to validate each path
     :param require_roi_files: bool, whether to require the .roi file
+    :param workers: (optional) the number of threads to list directories with
     """
     if not set(blacklist).isdisjoint(set(whitelist)):
         raise ValueError('whitelist and blacklist must be disjoint')
-    for dp, dirnames, filenames in os.walk(dirpath):
-        for d in dirnames:
-            if d in blacklist:
-                dirnames.remove(d)
-        if sort:
-            dirnames.sort(reverse=True)
-            filenames.sort(reverse=True)
-        for f in filenames:
-            basename, extension = f[:-4], f[-3:]
-            if extension == 'adc' and basename+'.hdr' in filenames and (not require_roi_files or basename+'.roi' in filenames):
-                if validate:
-                    reldir = dp[len(dirpath)+1:]
-                    if not validate_path(os.path.join(reldir,basename), whitelist=whitelist, blacklist=blacklist):
-                        continue
+    blacklist, whitelist = set(blacklist), set(whitelist)
+    def scan(reldir):
+        return scan_directory(os.path.join(dirpath, reldir), blacklist=blacklist, require_roi_files=require_roi_files)
+    executor = None
+    if workers:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=workers)
+        submit = lambda reldir: executor.submit(scan, reldir)
+    else:
+        submit = lambda reldir: _Scanned(scan(reldir))
+    try:
+        stack = [('', submit(''))]
+        while stack:
+            reldir, scanned = stack.pop()
+            subdirs, basenames = scanned.result()
+            dp = os.path.join(dirpath, reldir) if reldir else dirpath
+            if validate:
+                valid = directory_validator(reldir, blacklist=blacklist, whitelist=whitelist)
+                basenames = [b for b in basenames if valid(b)]
+            if sort:
+                basenames = reversed(basenames)
+            for basename in basenames:
                 yield dp, basename
+            # the stack pops the last subdirectory first, so they are visited in reverse order
+            stack.extend((os.path.join(reldir, d), submit(os.path.join(reldir, d))) for d in subdirs)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+# time range queries
+
+def _time_bound(t):
+    return None if t is None else pd.to_datetime(t, utc=True)
+
+# directory names that imply a time range, e.g. as created by
+# ``transfer.deposit.fileset_destination_dir`` or by the instrument.
+# bare four-digit names are only taken as years in a plausible range,
+# since other directories (e.g., instrument or cruise numbers) can
+# have four-digit names
+DIRECTORY_TIME_PATTERNS = [
+    (re.compile(r'^D(?P<year>\d{4})$'), 'year'),
+    (re.compile(r'^(?P<year>20\d{2})$'), 'year'),
+    (re.compile(r'^D(?P<year>\d{4})(?P<month>\d{2})$'), 'month'),
+    (re.compile(r'^D(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})$'), 'day'),
+    (re.compile(r'^D(?P<year>\d{4})_(?P<yearday>\d{3})$'), 'yearday'),
+    (re.compile(r'^IFCB(?P<instrument>\d+)_(?P<year>\d{4})_(?P<yearday>\d{3})$'), 'yearday'),
+]
+
+def directory_time_range(name):
+    """
+    Infer the range of bin timestamps a directory can contain from
+    its name, for names such as ``2013``, ``D2013``, ``D201305``,
+    ``D20130526``, ``D2013_146``, or ``IFCB5_2012_028``. Names that
+    are only a year must be in the range 2000-2099.
+
+    :param name: the directory name (not a path)
+    :returns: a tuple of start time, end time (exclusive), and
+      instrument number (or ``None``), or ``None`` if the name
+      does not imply a time range
+    """
+    for pattern, unit in DIRECTORY_TIME_PATTERNS:
+        match = pattern.match(name)
+        if match is None:
+            continue
+        g = match.groupdict()
+        year = int(g['year'])
+        try:
+            if unit == 'year':
+                start = pd.Timestamp(year=year, month=1, day=1, tz='UTC')
+                end = pd.Timestamp(year=year+1, month=1, day=1, tz='UTC')
+            elif unit == 'month':
+                start = pd.Timestamp(year=year, month=int(g['month']), day=1, tz='UTC')
+                end = start + pd.offsets.MonthBegin(1)
+            elif unit == 'day':
+                start = pd.Timestamp(year=year, month=int(g['month']), day=int(g['day']), tz='UTC')
+                end = start + pd.Timedelta(days=1)
+            else:
+                start = pd.Timestamp(year=year, month=1, day=1, tz='UTC') + pd.Timedelta(days=int(g['yearday'])-1)
+                end = start + pd.Timedelta(days=1)
+        except ValueError: # e.g., month 13
+            return None
+        instrument = g.get('instrument')
+        return start, end, None if instrument is None else int(instrument)
+    return None
+
+def query_filesets(dirpath, start=None, end=None, instrument=None, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST, validate=True, require_roi_files=True):
+    """
+    Yield the directory path and basename of each fileset whose
+    timestamp is in the given range, in timestamp order.
+
+    Subdirectories whose names imply a time range (see
+    ``directory_time_range``) that does not overlap the query, or
+    an instrument other than the one requested, are not listed.
+    Directories are listed lazily, in order of the earliest
+    timestamp they can contain, so results stream as the
+    directory tree is explored.
+
+    :param dirpath: the root directory
+    :param start: the earliest timestamp to include (default: no limit)
+    :param end: the timestamp before which to stop (default: no limit)
+    :param instrument: (optional) the instrument number to include
+    :param blacklist: list of directory names to ignore
+    :param whitelist: list of directory names to include, even if they
+      do not match a file's basename
+    :param validate: whether to validate each path
+    :param require_roi_files: bool, whether to require the .roi file
+    """
+    if not set(blacklist).isdisjoint(set(whitelist)):
+        raise ValueError('whitelist and blacklist must be disjoint')
+    start, end = _time_bound(start), _time_bound(end)
+    # heap entries are (lower bound on timestamp, kind, sequence, payload);
+    # directories (kind 0) sort before filesets (kind 1) with the same
+    # bound, so filesets with equal timestamps in unexplored directories
+    # are yielded in order
+    earliest = start if start is not None else pd.Timestamp.min.tz_localize('UTC')
+    heap = [(earliest, 0, 0, ('', earliest))]
+    seq = 1
+    while heap:
+        key, kind, _, payload = heapq.heappop(heap)
+        if kind == 1:
+            yield payload
+            continue
+        reldir, lower = payload
+        subdirs, basenames = scan_directory(os.path.join(dirpath, reldir), blacklist=blacklist, require_roi_files=require_roi_files)
+        for d in subdirs:
+            r = directory_time_range(d)
+            child_lower = lower
+            if r is not None:
+                d_start, d_end, d_instrument = r
+                if start is not None and d_end <= start:
+                    continue
+                if end is not None and d_start >= end:
+                    continue
+                if instrument is not None and d_instrument is not None and d_instrument != instrument:
+                    continue
+                child_lower = max(lower, d_start)
+            heapq.heappush(heap, (child_lower, 0, seq, (os.path.join(reldir, d), child_lower)))
+            seq += 1
+        valid = directory_validator(reldir, blacklist=blacklist, whitelist=whitelist)
+        for basename in basenames:
+            if validate and not valid(basename):
+                continue
+            pid = Pid(basename, parse=False)
+            if not pid.isvalid():
+                continue
+            if instrument is not None and pid.instrument != instrument:
+                continue
+            ts = pid.timestamp
+            if (start is not None and ts < start) or (end is not None and ts >= end):
+                continue
+            heapq.heappush(heap, (ts, 1, seq, (os.path.join(dirpath, reldir), basename)))
+            seq += 1
 
 def list_data_dirs(dirpath, blacklist=DEFAULT_BLACKLIST, sort=True, prune=True):
     """
@@ -335,26 +536,68 @@ class DataDirectory(object):
     Represents a directory containing IFCB raw data.
 
     Provides a dict-like interface allowing access to FilesetBins by LID.
+
+    Optionally, the filesets can be indexed in a persistent catalog
+    (see ``FilesetCatalog``) so that lookups, membership tests, and
+    ``len`` do not require walking the directory. The catalog is
+    built on first use; call ``update_catalog`` to pick up changes.
+
+    Optionally, bins accessed by LID can be kept in a ``BinPool``, so
+    that repeated access to the same bin reuses its parsed ADC data
+    and headers and its memory-mapped ``.roi`` file.
     """
-    def __init__(self, path='.', whitelist=DEFAULT_WHITELIST, blacklist=DEFAULT_BLACKLIST, filter=lambda x: True, require_roi_files=True):
+    def __init__(self, path='.', whitelist=DEFAULT_WHITELIST, blacklist=DEFAULT_BLACKLIST, filter=None, require_roi_files=True, catalog=None, workers=None, pool=None):
         """
         :param path: the path of the data directory
         :param whitelist: a list of directory names to allow
         :param blacklist: a list of directory names to disallow
+        :param filter: a function that takes a ``Fileset`` and returns
+          whether to include it (default: include all filesets)
         :param require_roi_files: bool, whether to require the .roi file
+        :param catalog: (optional) the path of a SQLite catalog file
+        :param workers: (optional) the number of threads to use
+          when listing directories (see ``list_filesets``)
+        :param pool: (optional) a ``BinPool``, or the maximum number
+          of bins to keep in a new one
         """
         self.path = path
         self.whitelist = whitelist
         self.blacklist = blacklist
-        self.filter = filter
+        self._filtered = filter is not None
+        self.filter = filter if filter is not None else lambda x: True
         self.require_roi_files=require_roi_files
+        self.workers = workers
+        self.catalog = None
+        if catalog is not None:
+            from .catalog import FilesetCatalog
+            self.catalog = FilesetCatalog(catalog, self)
+        if pool is not None and not hasattr(pool, 'get'):
+            from .pool import BinPool
+            pool = BinPool(max_bins=pool)
+        self.pool = pool
+    def update_catalog(self):
+        """
+        Incrementally rescan the directory and update the catalog.
+        Only directories whose modification time has changed are listed.
+
+        :returns: the number of directories listed
+        """
+        if self.catalog is None:
+            raise ValueError('DataDirectory has no catalog')
+        return self.catalog.update()
+    def _fileset(self, dirpath, basename):
+        basepath = os.path.join(dirpath, basename)
+        return Fileset(basepath, require_roi_files=self.require_roi_files)
     def list_filesets(self):
         """
         Yield all filesets.
         """
-        for dirpath, basename in list_filesets(self.path, whitelist=self.whitelist, blacklist=self.blacklist, require_roi_files=self.require_roi_files):
-            basepath = os.path.join(dirpath, basename)
-            fs = Fileset(basepath, require_roi_files=self.require_roi_files)
+        if self.catalog is not None:
+            paths = self.catalog.list_filesets()
+        else:
+            paths = list_filesets(self.path, whitelist=self.whitelist, blacklist=self.blacklist, require_roi_files=self.require_roi_files, workers=self.workers)
+        for dirpath, basename in paths:
+            fs = self._fileset(dirpath, basename)
             if self.filter(fs):
                 yield fs
     def find_fileset(self, lid):
@@ -365,7 +608,11 @@ class DataDirectory(object):
         :type lid: str
         :returns Fileset: the fileset, or None if not found
         """
-        fs = find_fileset(self.path, lid, whitelist=self.whitelist, blacklist=self.blacklist, require_roi_files=self.require_roi_files)
+        if self.catalog is not None:
+            path = self.catalog.find(lid)
+            fs = None if path is None else self._fileset(*path)
+        else:
+            fs = find_fileset(self.path, lid, whitelist=self.whitelist, blacklist=self.blacklist, require_roi_files=self.require_roi_files)
         if fs is None:
             return None
         elif self.filter(fs):
@@ -377,14 +624,86 @@ class DataDirectory(object):
     def has_key(self, lid):
         # fast contains method that avoids iteration
         return self.find_fileset(lid) is not None
+    def _pool_key(self, lid):
+        # pools may be shared between directories, so bins are keyed
+        # by the options that determine which filesets are found
+        return (os.path.abspath(self.path), tuple(self.whitelist), tuple(self.blacklist), self.require_roi_files, lid)
     def __getitem__(self, lid):
+        if self.pool is not None:
+            b = self.pool.get(self._pool_key(lid))
+            if b is not None and self.filter(b.fileset):
+                return b
         fs = self.find_fileset(lid)
         if fs is None:
             raise KeyError('No fileset for %s found at or under %s' % (lid, self.path))
+        if self.pool is not None:
+            return self.pool.add(fs, key=self._pool_key(lid))
         return FilesetBin(fs)
     def __len__(self):
-        """warning: for large datasets, this is very slow"""
-        return sum(1 for _ in self)
+        """warning: for large datasets without a catalog, this is very slow"""
+        if self.catalog is not None and not self._filtered:
+            return len(self.catalog)
+        return sum(1 for _ in self.list_filesets())
+    def query(self, start=None, end=None, instrument=None):
+        """
+        Yield the filesets with timestamps in the given range,
+        in timestamp order. Without a catalog, directories whose
+        names show that they cannot contain matching filesets are
+        skipped (see ``query_filesets``).
+
+        :param start: the earliest timestamp to include (default: no limit)
+        :param end: the timestamp before which to stop (default: no limit)
+        :param instrument: (optional) the instrument number to include
+        """
+        if self.catalog is not None:
+            paths = self.catalog.query(start, end, instrument)
+        else:
+            paths = query_filesets(self.path, start, end, instrument, whitelist=self.whitelist, blacklist=self.blacklist, require_roi_files=self.require_roi_files)
+        for dirpath, basename in paths:
+            fs = self._fileset(dirpath, basename)
+            if self.filter(fs):
+                yield fs
+    def map(self, func, workers=None, chunksize=1, ordered=True):
+        """
+        Apply a function to every bin in this directory using
+        a pool of processes (see ``BinMap``).
+
+        :param func: a picklable function that takes a ``FilesetBin``
+        :param workers: the number of processes (default: the number
+          of CPUs; 0 to apply the function in this process)
+        :param chunksize: the number of filesets to send to a worker at once
+        :param ordered: whether to yield results in directory order,
+          rather than as they are completed
+        :returns BinMap: an iterable of ``BinResult``
+        """
+        from .parallel import map_bins
+        return map_bins(func, self.list_filesets(), workers=workers, chunksize=chunksize, ordered=ordered, require_roi_files=self.require_roi_files)
+    def summary(self, workers=None, chunksize=8, cache=None):
+        """
+        Compute a table of per-bin metrics (timestamp, ml_analyzed,
+        look time, run time, trigger count and rate, temperature,
+        and humidity) for every bin in this directory. Only the ADC
+        columns needed for the metrics are parsed.
+
+        :param workers: the number of processes (default: the number
+          of CPUs; 0 to compute in this process)
+        :param chunksize: the number of filesets to send to a worker at once
+        :param cache: (optional) the path of a CSV file in which to cache
+          the table; only new or changed bins are computed on later calls
+        :returns pandas.DataFrame: the table, indexed by LID
+        :see ifcb.metrics.summary.summarize
+        """
+        from ..metrics.summary import summarize
+        return summarize(self.list_filesets(), workers=workers, chunksize=chunksize, cache=cache)
+    def to_hdf(self, hdf_path, workers=None, chunksize=1, archive=False):
+        """
+        Write every bin in this directory to one HDF file, in
+        groups named by LID. Resumes an interrupted write.
+
+        :see ifcb.data.hdf.bins2hdf
+        """
+        from .hdf import bins2hdf
+        return bins2hdf(self, hdf_path, workers=workers, chunksize=chunksize, archive=archive)
     # subdirectories
     def list_descendants(self, **kw):
         """
@@ -403,10 +722,9 @@ class DataDirectory(object):
 
 # filters for DataDirectory
 
-def time_filter(start='1970-01-01', end='3000-01-01'):
-    start = pd.to_datetime(start, utc=True)
-    end = pd.to_datetime(end, utc=True)
+def time_filter(start=None, end=None):
+    start, end = _time_bound(start), _time_bound(end)
     def inner(fs):
         ts = fs.pid.timestamp
-        return ts >= start and ts < end
+        return (start is None or ts >= start) and (end is None or ts < end)
     return inner
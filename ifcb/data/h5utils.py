@@ -95,21 +95,43 @@ def pd2hdf(group, df, **kw):
     if df.index.name is not None:
         ix.attrs['name'] = df.index.name
 
-def hdf2pd(group):
+def hdf2pd(group, columns=None, rows=None):
     """
     Read a ``pandas.DataFrame`` from an ``h5py.Group``.
 
+    Only the requested columns and rows are read from the HDF
+    file; other column datasets are not touched.
+
     :param group: the ``h5py.Group`` to read from.
+    :param columns: (optional) the names of the columns to read,
+      in the order in which they should appear (default: all columns)
+    :param rows: (optional) a ``slice`` selecting rows by position
+      (default: all rows)
     """
     if group.attrs['ptype'] != 'DataFrame':
         raise ValueError('unrecognized HDF format')
+    if rows is None:
+        rows = slice(None)
+    elif not isinstance(rows, slice):
+        raise TypeError('rows must be a slice')
     index = group['index']
     index_name = index.attrs.get('name',None)
     col_refs = group['columns']
-    col_data = [np.array(group[r]) for r in col_refs]
     col_names = col_refs.attrs.get('names')
     if type(col_names[0]) == np.bytes_:
         col_names = [str(cn,'utf8') for cn in col_names]
-    data = { k: v for k, v in zip(col_names, col_data) }
-    index = pd.Series(index, name=index_name)
-    return pd.DataFrame(data=data, index=index, columns=col_names)
+    else:
+        col_names = list(col_names)
+    if columns is None:
+        columns = col_names
+    positions = {}
+    for i, name in enumerate(col_names):
+        positions.setdefault(name, i)
+    try:
+        selected = [positions[c] for c in columns]
+    except KeyError as e:
+        raise KeyError('no column %s' % e.args[0])
+    col_data = [group[col_refs[i]][rows] for i in selected]
+    data = { k: v for k, v in zip(columns, col_data) }
+    index = pd.Series(index[rows], name=index_name)
+    return pd.DataFrame(data=data, index=index, columns=list(columns))
@@ -2,10 +2,14 @@
 Support for reading and writing IFCB data to HDF5.
 """
 
+import os
 import datetime
+import zlib
+import traceback
 
 import numpy as np
-from functools import lru_cache
+import h5py as h5
+from functools import lru_cache, partial
 
 from .h5utils import pd2hdf, hdf2pd, hdfopen, H5_REF_TYPE
 
@@ -14,6 +18,9 @@ from .adc import SCHEMA
 from .utils import BaseDictlike
 from .bins import BaseBin
 from .files import FilesetBin
+from .packed import PackedImages, pack_images
+from .parallel import map_bins, BinResult
+from .imagecache import cached_image, RAW
 
 def adc2hdf(adcfile, hdf_file, group=None, replace=True):
     """
@@ -36,15 +43,34 @@ def adc2hdf(adcfile, hdf_file, group=None, replace=True):
         pd2hdf(root, adcfile.to_dataframe(), compression='gzip')
         root.attrs['schema'] = adcfile.schema._name
 
-def roi2hdf(roifile, hdf_file, group=None, replace=True):
+# ROI storage layouts
+ROI_LAYOUT_DATASETS = 1 # one dataset per image
+ROI_LAYOUT_PACKED = 2 # all pixels in one chunked dataset
+ROI_CHUNK_SIZE = 16384 # bytes per chunk in the packed layout
+
+def roi2hdf(roifile, hdf_file, group=None, replace=True, layout=ROI_LAYOUT_DATASETS, compression='gzip'):
     """
-    Store a ``RoiFile`` in an HDF file or group. ROI
-    data is represented as follows in an HDF group:
+    Store a ``RoiFile`` in an HDF file or group. By default,
+    each image is a separate dataset:
 
     * ``{root}.index`` (attribute): target number for each image
     * ``{root}/images`` (dataset): references to images keyed by target number
     * ``{root}/{n}`` (dataset): 2d uint8 image (n = ``str(target_number)``)
 
+    In the packed layout (``layout=ROI_LAYOUT_PACKED``), all images
+    are stored in one chunked, compressed dataset:
+
+    * ``{root}.layout`` (attribute): 2
+    * ``{root}.index`` (attribute): target number for each image, in ascending order
+    * ``{root}/pixels`` (dataset): 1d chunked, compressed uint8 array of all pixels
+    * ``{root}/offsets`` (dataset): the position of each image in ``pixels``
+    * ``{root}/heights`` (dataset): the height of each image
+    * ``{root}/widths`` (dataset): the width of each image
+
+    Each image is stored in row-major order. The packed layout is
+    smaller and much faster to read, but somewhat slower to write,
+    and cannot be read by releases that predate it.
+
     :param roifile: the ``RoiFile`` to store (or similar dictlike)
     :type roifile: RoiFile
     :param hdf_file: the root HDF
@@ -54,15 +80,41 @@ def roi2hdf(roifile, hdf_file, group=None, replace=True):
       to use
     :param replace: whether to replace any existing data
       at that location in the HDF file
+    :param layout: the layout to use (``ROI_LAYOUT_PACKED`` or
+      ``ROI_LAYOUT_DATASETS``)
+    :param compression: the compression filter for the packed layout
     """
     with hdfopen(hdf_file, group, replace=replace) as root:
-        root.attrs['index'] = roifile.keys()
-        # create image datasets and map them to roi numbers
-        d = { n: root.create_dataset(str(n), data=im) for n, im in roifile.items() }
-        # now create sparse array of references keyed by roi number
-        n = max(d.keys())+1
-        r = [ d[i].ref if i in d else None for i in range(n) ]
-        root.create_dataset('images', data=r, dtype=H5_REF_TYPE)
+        if layout == ROI_LAYOUT_PACKED:
+            _roi2hdf_packed(roifile, root, compression)
+        elif layout == ROI_LAYOUT_DATASETS:
+            _roi2hdf_datasets(roifile, root)
+        else:
+            raise ValueError('unknown ROI layout %s' % layout)
+
+def _roi2hdf_datasets(roifile, root):
+    root.attrs['index'] = list(roifile.keys())
+    # create image datasets and map them to roi numbers
+    d = { n: root.create_dataset(str(n), data=im) for n, im in roifile.items() }
+    # now create sparse array of references keyed by roi number
+    n = max(d.keys())+1
+    r = [ d[i].ref if i in d else None for i in range(n) ]
+    root.create_dataset('images', data=r, dtype=H5_REF_TYPE)
+
+def _write_packed_index(root, targets, offsets, shapes):
+    root.attrs['layout'] = ROI_LAYOUT_PACKED
+    root.attrs['index'] = targets
+    root.create_dataset('offsets', data=offsets)
+    root.create_dataset('heights', data=shapes[:,0].astype(np.int32))
+    root.create_dataset('widths', data=shapes[:,1].astype(np.int32))
+
+def _roi2hdf_packed(roifile, root, compression):
+    packed = pack_images(roifile)
+    kw = {}
+    if packed.buffer.size > 0: # empty datasets cannot be chunked
+        kw = dict(chunks=(min(ROI_CHUNK_SIZE, packed.buffer.size),), compression=compression)
+    root.create_dataset('pixels', data=packed.buffer, **kw)
+    _write_packed_index(root, packed.targets, packed.offsets, packed.shapes)
 
 def hdr2hdf(hdr_dict, hdf_file, group=None, replace=True):
     """
@@ -98,19 +150,31 @@ def file2hdf(hdf_root, ds_name, path, **kw):
     file_array = bytearray(file_data)
     hdf_root.create_dataset(ds_name, data=file_array, **kw)
 
-def hdf2file(hdf_dataset, path):
+HDF_COPY_BUFFER_SIZE = 1 << 20 # bytes read at a time when streaming from HDF
+
+def _copy_dataset(hdf_dataset, outfile, buffer_size=HDF_COPY_BUFFER_SIZE):
+    # stream a 1d dataset to a file, reading whole chunks at a time
+    step = buffer_size
+    if hdf_dataset.chunks is not None:
+        chunk_len = hdf_dataset.chunks[0]
+        step = max(chunk_len, step // chunk_len * chunk_len)
+    for start in range(0, len(hdf_dataset), step):
+        outfile.write(hdf_dataset[start:start + step].tobytes())
+
+def hdf2file(hdf_dataset, path, buffer_size=HDF_COPY_BUFFER_SIZE):
     """
-    Write the contents of an HDF dataset to a file. Does not stream,
-    so the entire contents of the dataset must fit in memory.
+    Write the contents of an HDF dataset to a file. The dataset
+    is streamed, so at most ``buffer_size`` bytes (rounded up to
+    a whole number of chunks) are held in memory.
 
     :param hdf_dataset: an ``h5py.Dataset`` to read
     :param path: the path of the file to write
+    :param buffer_size: the number of bytes to read at a time
     """
-    file_data = bytearray(hdf_dataset)
     with open(path,'wb') as outfile:
-        outfile.write(file_data)
+        _copy_dataset(hdf_dataset, outfile, buffer_size)
 
-def bin2hdf(b, hdf_file, group=None, replace=True):
+def bin2hdf(b, hdf_file, group=None, replace=True, layout=ROI_LAYOUT_DATASETS):
     """
     Write a ``Bin`` to an HDF file.
 
@@ -132,6 +196,7 @@ def bin2hdf(b, hdf_file, group=None, replace=True):
       to use
     :param replace: whether to replace any existing data
       at that location in the HDF file
+    :param layout: the layout to use for images (see ``roi2hdf``)
     """
     with hdfopen(hdf_file, group, replace=replace) as root:
         root.attrs['pid'] = str(b.pid)
@@ -141,9 +206,9 @@ def bin2hdf(b, hdf_file, group=None, replace=True):
         with hdfopen(root, 'adc') as adc:
             pd2hdf(adc, b.adc, compression='gzip')
             adc.attrs['schema'] = b.schema._name
-        roi2hdf(b.images, root, 'roi', replace=replace)
+        roi2hdf(b.images, root, 'roi', replace=replace, layout=layout)
 
-def filesetbin2hdf(fs_bin, hdf_file, group=None, replace=True, archive=False):
+def filesetbin2hdf(fs_bin, hdf_file, group=None, replace=True, archive=False, layout=ROI_LAYOUT_DATASETS):
     """
     Write a ``FilesetBin`` to an HDF file.
 
@@ -165,67 +230,282 @@ def filesetbin2hdf(fs_bin, hdf_file, group=None, replace=True, archive=False):
       at that location in the HDF file
     :param archive: whether to store copies of the ``.adc`` and ``.hdr``
       files in the HDF file
+    :param layout: the layout to use for images (see ``roi2hdf``)
     """
     with hdfopen(hdf_file, group, replace=replace) as root:
-        bin2hdf(fs_bin, root)
+        bin2hdf(fs_bin, root, layout=layout)
         if archive:
             file2hdf(root, 'archive/adc', fs_bin.fileset.adc_path, compression='gzip')
             file2hdf(root, 'archive/hdr', fs_bin.fileset.hdr_path)
         
-def fileset2hdf(fileset, hdf_file, group=None, replace=True, archive=False):
+def fileset2hdf(fileset, hdf_file, group=None, replace=True, archive=False, layout=ROI_LAYOUT_DATASETS):
     """
     Write a fileset to HDF.
 
     :see filesetbin2hdf
     """
     with FilesetBin(fileset) as fs_bin:
-        filesetbin2hdf(fs_bin, hdf_file, group=group, replace=replace, archive=archive)
+        filesetbin2hdf(fs_bin, hdf_file, group=group, replace=replace, archive=archive, layout=layout)
+
+# bulk archiving of many bins into one HDF file
+
+def _deflate_chunks(buffer, chunk_size, level):
+    # compress each chunk as HDF5's gzip filter would. partial final
+    # chunks are padded, because HDF5 stores edge chunks at full size
+    chunks = []
+    for start in range(0, buffer.size, chunk_size):
+        chunk = buffer[start:start + chunk_size]
+        if chunk.size < chunk_size:
+            chunk = np.pad(chunk, (0, chunk_size - chunk.size))
+        chunks.append(zlib.compress(chunk.tobytes(), level))
+    return chunks
+
+def _prepare_bin(b, compression_level=4, archive=False):
+    # parse and compress everything needed to write a bin, so
+    # that the writer only has to copy bytes into the HDF file
+    packed = pack_images(b.images)
+    p = {
+        'lid': b.lid,
+        'pid': str(b.pid),
+        'timestamp': b.timestamp.isoformat(),
+        'headers': dict(b.headers),
+        'adc': b.adc,
+        'schema': b.schema._name,
+        'targets': packed.targets,
+        'offsets': packed.offsets,
+        'shapes': packed.shapes,
+        'n_pixels': packed.buffer.size,
+        'chunk_size': min(ROI_CHUNK_SIZE, packed.buffer.size),
+    }
+    p['chunks'] = _deflate_chunks(packed.buffer, p['chunk_size'], compression_level)
+    if archive and hasattr(b, 'fileset'):
+        for ext in ['adc', 'hdr']:
+            with open(getattr(b.fileset, ext + '_path'), 'rb') as fin:
+                p[ext + '_file'] = np.frombuffer(fin.read(), dtype=np.uint8)
+    return p
+
+def _write_prepared(root, p, compression_level):
+    root.attrs['pid'] = p['pid']
+    root.attrs['lid'] = p['lid']
+    root.attrs['timestamp'] = p['timestamp']
+    hdr2hdf(p['headers'], root, 'hdr')
+    with hdfopen(root, 'adc') as adc:
+        pd2hdf(adc, p['adc'], compression='gzip', compression_opts=compression_level)
+        adc.attrs['schema'] = p['schema']
+    with hdfopen(root, 'roi') as roi:
+        if p['n_pixels'] > 0:
+            chunk_size = p['chunk_size']
+            pixels = roi.create_dataset('pixels', shape=(p['n_pixels'],), dtype=np.uint8,
+                chunks=(chunk_size,), compression='gzip', compression_opts=compression_level)
+            for i, chunk in enumerate(p['chunks']):
+                pixels.id.write_direct_chunk((i * chunk_size,), chunk)
+        else:
+            roi.create_dataset('pixels', data=np.zeros(0, dtype=np.uint8))
+        _write_packed_index(roi, p['targets'], p['offsets'], p['shapes'])
+    if 'adc_file' in p:
+        root.create_dataset('archive/adc', data=p['adc_file'], compression='gzip', compression_opts=compression_level)
+        root.create_dataset('archive/hdr', data=p['hdr_file'])
+    # written last, so that interrupted writes can be detected
+    root.attrs['complete'] = True
+
+def bins2hdf(bins, hdf_path, workers=None, chunksize=1, compression_level=4, archive=False):
+    """
+    Write many bins to one HDF file, each in a group named
+    after its LID and laid out as in ``bin2hdf``. Images are
+    always written in the packed layout (see ``roi2hdf``).
+
+    Bins from raw data filesets are parsed and their images
+    compressed in a pool of worker processes (see ``BinMap``);
+    the HDF file is opened once and written by this process only.
+    Other kinds of bins are prepared in this process.
+
+    Each group is marked complete once it has been written. Groups
+    that are already complete are skipped, so an interrupted
+    archive can be resumed by calling this again; incomplete
+    groups are rewritten.
+
+    :param bins: a ``DataDirectory``, or an iterable of bins or
+      ``Fileset`` objects
+    :param hdf_path: the path of the HDF file (created if it does
+      not exist)
+    :param workers: the number of processes (default: the number
+      of CPUs; 0 to prepare bins in this process)
+    :param chunksize: the number of filesets to send to a worker at once
+    :param compression_level: the gzip compression level
+    :param archive: whether to store copies of the ``.adc`` and ``.hdr``
+      files of raw data filesets (see ``filesetbin2hdf``)
+    :returns dict: the number of bins ``written`` and ``skipped``, and
+      a dict of ``failed`` bins mapping LIDs to formatted tracebacks
+    """
+    from .files import Fileset, DataDirectory
+    if isinstance(bins, DataDirectory):
+        bins = bins.list_filesets()
+    stats = { 'written': 0, 'skipped': 0, 'failed': {} }
+    prepare = partial(_prepare_bin, compression_level=compression_level, archive=archive)
+    with h5.File(hdf_path, 'a') as f:
+        def is_complete(lid):
+            return lid in f and bool(f[lid].attrs.get('complete', False))
+        filesets, others = [], []
+        for b in bins:
+            if isinstance(b, FilesetBin):
+                b = b.fileset
+            if is_complete(b.lid):
+                stats['skipped'] += 1
+            elif isinstance(b, Fileset):
+                filesets.append(b)
+            else:
+                others.append(b)
+        def prepared():
+            yield from map_bins(prepare, filesets, workers=workers, chunksize=chunksize, ordered=False)
+            for b in others:
+                try:
+                    yield BinResult(b.lid, prepare(b), None)
+                except Exception:
+                    yield BinResult(b.lid, None, traceback.format_exc())
+        for result in prepared():
+            if result.error is not None:
+                stats['failed'][result.lid] = result.error
+                continue
+            if result.lid in f: # incomplete
+                del f[result.lid]
+            _write_prepared(f.create_group(result.lid), result.value, compression_level)
+            f.flush()
+            stats['written'] += 1
+    return stats
 
-def hdf2fileset(hdf_path, fileset_path, group=None):
+def _roi2file(roi_group, outfile, buffer_size=HDF_COPY_BUFFER_SIZE):
+    roi = HdfRoi(roi_group)
+    if roi.layout == ROI_LAYOUT_PACKED:
+        # the pixels are stored in the order in which they are written
+        _copy_dataset(roi._pixels, outfile, buffer_size)
+        return
+    # coalesce images into buffer-sized writes
+    buf = bytearray()
+    for _, image in roi.items():
+        buf += np.asarray(image).tobytes()
+        if len(buf) >= buffer_size:
+            outfile.write(buf)
+            buf.clear()
+    outfile.write(buf)
+
+def hdf2fileset(hdf_path, fileset_path, group=None, buffer_size=HDF_COPY_BUFFER_SIZE):
     """
     Unarchive an archived IFCB fileset from an HDF file. Creates
     ``.hdr``, ``.adc``, and ``.roi`` files exactly matching the
     original raw data. This is the inverse operation of
     ``fileset2hdf`` if it was called with ``archive`` set to True.
 
-    :param hdf_path: the path to the HDF file
+    Data is streamed, so memory use is bounded by ``buffer_size``
+    rather than by the size of the fileset.
+
+    :param hdf_path: the path to the HDF file, or an open ``h5py.Group``
     :param fileset_path: base path for output files
     :param group: (optional) the path to the HDF group containing
       the archived IFCB data
+    :param buffer_size: the number of bytes to read at a time
     """
     with hdfopen(hdf_path, group) as root:
         if not 'archive' in root:
             raise ValueError('no archived IFCB data found')
-        hdf2file(root['archive/adc'], fileset_path + '.adc')
-        hdf2file(root['archive/hdr'], fileset_path + '.hdr')
+        hdf2file(root['archive/adc'], fileset_path + '.adc', buffer_size)
+        hdf2file(root['archive/hdr'], fileset_path + '.hdr', buffer_size)
         with open(fileset_path + '.roi', 'wb') as outroi:
             schema1 = root['adc'].attrs['schema'] == SCHEMA[1]._name
             if schema1:
-                outroi.write("\0")
-            imref = root['roi/images']
-            for i in root['roi'].attrs['index']:
-                image = root[imref[i]]
-                outroi.write(np.array(image).ravel())
+                outroi.write(b"\0")
+            _roi2file(root['roi'], outroi, buffer_size)
             if schema1:
-                outroi.write("\0")
-        
+                outroi.write(b"\0")
+
+def hdf2filesets(hdf_path, directory, lids=None, buffer_size=HDF_COPY_BUFFER_SIZE):
+    """
+    Unarchive many filesets from an HDF file written by ``bins2hdf``
+    (with ``archive`` set to True), opening the file only once.
+
+    :param hdf_path: the path to the HDF file
+    :param directory: the directory in which to write the filesets
+    :param lids: (optional) the LIDs of the bins to restore (default:
+      all archived bins in the file)
+    :param buffer_size: the number of bytes to read at a time
+    :returns list: the base paths of the restored filesets
+    """
+    basepaths = []
+    with h5.File(hdf_path, 'r') as f:
+        if lids is None:
+            lids = [k for k, v in f.items() if isinstance(v, h5.Group) and 'archive' in v]
+        for lid in lids:
+            if lid not in f:
+                raise KeyError('no bin %s in %s' % (lid, hdf_path))
+            basepath = os.path.join(directory, lid)
+            hdf2fileset(f[lid], basepath, buffer_size=buffer_size)
+            basepaths.append(basepath)
+    return basepaths
+
 # bin interface to HDF
 
 class HdfRoi(BaseDictlike):
     """
-    Dict-like interface to IFCB images stored in an HDF file.
+    Dict-like interface to IFCB images stored in an HDF file,
+    in either layout written by ``roi2hdf``.
     """
-    def __init__(self, group):
+    def __init__(self, group, lid=None):
         """
         :param group: the ``h5py.Group`` containing the image data
+        :param lid: (optional) the bin's LID. If given, images are
+          read through the process-wide image cache
         """
         self._group = group
+        self.lid = lid
+        self.layout = group.attrs.get('layout', ROI_LAYOUT_DATASETS)
+    @property
+    @lru_cache()
+    def _layout(self):
+        # target numbers, offsets, and shapes of the packed layout
+        g = self._group
+        targets = np.asarray(g.attrs['index'], dtype=np.int64)
+        shapes = np.stack([g['heights'][()], g['widths'][()]], axis=1)
+        return targets, g['offsets'][()], shapes
+    @property
+    @lru_cache()
+    def _pixels(self):
+        return self._group['pixels']
+    def _position(self, roi_number):
+        targets = self._layout[0]
+        i = np.searchsorted(targets, roi_number)
+        if i == len(targets) or targets[i] != roi_number:
+            raise KeyError('no ROI #%d' % roi_number)
+        return i
     def keys(self):
         yield from self._group.attrs['index']
+    def has_key(self, roi_number):
+        if self.layout == ROI_LAYOUT_DATASETS:
+            return super(HdfRoi, self).has_key(roi_number)
+        try:
+            self._position(roi_number)
+            return True
+        except KeyError:
+            return False
     def __len__(self):
         return len(self._group.attrs['index'])
     def __getitem__(self, roi_number):
-        return np.array(self._group[self._group['images'][roi_number]])
+        return cached_image(self.lid, roi_number, RAW, lambda: self._read_image(roi_number))
+    def _read_image(self, roi_number):
+        if self.layout == ROI_LAYOUT_DATASETS:
+            return np.array(self._group[self._group['images'][roi_number]])
+        i = self._position(roi_number)
+        _, offsets, shapes = self._layout
+        h, w = shapes[i]
+        o = offsets[i]
+        return self._pixels[o:o + h * w].reshape((h, w))
+    def pack(self):
+        """
+        Read all the images into a ``PackedImages``. For the packed
+        layout, this reads the pixel data in a single operation.
+        """
+        if self.layout == ROI_LAYOUT_DATASETS:
+            return pack_images(dict(self.items()))
+        targets, offsets, shapes = self._layout
+        return PackedImages(targets, self._pixels[()], offsets, shapes)
         
 class HdfBin(BaseBin):
     """
@@ -279,6 +559,17 @@ class HdfBin(BaseBin):
         The bin's ADC data as a ``pandas.DataFrame``
         """
         return hdf2pd(self._group['adc'])
+    def adc_columns(self, columns, rows=None):
+        """
+        Read some of the bin's ADC data, without reading or
+        caching the rest.
+
+        :param columns: the column numbers to read (e.g.,
+          ``[b.schema.ROI_WIDTH, b.schema.ROI_HEIGHT]``)
+        :param rows: (optional) a ``slice`` selecting rows by position
+        :returns pandas.DataFrame: the selected ADC data
+        """
+        return hdf2pd(self._group['adc'], columns=columns, rows=rows)
     @property
     @lru_cache()
     def schema(self):
@@ -301,8 +592,9 @@ class HdfBin(BaseBin):
         """
         return Pid(self._group.attrs['pid'])
     @property
+    @lru_cache()
     def images(self):
         """
         The bin's images
         """
-        return HdfRoi(self._group['roi'])
+        return HdfRoi(self._group['roi'], lid=self.lid)
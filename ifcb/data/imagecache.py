@@ -0,0 +1,177 @@
+"""
+Process-wide cache of decoded images.
+
+Images are cached by ``(bin lid, target number, variant)``, where the
+variant distinguishes different images for the same target (e.g.,
+raw images and infilled images of revision 1 bins), so that any bin type reading the
+same raw image shares one cache entry. Caching is disabled until a
+cache is configured with ``set_image_cache``:
+
+>>> set_image_cache(ImageCache(max_bytes=256 * 1024 * 1024))
+
+Cached images are read-only, since they are shared between callers.
+Only single-image access is cached; bulk reads such as ``read_many``
+and ``iter_images`` bypass the cache so they do not evict hot images.
+"""
+
+from collections import OrderedDict
+from threading import RLock
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+RAW = 'raw' # images as stored in the raw data
+INFILLED = 'infilled' # images as provided by ``InfilledImages``
+
+def _buffer_nbytes(image):
+    # the size of the buffer that an array's memory belongs to
+    base = image
+    while isinstance(base, np.ndarray) and base.base is not None:
+        base = base.base
+    if isinstance(base, np.ndarray):
+        return base.nbytes
+    try:
+        return memoryview(base).nbytes
+    except TypeError:
+        return image.nbytes
+
+class ImageCache(object):
+    """
+    Thread-safe LRU cache of images with a budget in bytes.
+    When adding an image would exceed the budget, the least
+    recently used images are evicted. Images larger than the
+    budget are not cached.
+
+    Any object with ``get``, ``put``, and ``get_or_load`` methods
+    can be used in its place with ``set_image_cache``.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param max_bytes: the maximum number of bytes of image
+          data to hold
+        """
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._lock = RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get(self, key):
+        """
+        :returns: the cached image, or None if it is not cached
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self._images.move_to_end(key)
+                self.hits += 1
+            return image
+    def put(self, key, image):
+        """
+        Add an image to the cache, evicting images as needed.
+        The cache holds a read-only view of the array, so the array
+        passed in is not modified. Views into larger buffers (e.g.,
+        images in a ``PackedImages``) are copied, so that cached
+        images do not keep the rest of the buffer in memory.
+
+        :returns: the cached (read-only) image
+        """
+        if _buffer_nbytes(image) > image.nbytes:
+            image = image.copy()
+        else:
+            image = image.view()
+        image.flags.writeable = False
+        if image.nbytes > self.max_bytes:
+            return image
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self._images and self.nbytes + image.nbytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+            self._images[key] = image
+            self.nbytes += image.nbytes
+        return image
+    def get_or_load(self, key, load):
+        """
+        Get an image, calling ``load`` to read it and
+        adding it to the cache if it is not cached.
+
+        :param key: the cache key
+        :param load: a function of no arguments returning the image
+        """
+        image = self.get(key)
+        if image is None:
+            # load outside the lock so that other threads are not blocked
+            image = self.put(key, load())
+        return image
+    def clear(self):
+        """
+        Remove all images from the cache. Counters are not reset.
+        """
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+    def stats(self):
+        """
+        :returns dict: counters for monitoring
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'images': len(self._images),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+    def __len__(self):
+        return len(self._images)
+    def __contains__(self, key):
+        return key in self._images
+    def __repr__(self):
+        return '<ImageCache %d images, %d/%d bytes>' % (len(self), self.nbytes, self.max_bytes)
+
+_image_cache = None
+
+def set_image_cache(cache):
+    """
+    Configure the process-wide image cache.
+
+    While a cache is configured, images returned by bins that use it
+    (``RoiFile``, ``HdfRoi``, ``ZipBin``, ``BlobFile``, and stitched
+    images from ``InfilledImages``) are read-only, including those
+    that would otherwise be writable, because the same array is
+    returned to every caller. Copy an image before modifying it.
+
+    :param cache: an ``ImageCache`` (or compatible object), or
+      None to disable caching
+    """
+    global _image_cache
+    _image_cache = cache
+
+def get_image_cache():
+    """
+    :returns: the process-wide image cache, or None
+    """
+    return _image_cache
+
+def cached_image(lid, target, variant, load):
+    """
+    Get an image through the process-wide cache, if one is configured.
+
+    :param lid: the bin lid (if None, the image is not cached)
+    :param target: the target number
+    :param variant: the kind of image (e.g., ``RAW``)
+    :param load: a function of no arguments returning the image
+    """
+    cache = _image_cache
+    if cache is None or lid is None:
+        return load()
+    return cache.get_or_load((str(lid), int(target), variant), load)
@@ -1,4 +1,7 @@
+import os
 from io import BytesIO
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
 from PIL import Image
 import numpy as np
@@ -13,10 +16,12 @@ PIL_FORMATS_BY_MIME_TYPE = {
     'image/x-xbitmap': 'XBM'
 }
 
-def format_image(array, mimetype='image/png'):
+def format_image(array, mimetype='image/png', **kw):
     """
     Represent the image in the given format and
-    return the bytes of the image.
+    return the bytes of the image. Keywords are passed
+    through to PIL as format-specific options (e.g., for
+    PNG, ``compress_level`` and ``compress_type``).
 
     :param array: the image
     :param mimetype: the format's MIME type
@@ -30,10 +35,72 @@ def format_image(array, mimetype='image/png'):
         array = array.astype(np.uint8)
         array *= 255
     pil = Image.fromarray(array)
-    pil.save(buf, fmt)
+    pil.save(buf, fmt, **kw)
     buf.seek(0)
     return buf
 
+def png_options(compress_level=None, compress_type=None):
+    """
+    PIL options for PNG encoding, for use with ``format_image``
+    and ``encode_images``.
+
+    :param compress_level: the zlib compression level, 0-9
+      (default: PIL's default, 6)
+    :param compress_type: the zlib compression strategy, e.g.
+      ``zlib.Z_FILTERED``, ``zlib.Z_RLE`` or ``zlib.Z_HUFFMAN_ONLY``
+      (default: ``zlib.Z_DEFAULT_STRATEGY``)
+    :returns dict: the options
+    """
+    options = {}
+    if compress_level is not None:
+        options['compress_level'] = compress_level
+    if compress_type is not None:
+        options['compress_type'] = compress_type
+    return options
+
+def _encode(array, mimetype, options):
+    return format_image(array, mimetype, **options).getvalue()
+
+def encode_images(items, workers=1, processes=False, mimetype='image/png', **kw):
+    """
+    Encode many images, concurrently if ``workers`` is more than 1.
+    Results are yielded in the same order as the input, and only
+    a bounded number of images are read ahead of the consumer.
+
+    Keywords are passed through to PIL (see ``format_image`` and
+    ``png_options``).
+
+    :param items: an iterable of ``(key, image)`` pairs
+    :param workers: the number of workers (``None`` for the number
+      of CPUs), or a ``concurrent.futures.Executor`` to use
+    :param processes: whether to use processes rather than threads
+    :param mimetype: the MIME type of the format to encode
+    :returns: a generator of ``(key, bytes)`` pairs
+    """
+    if isinstance(workers, Executor):
+        yield from _encode_with(workers, items, mimetype, kw, max_pending=4 * (os.cpu_count() or 1))
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for key, array in items:
+            yield key, _encode(array, mimetype, kw)
+        return
+    pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool_class(max_workers=workers) as executor:
+        yield from _encode_with(executor, items, mimetype, kw, max_pending=4 * workers)
+
+def _encode_with(executor, items, mimetype, options, max_pending):
+    pending = deque()
+    for key, array in items:
+        pending.append((key, executor.submit(_encode, array, mimetype, options)))
+        if len(pending) >= max_pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+    while pending:
+        key, future = pending.popleft()
+        yield key, future.result()
+
 def read_image(buf_or_filename):
     pil = Image.open(buf_or_filename)
     return np.array(pil)
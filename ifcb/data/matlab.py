@@ -1,3 +1,7 @@
+import os
+import struct
+from functools import lru_cache
+
 import numpy as np
 from scipy.io import savemat, loadmat
 import pandas as pd
@@ -19,46 +23,176 @@ MAX_FIELD_LENGTH = 31
 # the matrix of ADC data is of a uniform type, so int columns
 # come back as floats.
 
-def bin2mat(b, mat_path):
+def bin2mat(b, mat_path, batch_size=None):
+    """
+    Write a bin to a MATLAB ``.mat`` file.
+
+    By default, all images are read into memory and written with
+    ``savemat``. If ``batch_size`` is given, images are instead
+    read that many at a time and streamed into the file, so that
+    memory use is bounded by the size of a batch.
+
+    :param b: the bin
+    :param mat_path: the path of the ``.mat`` file
+    :param batch_size: (optional) the number of images to hold in
+      memory at once
+    """
     # ADC data
     adc = np.array(b.adc)
-    # warning: reads all images into memory
-    roi_numbers = sorted(b.images)
-    images = np.array([ b.images[r] for r in roi_numbers ], dtype=object)
-    savemat(mat_path, {
+    variables = {
         PID_VAR: str(b.lid), # remove non-bin parts of pid
         HEADERS_VAR: b.headers,
         ADC_VAR: adc,
-        ROI_NUMBERS_VAR: roi_numbers,
-        IMAGES_VAR: images
-    }, long_field_names=True)
+        ROI_NUMBERS_VAR: sorted(b.images),
+    }
+    if batch_size is not None:
+        _check_cells_size(b)
+        try:
+            with open(mat_path, 'wb') as fout:
+                savemat(fout, variables, long_field_names=True)
+                _write_image_cells(fout, _iter_images(b.images, batch_size))
+        except Exception:
+            # do not leave a partial file, if one was created
+            try:
+                os.remove(mat_path)
+            except OSError:
+                pass
+            raise
+        return
+    # warning: reads all images into memory
+    roi_numbers = variables[ROI_NUMBERS_VAR]
+    images = np.array([ b.images[r] for r in roi_numbers ], dtype=object)
+    variables[IMAGES_VAR] = images
+    savemat(mat_path, variables, long_field_names=True)
+
+def _iter_images(images, batch_size):
+    # yield images in roi number order, batch_size at a time
+    if hasattr(images, 'iter_images'): # RoiFile
+        for _, image in images.iter_images(batch_size):
+            yield image
+    else:
+        for k in sorted(images):
+            yield images[k]
+
+# MAT-file (level 5) data types and array classes
+MI_INT8, MI_UINT8, MI_INT32, MI_UINT32, MI_MATRIX = 1, 2, 5, 6, 14
+MX_CELL_CLASS, MX_UINT8_CLASS = 1, 9
+
+# element sizes are stored as 32-bit unsigned integers
+MAX_ELEMENT_SIZE = 2**32 - 1
+
+def _mat_element(data_type, data):
+    # a data element: tag and data, padded to 8 bytes
+    padding = b'\0' * (-len(data) % 8)
+    return struct.pack('<2I', data_type, len(data)) + data + padding
+
+def _mat_array_header(mx_class, dims, name):
+    flags = _mat_element(MI_UINT32, struct.pack('<2I', mx_class, 0))
+    dims = _mat_element(MI_INT32, struct.pack('<%di' % len(dims), *dims))
+    return flags + dims + _mat_element(MI_INT8, name.encode('ascii'))
+
+def _cells_size(shapes):
+    # size of a cell array of uint8 images with the given shapes, excluding its tag
+    size = len(_mat_array_header(MX_CELL_CLASS, (1, 0), IMAGES_VAR))
+    cell_header = 8 + len(_mat_array_header(MX_UINT8_CLASS, (1, 1), '')) + 8
+    pixels = np.prod(np.asarray(shapes, dtype=np.int64).reshape(-1, 2), axis=1)
+    return size + int(np.sum(cell_header + pixels + (-pixels % 8)))
+
+def _check_cells_size(b):
+    # raise before writing if the bin's images cannot be stored
+    s = b.schema
+    adc = b.adc
+    adc = adc[adc[s.ROI_WIDTH] != 0] # targets with no image
+    shapes = adc[[s.ROI_HEIGHT, s.ROI_WIDTH]].to_numpy()
+    if _cells_size(shapes) > MAX_ELEMENT_SIZE:
+        raise ValueError('images of %s exceed the 4 GB size limit of a MAT-file variable' % b.lid)
+
+def _write_image_cells(fout, images):
+    """
+    Append a 1xn cell array of uint8 images to an open MAT-file,
+    writing one image at a time. The size of the array is patched
+    into its header once all images have been written.
+
+    Raises ``ValueError`` if the array would exceed the 4 GB element
+    size limit of the format; this is checked before each image is
+    written.
+    """
+    start = fout.tell()
+    header = _mat_array_header(MX_CELL_CLASS, (1, 0), IMAGES_VAR)
+    fout.write(struct.pack('<2I', MI_MATRIX, 0))
+    fout.write(header)
+    size = len(header) # size of the array element, excluding its tag
+    n = 0
+    for image in images:
+        image = np.asarray(image, dtype=np.uint8)
+        # MATLAB arrays are column-major
+        data = _mat_element(MI_UINT8, np.asfortranarray(image).tobytes(order='F'))
+        cell = _mat_array_header(MX_UINT8_CLASS, image.shape, '') + data
+        size += 8 + len(cell)
+        if size > MAX_ELEMENT_SIZE:
+            raise ValueError('images exceed the 4 GB size limit of a MAT-file variable')
+        fout.write(struct.pack('<2I', MI_MATRIX, len(cell)))
+        fout.write(cell)
+        n += 1
+    end = fout.tell()
+    fout.seek(start)
+    fout.write(struct.pack('<2I', MI_MATRIX, end - start - 8))
+    fout.write(_mat_array_header(MX_CELL_CLASS, (1, n), IMAGES_VAR))
+    fout.seek(end)
 
 class _MatBinImages(BaseDictlike):
-    def __init__(self, mat):
-        self._mat = mat
+    def __init__(self, mat_bin):
+        self._bin = mat_bin
+        self._roi_numbers = np.atleast_1d(mat_bin._mat[ROI_NUMBERS_VAR]).tolist()
+        self._index = { k: i for i, k in enumerate(self._roi_numbers) }
+    @property
+    @lru_cache()
+    def _images(self):
+        mat = self._bin._mat
+        if IMAGES_VAR not in mat: # lazy loading
+            mat = self._bin._load([IMAGES_VAR])
+        images = mat[IMAGES_VAR]
+        if len(self._roi_numbers) == 1 and images.dtype != object:
+            images = [images] # single image was squeezed
+        return images
     def keys(self):
-        for k in self._mat[ROI_NUMBERS_VAR]:
-            yield k
+        yield from self._roi_numbers
     def has_key(self, k):
-        return k in self._mat[ROI_NUMBERS_VAR]
+        return k in self._index
+    def __len__(self):
+        return len(self._roi_numbers)
     def __getitem__(self, roi_number):
-        i = 0
-        for k in self.keys():
-            if k == roi_number:
-                return self._mat[IMAGES_VAR][i]
-            i += 1 
-        raise KeyError('no ROI #%d' % roi_number)
+        try:
+            i = self._index[roi_number]
+        except KeyError:
+            raise KeyError('no ROI #%d' % roi_number)
+        return self._images[i]
     
 class MatBin(BaseBin):
-    def __init__(self, mat_path):
-        self._mat = loadmat(mat_path, squeeze_me=True)
+    """
+    Bin interface to a ``.mat`` file written by ``bin2mat``.
+
+    By default, images are not loaded until one is accessed, so
+    header and ADC access do not require decoding every image.
+    """
+    def __init__(self, mat_path, lazy=True):
+        """
+        :param mat_path: the path of the ``.mat`` file
+        :param lazy: whether to defer loading images until
+          they are accessed (if not, the whole file is loaded)
+        """
+        self.mat_path = mat_path
+        if lazy:
+            self._mat = self._load([PID_VAR, ADC_VAR, ROI_NUMBERS_VAR, HEADERS_VAR])
+        else:
+            self._mat = self._load()
         self.pid = Pid(self._mat[PID_VAR])
         self.adc = pd.DataFrame(self._mat[ADC_VAR]);
         self.adc.index += 1 # 1-based indexes
-        self.images = _MatBinImages(self._mat)
+        self.images = _MatBinImages(self)
         rec = self._mat[HEADERS_VAR]
         rec_names = rec.dtype.names
         self.headers = { n : rec[n].item() for n in rec_names }
-
-
-
+    def _load(self, variable_names=None):
+        # load some (by default, all) of the variables in the file
+        return loadmat(self.mat_path, squeeze_me=True, variable_names=variable_names)
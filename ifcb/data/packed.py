@@ -0,0 +1,96 @@
+"""
+Compact in-memory representation of a bin's images.
+"""
+
+import numpy as np
+
+from .utils import BaseDictlike
+
+class PackedImages(BaseDictlike):
+    """
+    Stores many images in a single contiguous ``uint8`` buffer,
+    with arrays of target numbers, offsets into the buffer, and
+    image shapes. This avoids allocating an array per image when
+    holding all of a bin's images in memory.
+
+    Provides a dict-like interface; keys are target numbers, values
+    are read-only 2d images that are views into the buffer.
+    """
+    def __init__(self, targets, buffer, offsets, shapes):
+        """
+        :param targets: the target number of each image, in ascending order
+        :param buffer: a 1d ``uint8`` array containing the pixel data
+        :param offsets: the position of each image in the buffer
+        :param shapes: an ``(n, 2)`` array of image (height, width)
+        """
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.buffer = np.asarray(buffer, dtype=np.uint8).view()
+        self.buffer.flags.writeable = False
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+        if not (len(self.targets) == len(self.offsets) == len(self.shapes)):
+            raise ValueError('targets, offsets, and shapes must be the same length')
+    def _position(self, target_number):
+        i = np.searchsorted(self.targets, target_number)
+        if i == len(self.targets) or self.targets[i] != target_number:
+            raise KeyError('no ROI #%d' % target_number)
+        return i
+    def keys(self):
+        return self.targets
+    def has_key(self, target_number):
+        try:
+            self._position(target_number)
+            return True
+        except KeyError:
+            return False
+    def __len__(self):
+        return len(self.targets)
+    def shape(self, target_number):
+        h, w = self.shapes[self._position(target_number)]
+        return (int(h), int(w))
+    def _image(self, i):
+        h, w = self.shapes[i]
+        o = self.offsets[i]
+        return self.buffer[o:o + h * w].reshape((h, w))
+    def __getitem__(self, target_number):
+        return self._image(self._position(target_number))
+    def items(self):
+        for i, target_number in enumerate(self.targets.tolist()):
+            yield target_number, self._image(i)
+    @property
+    def nbytes(self):
+        """
+        The total size of the buffer and index arrays in bytes
+        """
+        return self.buffer.nbytes + self.targets.nbytes + self.offsets.nbytes + self.shapes.nbytes
+    def __repr__(self):
+        return '<PackedImages (%d images)>' % len(self)
+
+def pack_images(images):
+    """
+    Pack a dict-like of images into a ``PackedImages``.
+
+    Uses the source's ``pack`` method if it has one (e.g.,
+    ``RoiFile.pack``, which packs with a single read). Otherwise
+    the images are read one at a time and copied into the buffer.
+
+    :param images: dict-like mapping target numbers to 2d images
+    :returns PackedImages: the packed images
+    """
+    if isinstance(images, PackedImages):
+        return images
+    pack = getattr(images, 'pack', None)
+    if pack is not None:
+        return pack()
+    targets, arrays = [], []
+    for target_number, image in sorted(images.items(), key=lambda item: item[0]):
+        targets.append(target_number)
+        arrays.append(np.asarray(image, dtype=np.uint8))
+    shapes = np.array([a.shape for a in arrays], dtype=np.int64).reshape(-1, 2)
+    lengths = shapes[:, 0] * shapes[:, 1]
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    if arrays:
+        buffer = np.concatenate([a.ravel() for a in arrays])
+    else:
+        buffer = np.zeros(0, dtype=np.uint8)
+    return PackedImages(targets, buffer, offsets[:len(targets)], shapes)
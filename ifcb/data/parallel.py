@@ -0,0 +1,156 @@
+"""
+Parallel computation over many bins.
+"""
+
+import os
+import time
+import traceback
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .files import Fileset, FilesetBin
+
+BinResult = namedtuple('BinResult', ['lid', 'value', 'error'])
+BinResult.__doc__ = """
+The result of applying a function to one bin. If the function
+raised an exception, ``value`` is ``None`` and ``error`` is the
+formatted traceback.
+"""
+
+def _apply(func, basepath, require_roi_files):
+    lid = basepath
+    try:
+        fs = Fileset(basepath, require_roi_files=require_roi_files)
+        try:
+            lid = fs.lid
+        except ValueError: # unparseable pid
+            pass
+        return BinResult(lid, func(FilesetBin(fs)), None)
+    except Exception:
+        return BinResult(lid, None, traceback.format_exc())
+
+def _apply_chunk(func, basepaths, require_roi_files):
+    return [_apply(func, bp, require_roi_files) for bp in basepaths]
+
+def _chunks(filesets, chunksize):
+    chunk = []
+    for fs in filesets:
+        chunk.append(fs.basepath)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class BinMap(object):
+    """
+    Applies a function to the bins of many filesets using a process
+    pool, and yields a ``BinResult`` for each one.
+
+    Workers are sent fileset paths rather than bins, and open the
+    bins themselves. Exceptions raised by the function are captured
+    in the results rather than stopping the computation. While
+    iterating, the ``completed``, ``failed``, ``elapsed`` and
+    ``throughput`` attributes report progress.
+
+    The function must be picklable (e.g., defined at module level)
+    unless ``workers`` is 0, in which case it is applied in this process.
+
+    :Example:
+
+    >>> def n_images(b):
+    ...     return len(b.images)
+    >>> for result in DataDirectory('/data').map(n_images, workers=8):
+    ...     print(result.lid, result.value)
+    """
+    def __init__(self, func, filesets, workers=None, chunksize=1, ordered=True, require_roi_files=True):
+        """
+        :param func: a function that takes a ``FilesetBin``
+        :param filesets: an iterable of ``Fileset`` objects
+        :param workers: the number of processes (default: the number
+          of CPUs; 0 to apply the function in this process)
+        :param chunksize: the number of filesets to send to a worker at once
+        :param ordered: whether to yield results in the order of the
+          filesets, rather than as they are completed
+        :param require_roi_files: bool, whether to require the .roi file
+        """
+        if chunksize < 1:
+            raise ValueError('chunksize must be at least 1')
+        self.func = func
+        self.filesets = filesets
+        self.workers = workers
+        self.chunksize = chunksize
+        self.ordered = ordered
+        self.require_roi_files = require_roi_files
+        self.completed = 0
+        self.failed = 0
+        self._start = None
+    @property
+    def elapsed(self):
+        """
+        Seconds since iteration started
+        """
+        if self._start is None:
+            return 0.0
+        return time.monotonic() - self._start
+    @property
+    def throughput(self):
+        """
+        Bins completed per second
+        """
+        elapsed = self.elapsed
+        if elapsed == 0:
+            return 0.0
+        return self.completed / elapsed
+    def _record(self, results):
+        for result in results:
+            self.completed += 1
+            if result.error is not None:
+                self.failed += 1
+            yield result
+    def _serial(self, chunks):
+        for chunk in chunks:
+            yield from self._record(_apply_chunk(self.func, chunk, self.require_roi_files))
+    def _parallel(self, chunks, executor, max_pending):
+        pending = deque()
+        def submit_next():
+            for chunk in chunks:
+                pending.append(executor.submit(_apply_chunk, self.func, chunk, self.require_roi_files))
+                return True
+            return False
+        while len(pending) < max_pending and submit_next():
+            pass
+        while pending:
+            if self.ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            submit_next()
+            yield from self._record(future.result())
+    def __iter__(self):
+        self.completed, self.failed = 0, 0
+        self._start = time.monotonic()
+        chunks = _chunks(self.filesets, self.chunksize)
+        if self.workers == 0:
+            yield from self._serial(chunks)
+            return
+        workers = self.workers
+        if workers is None:
+            workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # bound the number of chunks in flight so results stream
+            max_pending = 4 * workers
+            yield from self._parallel(chunks, executor, max_pending)
+    def __repr__(self):
+        return '<BinMap %d completed, %d failed, %.1f bins/s>' % (self.completed, self.failed, self.throughput)
+
+def map_bins(func, filesets, workers=None, chunksize=1, ordered=True, require_roi_files=True):
+    """
+    Apply a function to the bins of many filesets in parallel.
+
+    :see BinMap
+    :returns BinMap: an iterable of ``BinResult``
+    """
+    return BinMap(func, filesets, workers=workers, chunksize=chunksize, ordered=ordered, require_roi_files=require_roi_files)
@@ -0,0 +1,154 @@
+"""
+Pool of recently used fileset bins.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from .files import FilesetBin
+
+DEFAULT_MAX_BINS = 64
+DEFAULT_MAX_OPEN = 16
+
+def _stamp(fileset):
+    # modification times and sizes of the files parsed or read by a bin
+    stamp = []
+    for path in [fileset.adc_path, fileset.hdr_path, fileset.roi_path]:
+        try:
+            st = os.stat(path)
+            stamp += [st.st_mtime_ns, st.st_size]
+        except OSError: # missing
+            stamp += [None, None]
+    return tuple(stamp)
+
+class BinPool(object):
+    """
+    Bounded cache of recently used ``FilesetBin`` objects, keyed
+    by LID or by a caller-supplied key (``DataDirectory`` keys bins
+    by its path and listing options as well, so that one pool can be
+    shared between directories). Pooled bins keep their parsed ADC
+    data and headers.
+
+    Pooled bins memory-map their ``.roi`` files (see ``RoiFile``).
+    A bin's file is mapped when an image is first read and stays
+    mapped, so later reads do not reopen it. At most ``max_open``
+    pooled bins stay mapped: each time a bin is retrieved, the
+    mappings of the least recently used bins beyond that are closed,
+    to be remapped if they are read again. Bins evicted from the
+    pool are closed. Bins are not opened by the pool, so
+    ``as_single`` and the context manager work as usual.
+
+    The pool can be shared between threads. Closing a mapping does
+    not affect reads in progress or images already read, since each
+    read holds a reference to the mapping it reads from; the mapping
+    itself is released once no image read from it is referenced.
+
+    A pooled bin is replaced if its files' modification times or
+    sizes change.
+    """
+    def __init__(self, max_bins=DEFAULT_MAX_BINS, max_open=DEFAULT_MAX_OPEN):
+        """
+        :param max_bins: the maximum number of bins to keep
+        :param max_open: the maximum number of ``.roi`` files to
+          keep mapped
+        """
+        self.max_bins = max_bins
+        self.max_open = max_open
+        self._bins = OrderedDict() # key -> (stamp, bin), least recently used first
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def _limit_open(self):
+        # close mappings of the least recently used bins beyond the limit
+        mapped = [b for _, b in self._bins.values() if b.roi_file.ismapped()]
+        for b in mapped[:max(0, len(mapped) - self.max_open)]:
+            b.close()
+    def _discard(self, key):
+        _, b = self._bins.pop(key)
+        b.close()
+    def get(self, key):
+        """
+        Get a pooled bin, if it is in the pool and its files
+        have not changed.
+
+        :param key: the key the bin was added with (by default,
+          its LID)
+        :returns: the ``FilesetBin``, or None
+        """
+        with self._lock:
+            if key not in self._bins:
+                return None
+            stamp, b = self._bins[key]
+            if _stamp(b.fileset) != stamp:
+                self._discard(key)
+                return None
+            self.hits += 1
+            self._bins.move_to_end(key)
+            self._limit_open()
+            return b
+    def add(self, fileset, key=None):
+        """
+        Construct a bin for a fileset and add it to the pool,
+        evicting the least recently used bins as needed.
+
+        :param fileset: the ``Fileset``
+        :param key: (optional) the key to add the bin with
+          (default: the fileset's LID)
+        :returns: the ``FilesetBin``
+        """
+        if key is None:
+            key = fileset.lid
+        stamp = _stamp(fileset)
+        b = FilesetBin(fileset, use_mmap=True)
+        with self._lock:
+            self.misses += 1
+            if key in self._bins:
+                self._discard(key)
+            self._bins[key] = (stamp, b)
+            while len(self._bins) > self.max_bins:
+                self._discard(next(iter(self._bins)))
+                self.evictions += 1
+            self._limit_open()
+        return b
+    def n_open(self):
+        """
+        :returns int: the number of mapped ``.roi`` files
+        """
+        with self._lock:
+            return sum(1 for _, b in self._bins.values() if b.roi_file.ismapped())
+    def clear(self):
+        """
+        Close and remove all bins.
+        """
+        with self._lock:
+            for key in list(self._bins):
+                self._discard(key)
+    def close(self):
+        """
+        Close all ``.roi`` files, keeping the bins.
+        """
+        with self._lock:
+            for _, b in self._bins.values():
+                b.close()
+    def stats(self):
+        """
+        :returns dict: counters for monitoring
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bins': len(self._bins),
+                'open': self.n_open(),
+            }
+    def __len__(self):
+        with self._lock:
+            return len(self._bins)
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._bins
+    def __repr__(self):
+        return '<BinPool %d bins>' % len(self)
@@ -6,6 +6,7 @@ from io import BytesIO
 from ..identifiers import Pid
 from ..utils import BaseDictlike
 from ..imageio import read_image
+from ..imagecache import cached_image
 from .files import find_product_file, list_product_files
 
 class BlobDirectory(BaseDictlike):
@@ -57,6 +58,9 @@ class BlobFile(BaseDictlike):
         entry_name = '{}_{:05d}.png'.format(self.bin_lid, target_number)
         return BytesIO(zin.read(entry_name))
     def __getitem__(self, target_number):
+        variant = 'blob_v{}'.format(self.version)
+        return cached_image(self.bin_lid, target_number, variant, lambda: self._load(target_number))
+    def _load(self, target_number):
         if self._zipfile is None:
             with ZipFile(self.path) as zin:
                 image_data = self._read_image(zin, target_number)
@@ -3,12 +3,15 @@ Support for reading images from IFCB ``.roi`` files.
 """
 
 import os
+import threading
 from functools import lru_cache
 
 import numpy as np
 
 from .adc import AdcFile
 from .utils import BaseDictlike
+from .packed import PackedImages
+from .imagecache import cached_image, get_image_cache, RAW
 
 def read_image(inroi, byte_offset, width, height):
     """
@@ -26,6 +29,77 @@ def read_image(inroi, byte_offset, width, height):
     pixel_values = inroi.read(length)
     return np.frombuffer(pixel_values, dtype=np.uint8).reshape((width,height))
 
+def read_image_view(buf, byte_offset, width, height):
+    """
+    Return an image as a view into raw 8-bit binary data,
+    without copying.
+
+    :param buf: a 1d ``uint8`` array, such as a memory-mapped ``.roi`` file
+    :param byte_offset: the position of the image in the array
+    :param width: the width of the image in pixels
+    :param height: the height of the image in pixels
+
+    :returns array-like: an 8-bit 2d image
+    """
+    length = width * height
+    return buf[byte_offset:byte_offset+length].reshape((width,height))
+
+READ_MAX_GAP = 65536
+
+def read_images(inroi, byte_offsets, widths, heights, max_gap=READ_MAX_GAP):
+    """
+    Read many images from raw 8-bit binary data. Requests are sorted
+    by byte offset and images that are adjacent in the file (or separated
+    by no more than ``max_gap`` bytes) are read with a single sequential
+    read, from which the images are sliced.
+
+    Images read together share a buffer, so holding one image keeps
+    the others in memory.
+
+    :param inroi: an open file in binary read mode
+    :param byte_offsets: the position of each image in the file
+    :param widths: the width of each image in pixels
+    :param heights: the height of each image in pixels
+    :param max_gap: the largest gap in bytes between images
+      that is read through rather than skipped with a seek
+
+    :returns list: 8-bit 2d images, in the order requested
+    """
+    byte_offsets = np.asarray(byte_offsets, dtype=np.int64)
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    n = len(byte_offsets)
+    images = [None] * n
+    if n == 0:
+        return images
+    order = np.argsort(byte_offsets, kind='stable')
+    starts = byte_offsets[order]
+    ends = np.maximum.accumulate(starts + widths[order] * heights[order])
+    # start a new read wherever the gap since the previous image is too large
+    breaks = np.flatnonzero(starts[1:] - ends[:-1] > max_gap) + 1
+    for run in np.split(np.arange(n), breaks):
+        run_start, run_end = starts[run[0]], ends[run[-1]]
+        inroi.seek(run_start)
+        buf = np.frombuffer(inroi.read(run_end - run_start), dtype=np.uint8)
+        for i in run:
+            j = order[i]
+            images[j] = read_image_view(buf, starts[i] - run_start, widths[j], heights[j])
+    return images
+
+def map_roi_file(roi_path):
+    """
+    Memory-map a ``.roi`` file read-only.
+
+    The mapping is released when the returned array, and all
+    views of it, have been garbage collected.
+
+    :param roi_path: the path of the ``.roi`` file
+    :returns numpy.ndarray: a 1d ``uint8`` array
+    """
+    if os.path.getsize(roi_path) == 0: # empty files can't be mapped
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(roi_path, dtype=np.uint8, mode='r').view(np.ndarray)
+
 class RoiFile(BaseDictlike):
     """
     Wraps and provides access to an IFCB ``.roi`` file.
@@ -35,11 +109,20 @@ class RoiFile(BaseDictlike):
     and access to images by target number.
 
     Requires an associated ``.adc`` file or ``AdcFile`` object.
+
+    If ``use_mmap`` is set, the file is memory-mapped and images
+    are returned as read-only views into the mapping, with no
+    per-image reads or copies. In that mode the mapping is created
+    on first access and kept until ``close`` is called; images that
+    are still referenced remain valid after closing.
     """
-    def __init__(self, adc, roi_path):
+    def __init__(self, adc, roi_path, use_mmap=False, copy=False):
         """
         :param adc: the path of the ``.adc`` file, or an ``AdcFile`` object
         :param roi_path: the path to the ``.roi`` file
+        :param use_mmap: whether to memory-map the file
+        :param copy: whether to return writable copies of images
+          rather than read-only arrays
         """
         # duck type adc argument
         self.adc = None
@@ -49,7 +132,12 @@ class RoiFile(BaseDictlike):
         except AttributeError:
             self.adc = AdcFile(adc)
         self.path = roi_path
+        self.use_mmap = use_mmap
+        self.copy = copy
         self._inroi = None # start with the file closed
+        self._opened = False # opened explicitly, e.g. by the context manager
+        self._layout_cache = None
+        self._layout_lock = threading.Lock()
     @property
     @lru_cache()
     def csv(self):
@@ -71,13 +159,33 @@ class RoiFile(BaseDictlike):
         return os.path.getsize(self.path)
     def isopen(self):
         """
-        Flag indicating if the file is open
+        Flag indicating if the file is open. A memory mapping
+        created on first access outside of a ``with`` block does
+        not count as open.
         """
-        return self._inroi is not None
+        return self._opened
     def _open(self):
         if self.isopen():
             raise ValueError('RoiFile already open')
-        self._inroi = open(self.path, 'rb')
+        if self.use_mmap:
+            self._map()
+        else:
+            self._inroi = open(self.path, 'rb')
+        self._opened = True
+    def ismapped(self):
+        """
+        Flag indicating if the file is memory-mapped
+        """
+        return self.use_mmap and self._inroi is not None
+    def _map(self):
+        # create the memory mapping if it does not exist, and return it.
+        # readers use the returned mapping, so that closing the file in
+        # another thread does not affect reads in progress
+        mapping = self._inroi
+        if mapping is None:
+            mapping = map_roi_file(self.path)
+            self._inroi = mapping
+        return mapping
     def close(self):
         """
         Close the file.
@@ -85,14 +193,139 @@ class RoiFile(BaseDictlike):
         It is OK to call this even if the file is closed.
         """
         # allow re-closing
-        if self.isopen():
+        if self._inroi is not None and not self.use_mmap:
             self._inroi.close()
         self._inroi = None
+        self._opened = False
     def __enter__(self):
         self._open()
         return self
     def __exit__(self, *args):
         self.close()
+    def _compute_layout(self):
+        s = self.adc.schema
+        csv = self.csv
+        targets = np.asarray(csv.index, dtype=np.int64)
+        layout = (targets,) + tuple(np.asarray(csv[c], dtype=np.int64) for c in [s.START_BYTE, s.ROI_WIDTH, s.ROI_HEIGHT])
+        positions = dict(zip(targets.tolist(), range(len(targets))))
+        return layout, positions
+    def _layout_and_positions(self):
+        # computed once, under a lock: pandas builds index lookups
+        # lazily, which is not safe to do from several threads at once
+        cache = self._layout_cache
+        if cache is None:
+            with self._layout_lock:
+                if self._layout_cache is None:
+                    self._layout_cache = self._compute_layout()
+                cache = self._layout_cache
+        return cache
+    def _layout(self):
+        # target numbers, byte offsets, widths, and heights as NumPy arrays
+        return self._layout_and_positions()[0]
+    def _read_positions(self, positions, source=None):
+        # read images at the given positions in the layout, from the
+        # given open file or mapping (default: this file's own)
+        _, offsets, widths, heights = self._layout()
+        offsets, widths, heights = offsets[positions], widths[positions], heights[positions]
+        if self.use_mmap:
+            mapping = self._map() if source is None else source
+            images = [read_image_view(mapping, bo, h, w) for bo, w, h in zip(offsets, widths, heights)]
+        else:
+            inroi = self._inroi if source is None else source
+            # width and height are passed in (height, width) order, as in get_image
+            images = read_images(inroi, offsets, heights, widths)
+        if self.copy:
+            images = [im.copy() for im in images]
+        return images
+    def _open_for_reading(self):
+        # open the file if needed, returning whether it should be closed after
+        if self.use_mmap:
+            self._map() # mappings stay open until close
+            return False
+        if self.isopen():
+            return False
+        self._open()
+        return True
+    def read_many(self, targets):
+        """
+        Read many images from the file in as few reads as possible.
+        Reads are sorted by position in the file and adjacent images
+        are read together.
+
+        :param targets: the target numbers of the ROIs to read
+        :returns list: 8-bit 2d images, in the order requested
+        """
+        targets = np.asarray(targets, dtype=np.int64).ravel()
+        positions = self.csv.index.get_indexer(targets)
+        if np.any(positions < 0):
+            missing = targets[positions < 0][0]
+            raise KeyError('adc data does not contain a roi #%d' % missing)
+        close = self._open_for_reading()
+        try:
+            return self._read_positions(positions)
+        finally:
+            if close:
+                self.close()
+    def iter_images(self, batch_size=256):
+        """
+        Yield ``(target_number, image)`` pairs for every ROI in the
+        file, in target order. Images are read ``batch_size`` at a
+        time, with adjacent images in each batch read together.
+
+        :param batch_size: the number of images to read at once
+        """
+        targets = self._layout()[0]
+        # read through a private file or mapping, so that closing this
+        # file (e.g., with a ``with`` block in the loop body) while
+        # the generator is suspended does not affect it
+        if self.use_mmap:
+            source = self._map()
+        else:
+            source = open(self.path, 'rb')
+        try:
+            for i in range(0, len(targets), batch_size):
+                positions = np.arange(i, min(i + batch_size, len(targets)))
+                images = self._read_positions(positions, source)
+                yield from zip(targets[positions].tolist(), images)
+        finally:
+            if not self.use_mmap:
+                source.close()
+    def items(self):
+        """
+        Yield ``(target_number, image)`` pairs. Uses batched
+        reads (see ``iter_images``).
+        """
+        yield from self.iter_images()
+    def pack(self):
+        """
+        Read all images into a ``PackedImages``, using a single
+        read spanning all the images in the file.
+
+        If the file is memory-mapped, the buffer is a read-only view
+        into the mapping rather than an in-memory copy, unless
+        ``copy`` is set.
+
+        :returns PackedImages: the packed images
+        """
+        targets, offsets, widths, heights = self._layout()
+        shapes = np.column_stack([heights, widths])
+        if len(targets) == 0:
+            return PackedImages(targets, np.zeros(0, dtype=np.uint8), offsets, shapes)
+        lo = offsets.min()
+        hi = (offsets + widths * heights).max()
+        close = self._open_for_reading()
+        try:
+            if self.use_mmap:
+                buf = self._map()[lo:hi]
+                if self.copy:
+                    buf = buf.copy()
+            else:
+                self._inroi.seek(lo)
+                buf = np.frombuffer(self._inroi.read(hi - lo), dtype=np.uint8)
+        finally:
+            if close:
+                self.close()
+        return PackedImages(targets, buf, offsets - lo, shapes)
     def shape(self, roi_number):
         roi_number = int(roi_number)
         s = self.adc.schema
@@ -104,19 +337,36 @@ class RoiFile(BaseDictlike):
         Read an image from the file. Note that the dict-like
         interface can be used to access images by target number.
 
+        Images are read through the process-wide image cache,
+        if one is configured (see ``ifcb.data.imagecache``).
+
         :param roi_number: the (1-based) target number for this ROI
         :returns numpy.array: an 8-bit 2d image
         """
         roi_number = int(roi_number)
-        s = self.adc.schema
-        keys = [s.START_BYTE, s.ROI_WIDTH, s.ROI_HEIGHT]
+        def load():
+            im = self._read_image(roi_number)
+            if self.use_mmap and get_image_cache() is not None:
+                # cached images should not keep the mapping and its file open
+                im = np.array(im)
+            return im
+        im = cached_image(self.lid, roi_number, RAW, load)
+        if self.copy:
+            im = im.copy()
+        return im
+    def _read_image(self, roi_number):
+        (_, offsets, widths, heights), positions = self._layout_and_positions()
         try:
-            bo, width, height = [self.csv[k][roi_number] for k in keys]
+            i = positions[roi_number]
         except KeyError:
             raise KeyError('adc data does not contain a roi #%d' % roi_number)
+        bo, width, height = offsets[i], widths[i], heights[i]
         if width * height == 0:
             raise KeyError('roi #%d is 0x0' % roi_number)
-        if not self.isopen():
+        if self.use_mmap:
+            # stays mapped until close
+            im = read_image_view(self._map(), bo, height, width)
+        elif not self.isopen():
             self._open()
             try:
                 im = read_image(self._inroi, bo, height, width)
@@ -4,12 +4,16 @@ Note that this does not apply to data from commercial
 IFCB instruments.
 """
 
-from functools import lru_cache
+import os
+import operator
+import tempfile
+from collections import namedtuple
 
 import numpy as np
 from scipy import ndimage as ndi
 
 from .utils import BaseDictlike
+from .imagecache import cached_image, INFILLED
 
 ### Stitching
 
@@ -28,14 +32,21 @@ class Stitcher(BaseDictlike):
         :type the_bin: Bin
         """
         self.bin = the_bin
+        self._last = None # most recently stitched (target, image)
+        # computed on first use and kept with this instance
+        self._coordinates = None
+        self._boxes_cache = None
     @property
-    @lru_cache()
     def coordinates(self):
         """
         Compute stitched image metrics.
 
         :returns: stitched box coordinates of all stitched ROIs.
         """
+        if self._coordinates is None:
+            self._coordinates = self._compute_coordinates()
+        return self._coordinates
+    def _compute_coordinates(self):
         S = self.bin.schema
         cols = [S.TRIGGER, S.ROI_X, S.ROI_Y, S.ROI_WIDTH, S.ROI_HEIGHT]
         # place adc image metrics data side by side with itself
@@ -67,7 +78,6 @@ class Stitcher(BaseDictlike):
         M['sx2'] = np.maximum(M['ax2'], M['bx2'])
         M['sy2'] = np.maximum(M['ay2'], M['by2'])
         return M
-    @lru_cache()
     def excluded_targets(self):
         """
         Returns the target numbers of the targets that should
@@ -77,39 +87,115 @@ class Stitcher(BaseDictlike):
         This is just each included key + 1.
         """
         return [x + 1 for x in self.keys()]
+    @property
+    def _boxes(self):
+        """
+        Stitched box sizes and the placement of each source ROI
+        within its stitched box, as NumPy arrays.
+        """
+        if self._boxes_cache is None:
+            self._boxes_cache = self._compute_boxes()
+        return self._boxes_cache
+    def _compute_boxes(self):
+        M = self.coordinates
+        targets = np.asarray(M.index, dtype=np.int64)
+        def corners(cols):
+            return np.asarray(M[cols], dtype=np.int64).reshape(-1, 4)
+        s = corners(['sy1', 'sx1', 'sy1', 'sx1'])
+        # source boxes as (y1, x1, y2, x2) relative to the stitched box
+        a = corners(['ay1', 'ax1', 'ay2', 'ax2']) - s
+        b = corners(['by1', 'bx1', 'by2', 'bx2']) - s
+        shapes = corners(['sy2', 'sx2', 'sy2', 'sx2'])[:, :2] - s[:, :2]
+        index = { t: i for i, t in enumerate(targets.tolist()) }
+        return StitchBoxes(targets, shapes, a, b, index)
     def has_key(self, target_number):
         """
         :returns bool: is the ROI with the given target
           number stitched?
         """
-        return target_number in self.coordinates.index
+        return target_number in self._boxes.index
     def keys(self):
         """
         Yield the target number of each stitched ROI.
         """
-        yield from self.coordinates.index
+        yield from self._boxes.targets.tolist()
     def __len__(self):
-        return len(self.coordinates.index)
+        return len(self._boxes.targets)
+    def _position(self, target_number):
+        try:
+            return self._boxes.index[target_number]
+        except KeyError:
+            raise KeyError('ROI #%d is not stitched' % target_number)
     def shape(self, target_number):
-        row = self.coordinates.loc[target_number]
-        w = row['sx2'] - row['sx1']
-        h = row['sy2'] - row['sy1']
-        return (h, w)
-    @lru_cache(maxsize=2)
+        h, w = self._boxes.shapes[self._position(target_number)]
+        return (int(h), int(w))
+    def _stitch(self, i, a_image, b_image):
+        # assemble the stitched image at position i from its source images
+        boxes = self._boxes
+        return stitch_images(boxes.shapes[i], [boxes.a[i], boxes.b[i]], [a_image, b_image])
     def __getitem__(self, target_number):
-        h, w = self.shape(target_number)
-        row = self.coordinates.loc[target_number]
-        # create composite image
-        msk = np.ones((h,w),dtype=bool)
-        im = np.zeros((h,w),dtype=np.uint8)
-        for ab,ij in zip('ab',[target_number, target_number+1]):
-            rx1 = row[ab+'x1'] - row['sx1']
-            ry1 = row[ab+'y1'] - row['sy1']
-            rx2 = rx1 + row[ab+'x2'] - row[ab+'x1']
-            ry2 = ry1 + row[ab+'y2'] - row[ab+'y1']
-            msk[ry1:ry2,rx1:rx2] = False
-            im[ry1:ry2,rx1:rx2] = self.bin.images[ij]
-        return np.ma.array(im, mask=msk)
+        i = self._position(target_number)
+        if self._last is not None and self._last[0] == target_number:
+            return self._last[1]
+        images = self.bin.images
+        stitched = self._stitch(i, images[target_number], images[target_number + 1])
+        self._last = (target_number, stitched)
+        return stitched
+    def iter_stitched(self, batch_size=256):
+        """
+        Yield ``(target_number, stitched_image)`` for every stitched
+        ROI, in target order. Source images are read ``batch_size``
+        pairs at a time; bins whose images support ``read_many``
+        read each batch in a single sorted pass over the file.
+
+        :param batch_size: the number of pairs to read at once
+        """
+        targets = self._boxes.targets
+        for start in range(0, len(targets), batch_size):
+            batch = targets[start:start + batch_size]
+            # interleave each target with the second ROI of its pair
+            pairs = np.column_stack([batch, batch + 1]).ravel()
+            images = read_many(self.bin.images, pairs)
+            for j, t in enumerate(batch.tolist()):
+                yield t, self._stitch(start + j, images[2*j], images[2*j+1])
+
+StitchBoxes = namedtuple('StitchBoxes', ['targets', 'shapes', 'a', 'b', 'index'])
+StitchBoxes.__doc__ = """
+Stitched box geometry. ``shapes`` is an n x 2 array of (height, width);
+``a`` and ``b`` are n x 4 arrays of (y1, x1, y2, x2) giving the
+placement of the first and second ROI of each pair; ``index`` maps
+target numbers to positions in the arrays.
+"""
+
+def read_many(images, targets):
+    """
+    Read the images with the given target numbers, using the
+    images' ``read_many`` method if it has one.
+
+    :param images: a bin's ``images``
+    :param targets: the target numbers to read
+    :returns list: the images, in the order requested
+    """
+    if hasattr(images, 'read_many'):
+        return images.read_many(targets)
+    return [images[t] for t in np.asarray(targets).tolist()]
+
+def stitch_images(shape, boxes, images):
+    """
+    Place source images in a stitched box.
+
+    :param shape: the (height, width) of the stitched box
+    :param boxes: the (y1, x1, y2, x2) of each image in the stitched box
+    :param images: the source images
+    :returns: a masked array, masked where image data is missing
+    """
+    h, w = shape
+    msk = np.ones((h,w),dtype=bool)
+    im = np.zeros((h,w),dtype=np.uint8)
+    for (y1, x1, y2, x2), image in zip(boxes, images):
+        msk[y1:y2,x1:x2] = False
+        im[y1:y2,x1:x2] = image
+    return np.ma.array(im, mask=msk)
 
 ### Infilling
 
@@ -138,19 +224,75 @@ def chop_boundary_edges(boundary):
     boundary[-1,:] = boundary[-2,:]
     return boundary
 
+def boundary_mask(mask):
+    """
+    Compute the chopped boundary of the dilated mask, as
+    ``chop_boundary_edges(find_boundary(dilate(mask)))`` does,
+    but with shifted boolean slices rather than correlation.
+
+    :param mask: a 2d boolean array
+    :returns: a 2d boolean array
+    """
+    mask = np.asarray(mask, dtype=bool)
+    # dilate with four-connectivity
+    D = mask.copy()
+    D[1:] |= mask[:-1]
+    D[:-1] |= mask[1:]
+    D[:,1:] |= mask[:,:-1]
+    D[:,:-1] |= mask[:,1:]
+    # interior pixels have all four neighbors set; outside the image is unset
+    interior = D.copy()
+    interior[1:] &= D[:-1]
+    interior[:-1] &= D[1:]
+    interior[:,1:] &= D[:,:-1]
+    interior[:,:-1] &= D[:,1:]
+    interior[[0,-1],:] = False
+    interior[:,[0,-1]] = False
+    return chop_boundary_edges(D & ~interior)
+
+def infill_value(image, mask):
+    """
+    Compute the value to fill missing data with: the mean of
+    the image data on the boundary of the missing region.
+
+    :param image: a raw stitched image (2d uint8 array)
+    :param mask: where image data is missing (2d boolean array)
+    :returns int: the infill value
+    """
+    boundary = boundary_mask(mask)
+    boundary &= ~mask
+    if not boundary.any():
+        return 0
+    return int(round(np.mean(image[boundary])))
+
+def infill(raw_stitch):
+    """
+    Fill missing data in a raw stitched image.
+
+    :param raw_stitch: a masked stitched image, masked where
+      image data is missing
+    :returns: the infilled image, as a 2d uint8 array
+    """
+    image, mask = np.ma.getdata(raw_stitch), np.ma.getmaskarray(raw_stitch)
+    return np.where(mask, np.uint8(infill_value(image, mask)), image)
+
+def infill_many(raw_stitches):
+    """
+    Fill missing data in a batch of raw stitched images.
+
+    :param raw_stitches: masked stitched images
+    :returns list: the infilled images
+    """
+    return [infill(raw_stitch) for raw_stitch in raw_stitches]
+
 def infill_image(raw_stitch):
     """given a raw stitch image (stitched image where NaNs indicate
     missing data), compute the infill region (values where the NaNs
     are in the raw_stitch, NaNs elsewhere)"""
-    boundary = find_boundary(dilate(raw_stitch.mask))
-    boundary = chop_boundary_edges(boundary)
-    if np.sum(boundary) > 0:
-        infill_value = int(round(np.mean(raw_stitch[boundary])))
-        fill_image = np.full(raw_stitch.shape, dtype=np.uint8, fill_value=infill_value)
-    else:
-        fill_image = np.zeros(raw_stitch.shape, dtype=np.uint8)
-    infill = np.ma.array(fill_image, mask=np.logical_not(raw_stitch.mask))
-    return infill
+    mask = np.ma.getmaskarray(raw_stitch)
+    value = infill_value(np.ma.getdata(raw_stitch), mask)
+    fill_image = np.full(raw_stitch.shape, dtype=np.uint8, fill_value=value)
+    return np.ma.array(fill_image, mask=~mask)
     
 class Infiller(BaseDictlike):
     """
@@ -197,6 +339,88 @@ class Infiller(BaseDictlike):
         raw_stitch = self.stitcher[target_number]
         return infill_image(raw_stitch)
 
+### Caching
+
+STITCH_CACHE_SUFFIX = '.stitched.h5'
+
+_stitch_cache_dir = None
+
+def set_stitch_cache(directory):
+    """
+    Configure a directory in which ``InfilledImages`` caches the
+    stitched and infilled images of each bin, so that they are only
+    computed once. The cache is disabled by default.
+
+    :param directory: the cache directory, or None to disable caching
+    """
+    global _stitch_cache_dir
+    _stitch_cache_dir = directory
+
+def stitch_cache_path(the_bin, directory):
+    """
+    :returns: the path of the cached stitched images for a bin
+    """
+    return os.path.join(directory, str(the_bin.lid) + STITCH_CACHE_SUFFIX)
+
+def _source_stamp(the_bin):
+    # modification time and size of each of a fileset's files, or None
+    # for bins that are not read from a fileset
+    fileset = getattr(the_bin, 'fileset', None)
+    if fileset is None:
+        return None
+    stamp = []
+    for path in [fileset.adc_path, fileset.roi_path]:
+        st = os.stat(path)
+        stamp += [st.st_mtime_ns, st.st_size]
+    return np.array(stamp, dtype=np.int64)
+
+def read_stitch_cache(path, stamp):
+    """
+    Read cached stitched images, if they are present and were
+    computed from source files with the given stamp.
+
+    :param path: the path of the cache file
+    :param stamp: the source files' modification times and sizes
+    :returns: a ``PackedImages`` or None
+    """
+    import h5py as h5
+    from .hdf import HdfRoi
+    try:
+        with h5.File(path, 'r') as root:
+            if not np.array_equal(root.attrs['source'], stamp):
+                return None
+            return HdfRoi(root).pack()
+    except (OSError, KeyError):
+        return None # missing or corrupt
+
+def write_stitch_cache(path, stamp, images):
+    """
+    Write stitched images to a cache file. The file is written
+    under a temporary name and then renamed, so readers never
+    see a partial file.
+
+    :param path: the path of the cache file
+    :param stamp: the source files' modification times and sizes
+    :param images: a dict of infilled images keyed by target number
+    """
+    from .h5utils import hdfopen
+    from .hdf import roi2hdf, ROI_LAYOUT_PACKED
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=STITCH_CACHE_SUFFIX, dir=directory)
+    os.close(fd)
+    try:
+        with hdfopen(tmp_path, replace=True) as root:
+            roi2hdf(images, root, layout=ROI_LAYOUT_PACKED)
+            root.attrs['source'] = stamp
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
 class InfilledImages(BaseDictlike):
     """
     Wraps a bin's "images" property and provides access to infilled
@@ -204,41 +428,122 @@ class InfilledImages(BaseDictlike):
 
     Dict-like interface excludes from its keys target numbers that
     refer to the second ROI in a stitched pair.
+
+    If a cache directory is given (or configured with
+    ``set_stitch_cache``), the infilled images of a fileset bin are
+    computed all at once on first access and stored there, and later
+    instances read them from the cache. Cached images are recomputed
+    if the ``.adc`` or ``.roi`` file's modification time or size
+    changes.
     """
-    def __init__(self, the_bin):
+    def __init__(self, the_bin, cache=None):
+        """
+        :param the_bin: the bin to delegate to
+        :param cache: (optional) the cache directory. If not given,
+          the directory configured with ``set_stitch_cache`` is used;
+          if False, no cache is used
+        """
         self.bin = the_bin
+        if cache is None:
+            cache = _stitch_cache_dir
+        self.cache = cache or None
         self.stitcher = Stitcher(the_bin)
         self.infiller = Infiller(the_bin)
+        # computed on first use and kept with this instance
+        self._index_cache = None
+        self._shapes_cache = None
+        self._stitch_cache = False # not yet read
+    @property
+    def _index(self):
+        """
+        The output target numbers, whether each is stitched, and
+        a lookup table from target number to position (or -1).
+        """
+        if self._index_cache is None:
+            self._index_cache = self._compute_index()
+        return self._index_cache
+    def _compute_index(self):
+        targets = np.fromiter(self.bin.images.keys(), dtype=np.int64)
+        stitched = np.fromiter(self.stitcher.keys(), dtype=np.int64)
+        # exclude the second ROI of each stitched pair
+        targets = targets[~np.isin(targets, stitched + 1)]
+        is_stitched = np.isin(targets, stitched)
+        size = int(targets.max()) + 1 if len(targets) else 0
+        positions = np.full(size, -1, dtype=np.int64)
+        positions[targets] = np.arange(len(targets))
+        return targets, is_stitched, positions
+    def _position(self, target_number):
+        # position of the target number in the output, or -1
+        positions = self._index[2]
+        try:
+            target_number = operator.index(target_number)
+        except TypeError: # not an integer
+            return -1
+        if 0 <= target_number < len(positions):
+            return int(positions[target_number])
+        return -1
     def keys(self):
         """
         Yield the target number of each ROI that is not the second
         ROI in a stitched pair.
         """
-        for k in self.bin.images:
-            if k not in self.stitcher.excluded_targets():
-                yield k
+        yield from self._index[0].tolist()
     def has_key(self, target_number):
         """
         Exclude each target number from the bin's images that is
         second ROI from a stitched pair.
         """
-        in_bin = target_number in self.bin
-        excluded = target_number in self.stitcher.excluded_targets()
-        return in_bin and not excluded
+        return self._position(target_number) >= 0
+    def __len__(self):
+        return len(self._index[0])
     def __getitem__(self, target_number):
-        if target_number in self.stitcher:
-            # stitch the images
-            raw_stitch = self.stitcher[target_number]
-            # construct infill
-            infill = self.infiller[target_number]
-            # sum the stitched and infill images
-            infilled = raw_stitch.filled(0) + infill.filled(0)
-            return infilled
+        i = self._position(target_number)
+        if i >= 0 and self._index[1][i]:
+            return cached_image(self.bin.lid, target_number, INFILLED, lambda: self._infilled(target_number))
         else:
             # this is not a stitched image
             return self.bin.images[target_number]
-    @lru_cache()
+    def _infilled(self, target_number):
+        cached = self._cached
+        if cached is not None:
+            return cached[target_number]
+        # stitch and infill the images
+        return infill(self.stitcher[target_number])
+    @property
+    def _cached(self):
+        """
+        The cached infilled images, computed and stored if needed,
+        or None if this bin is not cached.
+        """
+        if self._stitch_cache is False:
+            self._stitch_cache = self._read_cache()
+        return self._stitch_cache
+    def _read_cache(self):
+        if self.cache is None:
+            return None
+        stamp = _source_stamp(self.bin)
+        if stamp is None:
+            return None
+        path = stitch_cache_path(self.bin, self.cache)
+        cached = read_stitch_cache(path, stamp)
+        if cached is None:
+            stitched = self.stitcher.iter_stitched()
+            images = { t: infill(raw_stitch) for t, raw_stitch in stitched }
+            try:
+                write_stitch_cache(path, stamp, images)
+            except OSError:
+                # e.g., a read-only or full cache directory; the cache
+                # is optional, so use the images just computed
+                return images
+            cached = read_stitch_cache(path, stamp)
+            if cached is None:
+                return images
+        return cached
     def _shapes(self):
+        if self._shapes_cache is None:
+            self._shapes_cache = self._compute_shapes()
+        return self._shapes_cache
+    def _compute_shapes(self):
         schema = self.bin.schema
         h_attr = '_{}'.format(schema.ROI_HEIGHT + 1)
         w_attr = '_{}'.format(schema.ROI_WIDTH + 1)
@@ -1,61 +1,152 @@
 from zipfile import ZipFile, ZIP_STORED
 import json
+import struct
 from io import StringIO, BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 from functools import lru_cache
+import numpy as np
 import pandas as pd
 
 from .identifiers import Pid
-from .adc import SCHEMA_VERSION_1
+from .adc import SCHEMA_VERSION_1, cast_to_schema
 from .stitching import InfilledImages
 
-from io import BytesIO
-
 from .utils import BaseDictlike
 from .bins import BaseBin
 
-from .imageio import format_image, read_image
+from .imageio import encode_images, read_image
+from .imagecache import cached_image, RAW, INFILLED
 
 METADATA_ARCNAME = 'metadata.json'
 HEADERS_ARCNAME_SUFFIX = '_headers.json'
 ADC_ARCNAME_SUFFIX = '.csv'
 
-def bin2zip_stream(b):
+ZIP_CHUNK_SIZE = 65536 # minimum size of chunks yielded by iter_bin2zip
+
+def _write_members(b, zip, workers=1, processes=False, **kw):
+    # write the bin to an open ZipFile, yielding after each member
+    # bin metadata as JSON
+    metadata = {
+        'lid': b.lid,
+        'schema': b.pid.schema_version,
+        'timestamp': b.timestamp.isoformat()
+    }
+    zip.writestr(METADATA_ARCNAME, json.dumps(metadata))
+    # headers as JSON
+    headers_json = json.dumps(b.headers)
+    zip.writestr(b.lid + HEADERS_ARCNAME_SUFFIX, headers_json)
+    # ADC as CSV
+    buf = StringIO()
+    # FIXME what float format to use?
+    b.adc.to_csv(buf, header=False, index=False)
+    zip.writestr(b.lid + ADC_ARCNAME_SUFFIX, buf.getvalue())
+    yield
+    # images as PNGs
+    with b:
+        if b.schema == SCHEMA_VERSION_1:
+            images = InfilledImages(b)
+        else:
+            images = b.images
+        items = ((target, images[target]) for target in images)
+        for target, png in encode_images(items, workers=workers, processes=processes, mimetype='image/png', **kw):
+            image_lid = b.pid.with_target(target, namespace=False)
+            arcname = image_lid + '.png'
+            zip.writestr(arcname, png)
+            yield
+
+class _ChunkSink(object):
+    """
+    Write-only stream that collects the data written to it
+    until it is drained.
+    """
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+    def flush(self):
+        pass
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+def iter_bin2zip(b, chunk_size=ZIP_CHUNK_SIZE, workers=1, processes=False, **kw):
+    """
+    Generate a ZIP archive of a bin, as it is being written.
+    Images are encoded as they are needed, so the start of the
+    archive is available before all images have been encoded.
+    Other keywords are passed to the PNG encoder (see ``png_options``).
+
+    :param b: the bin
+    :param chunk_size: the minimum size of the chunks to yield
+      (except for the last one)
+    :param workers: the number of workers with which to encode
+      images (see ``encode_images``)
+    :param processes: whether to encode images in processes
+      rather than threads
+    :returns: a generator of ``bytes``
+    """
+    sink = _ChunkSink()
+    with ZipFile(sink, 'w', compression=ZIP_STORED) as zip:
+        for _ in _write_members(b, zip, workers=workers, processes=processes, **kw):
+            if sink.size >= chunk_size:
+                yield sink.drain()
+    data = sink.drain()
+    if data:
+        yield data
+
+def bin2zip_stream(b, **kw):
+    """
+    Write a ZIP archive of a bin to an in-memory buffer.
+    Keywords are as for ``bin2zip``.
+
+    :param b: the bin
+    :returns BytesIO: the buffer, positioned at the start
+    """
     zip_stream = BytesIO()
-    with ZipFile(zip_stream, 'w', compression=ZIP_STORED) as zip:
-        # bin metadata as JSON
-        metadata = {
-            'lid': b.lid,
-            'schema': b.pid.schema_version,
-            'timestamp': b.timestamp.isoformat()
-        }
-        zip.writestr(METADATA_ARCNAME, json.dumps(metadata))
-        # headers as JSON
-        headers_json = json.dumps(b.headers)
-        zip.writestr(b.lid + HEADERS_ARCNAME_SUFFIX, headers_json)
-        # ADC as CSV
-        buf = StringIO()
-        # FIXME what float format to use?
-        b.adc.to_csv(buf, header=False, index=False)
-        zip.writestr(b.lid + ADC_ARCNAME_SUFFIX, buf.getvalue())
-        # images as PNGs
-        with b:
-            if b.schema == SCHEMA_VERSION_1:
-                images = InfilledImages(b)
-            else:
-                images = b.images
-            for target in images:
-                image_lid = b.pid.with_target(target, namespace=False)
-                arcname = image_lid + '.png'
-                buf = format_image(images[target], mimetype='image/png')
-                zip.writestr(arcname, buf.getvalue())
+    bin2zip(b, zip_stream, **kw)
     zip_stream.seek(0)
     return zip_stream
 
-def bin2zip(b, zip_path):
-    zip_bytes = bin2zip_stream(b).getvalue()
-    with open(zip_path,'wb') as zout:
-        zout.write(zip_bytes)
+def bin2zip(b, zip_file, workers=1, processes=False, **kw):
+    """
+    Write a ZIP archive of a bin containing its metadata, headers,
+    and ADC data, and an image per target as a PNG. Other keywords
+    are passed to the PNG encoder (see ``png_options``).
+
+    :param b: the bin
+    :param zip_file: the path of the file to write, or a writable
+      binary stream (which need not be seekable)
+    :param workers: the number of workers with which to encode
+      images (see ``encode_images``)
+    :param processes: whether to encode images in processes
+      rather than threads
+    """
+    if not hasattr(zip_file, 'write'):
+        with open(zip_file, 'wb') as zout:
+            bin2zip(b, zout, workers=workers, processes=processes, **kw)
+        return
+    with ZipFile(zip_file, 'w', compression=ZIP_STORED) as zip:
+        for _ in _write_members(b, zip, workers=workers, processes=processes, **kw):
+            pass
+
+# local file header layout, from the ZIP specification
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+
+def _image_target(arcname):
+    # target number from an image member name, e.g. D20130526T095207_IFCB013_00007.png
+    if not arcname.endswith('.png'):
+        return None
+    try:
+        return int(arcname[:-4].rsplit('_', 1)[1])
+    except (IndexError, ValueError):
+        return None
 
 class ZipImages(BaseDictlike):
     def __init__(self, open_zip_file):
@@ -67,28 +158,70 @@ class ZipImages(BaseDictlike):
     def keys(self):
         return self._zip.namelist()
     def has_key(self, arcname):
-        return arcname in self._zip.namelist()
+        try:
+            self._zip.getinfo(arcname)
+            return True
+        except KeyError:
+            return False
 
 class _ZipBinImages(BaseDictlike):
     def __init__(self, zip_bin):
         self.b = zip_bin
-        self.zi = ZipImages(zip_bin._zip)
-        s = self.b.schema
-        csv = self.b.adc
-        csv = csv[csv[s.ROI_WIDTH] != 0]
-        self.index = csv.index
-    def arcname(self, target):
-        return self.b.pid.with_target(target) + '.png'
+        self._infos = zip_bin._image_infos
+        self._targets = sorted(self._infos)
+    def _info(self, target):
+        try:
+            return self._infos[target]
+        except KeyError:
+            raise KeyError('no image for target %s' % target)
     def __getitem__(self, target):
-        return self.zi[self.arcname(target)]
+        info = self._info(target)
+        # revision 1 images were written infilled
+        variant = INFILLED if self.b.schema == SCHEMA_VERSION_1 else RAW
+        return cached_image(self.b.lid, target, variant, lambda: read_image(BytesIO(self.b._read_member(info))))
     def keys(self):
-        return self.index
+        return self._targets
     def has_key(self, k):
-        return k in self.index
-    
+        return k in self._infos
+    def __len__(self):
+        return len(self._targets)
+    def read_many(self, targets, workers=1):
+        """
+        Read and decode many images. Members are read in the order
+        in which they are stored, and decoded concurrently if
+        ``workers`` is more than 1.
+
+        :param targets: the target numbers of the images to read
+        :param workers: the number of threads with which to decode
+        :returns list: 2d images, in the order requested
+        """
+        infos = [self._info(t) for t in targets]
+        order = sorted(range(len(infos)), key=lambda i: infos[i].header_offset)
+        data = [None] * len(infos)
+        for i in order:
+            data[i] = self.b._read_member(infos[i])
+        decode = lambda d: read_image(BytesIO(d))
+        if workers <= 1:
+            return [decode(d) for d in data]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(decode, data))
+
 class ZipBin(BaseBin):
-    def __init__(self, zip_path):
+    """
+    Bin interface to a ZIP file written by ``bin2zip``.
+
+    When the ZIP file is opened, its central directory is indexed
+    by target number. Images stored without compression (as
+    ``bin2zip`` writes them) are read directly at their offset in
+    the file, optionally through a read-only memory map.
+    """
+    def __init__(self, zip_path, use_mmap=False):
+        """
+        :param zip_path: the path of the ZIP file
+        :param use_mmap: whether to memory-map the ZIP file
+        """
         self.zip_path = zip_path
+        self.use_mmap = use_mmap
         self._zip = None
         self._open()
         self._parse_metadata()
@@ -99,16 +232,52 @@ class ZipBin(BaseBin):
         if self.isopen():
             raise ValueError('zip file already open')
         self._zip = ZipFile(self.zip_path, 'r')
+        self._fp = open(self.zip_path, 'rb')
+        self._map = None
+        if self.use_mmap:
+            self._map = np.memmap(self._fp, dtype=np.uint8, mode='r').view(np.ndarray)
+        self._data_offsets = {}
+        self._image_infos = {}
+        for info in self._zip.infolist():
+            target = _image_target(info.filename)
+            if target is not None:
+                self._image_infos[target] = info
     def close(self):
         if not self.isopen():
             raise ValueError('zip file not open')
         self._zip.close()
+        self._fp.close()
         self._zip = None
+        self._map = None
     def __enter__(self):
         return self
     def __exit__(self, *args):
         if self.isopen():
             self.close()
+    def _read_at(self, offset, size):
+        if self._map is not None:
+            return self._map[offset:offset + size]
+        self._fp.seek(offset)
+        return self._fp.read(size)
+    def _data_offset(self, info):
+        # the data follows the local header, whose extra
+        # field may differ from the central directory's
+        offset = self._data_offsets.get(info.header_offset)
+        if offset is None:
+            header = bytes(self._read_at(info.header_offset, _LOCAL_HEADER.size))
+            fields = _LOCAL_HEADER.unpack(header)
+            if fields[0] != _LOCAL_HEADER_SIGNATURE:
+                raise ValueError('bad local header for %s' % info.filename)
+            name_length, extra_length = fields[-2:]
+            offset = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+            self._data_offsets[info.header_offset] = offset
+        return offset
+    def _read_member(self, info):
+        if not self.isopen():
+            raise ValueError('zip file not open')
+        if info.compress_type != ZIP_STORED:
+            return self._zip.read(info)
+        return self._read_at(self._data_offset(info), info.compress_size)
     def _parse_metadata(self):
         j = self._zip.read(METADATA_ARCNAME)
         md = json.loads(j.decode('utf8'))
@@ -123,6 +292,10 @@ class ZipBin(BaseBin):
         fin = self._zip.open(arcname)
         adc = pd.read_csv(fin, header=None, index_col=False)
         adc.columns = [c for c in adc.columns]
+        try:
+            adc = cast_to_schema(adc, self.schema)
+        except ValueError: # data does not match schema
+            pass
         adc.index = pd.RangeIndex(1, len(adc) + 1)
         return adc
     @property
@@ -40,17 +40,23 @@ def compute_ml_analyzed_s1_adc(adc, min_proc_time=0.073):
     ml_analyzed = look_time * FLOW_RATE
     return ml_analyzed, look_time, run_time
 
-def compute_ml_analyzed_s2_adc(b):
+def compute_ml_analyzed_s2_adc(b, adc=None):
     """
     This function returns the estimate of sample volume analyzed (in milliliters),
     assuming a standard IFCB configuration with the sample syringe operating at 0.25 mL per minute.
     It applies only to IFCB instruments after 007 and higher (except 008).
+
+    :param b: the bin
+    :param adc: (optional) the bin's ADC data, which may contain only
+      the columns listed by ``ml_analyzed_columns`` (default: ``b.adc``)
     """
 
-    adc = b.adc
+    if adc is None:
+        adc = b.adc
 
     column_names = ['trigger', 'adc_time', 'pmt_a', 'pmt_b', 'pmt_c', 'pmt_d', 'peak_a', 'peak_b', 'peak_c', 'peak_d', 'time_of_flight', 'grabtime_start', 'grabtime_end', 'roi_x', 'roi_y', 'roi_width', 'roi_height', 'start_byte', 'comparator_out', 'start_point', 'signal_length', 'status', 'runtime', 'inhibit_time', 'extra1', 'extra2']
-    adc.columns = column_names[:len(adc.columns)]
+    # rename a copy, so that the bin's ADC data is left as it is
+    adc = adc.rename(columns=dict(enumerate(column_names)))
 
     if not 'inhibit_time' in adc.columns or len(adc) == 1:
         return compute_ml_analyzed_s2_header(b)
@@ -136,10 +142,28 @@ def compute_ml_analyzed_s2(b):
     return ml_analyzed, looktime, runtime
 
 
-def compute_ml_analyzed_adc(b, adc_file):
+def ml_analyzed_columns(schema):
+    """
+    Return the ADC column numbers that are needed to compute
+    ml_analyzed for bins with the given schema.
+
+    :param schema: the ADC schema
+    """
+    if schema is SCHEMA_VERSION_1:
+        s = SCHEMA_VERSION_1
+        return [s.TRIGGER, s.TRIGGER_OPEN_TIME, s.FRAME_GRAB_TIME]
+    elif schema is SCHEMA_VERSION_2:
+        s = SCHEMA_VERSION_2
+        return [s.TRIGGER, s.ADC_TIME, s.RUN_TIME, s.INHIBIT_TIME]
+    else:
+        return []
+
+
+def compute_ml_analyzed_adc(b, adc_file, adc=None):
     pid = adc_file.pid
     schema = adc_file.schema
-    adc = adc_file.to_dataframe()
+    if adc is None:
+        adc = adc_file.to_dataframe()
 
     if pid.instrument == 5 and pid.timestamp >= pd.to_datetime('2015-06-01', utc=True):
         # IFCB5 bins after June 2015 require a non-default min_proc_time
@@ -147,11 +171,19 @@ def compute_ml_analyzed_adc(b, adc_file):
     elif schema is SCHEMA_VERSION_1:
         return compute_ml_analyzed_s1_adc(adc)
     elif schema is SCHEMA_VERSION_2:
-        return compute_ml_analyzed_s2_adc(b)
+        return compute_ml_analyzed_s2_adc(b, adc)
     else: # unknown bin type, indicating some upstream error
         return np.nan, np.nan, np.nan
 
 
-def compute_ml_analyzed(b):
+def compute_ml_analyzed(b, adc=None):
+    """
+    Compute ml_analyzed, look time, and run time for a bin.
+
+    :param b: the bin
+    :param adc: (optional) the bin's ADC data, which may contain only
+      the columns listed by ``ml_analyzed_columns`` (default: ``b.adc``)
+    :returns tuple: ml_analyzed, look time, and run time
+    """
     adc_file = b.adc_file
-    return compute_ml_analyzed_adc(b, adc_file)
\ No newline at end of file
+    return compute_ml_analyzed_adc(b, adc_file, adc)
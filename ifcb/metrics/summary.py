@@ -0,0 +1,118 @@
+"""
+Summary metrics for many bins.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from ifcb.data.adc import parse_adc_file
+from ifcb.data.hdr import TEMPERATURE, HUMIDITY
+
+from .ml_analyzed import compute_ml_analyzed, ml_analyzed_columns
+
+SUMMARY_COLUMNS = ['timestamp', 'instrument', 'n_triggers', 'ml_analyzed', 'look_time',
+    'run_time', 'inhibit_time', 'trigger_rate', 'temperature', 'humidity', 'adc_size']
+
+def bin_summary(b):
+    """
+    Compute summary metrics for a ``FilesetBin``. Only the ADC
+    columns that are needed are parsed. Metrics are the same as
+    the bin's properties of the same name, except that missing
+    header values are NaN.
+
+    :param b: the ``FilesetBin``
+    :returns dict: the metrics, keyed by the names in ``SUMMARY_COLUMNS``
+    """
+    schema = b.schema
+    adc_size = os.path.getsize(b.fileset.adc_path)
+    adc = parse_adc_file(b.fileset.adc_path, columns=ml_analyzed_columns(schema))
+    ml_analyzed, look_time, run_time = compute_ml_analyzed(b, adc=adc)
+    if len(adc) == 0:
+        n_triggers = 0
+    else:
+        n_triggers = int(adc[schema.TRIGGER].iloc[-1])
+    def header(key):
+        try:
+            return b.header(key)
+        except KeyError:
+            return np.nan
+    return {
+        'timestamp': b.timestamp,
+        'instrument': b.pid.instrument,
+        'n_triggers': n_triggers,
+        'ml_analyzed': ml_analyzed,
+        'look_time': look_time,
+        'run_time': run_time,
+        'inhibit_time': run_time - look_time,
+        'trigger_rate': 1.0 * n_triggers / run_time,
+        'temperature': header(TEMPERATURE),
+        'humidity': header(HUMIDITY),
+        'adc_size': adc_size,
+    }
+
+def _summary_frame(lids, rows):
+    df = pd.DataFrame(rows, index=pd.Index(lids, name='lid'), columns=SUMMARY_COLUMNS)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    return df
+
+def read_summary(path):
+    """
+    Read a summary table written by ``summarize``.
+
+    :param path: the path of the CSV file
+    :returns pandas.DataFrame: the summary table, indexed by LID
+    """
+    df = pd.read_csv(path, index_col='lid')
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    return df
+
+def summarize(filesets, workers=None, chunksize=8, cache=None):
+    """
+    Compute a table of summary metrics (see ``bin_summary``) for
+    many filesets, in parallel (see ``BinMap``).
+
+    If a cache file is given, bins that are already in it are
+    not recomputed unless their ``.adc`` file has changed size,
+    and the cache is rewritten with the new table. Bins for which
+    the metrics cannot be computed are left out of the table
+    (and are retried the next time).
+
+    :param filesets: an iterable of ``Fileset`` objects
+    :param workers: the number of processes (default: the number
+      of CPUs; 0 to compute in this process)
+    :param chunksize: the number of filesets to send to a worker at once
+    :param cache: (optional) the path of a CSV file in which to
+      cache the table
+    :returns pandas.DataFrame: the table, indexed by LID and
+      sorted by timestamp
+    """
+    from ifcb.data.parallel import map_bins
+    filesets = list(filesets)
+    if cache is not None and os.path.exists(cache):
+        previous = read_summary(cache)
+    else:
+        previous = _summary_frame([], [])
+    keep, todo = [], []
+    for fs in filesets:
+        lid = fs.lid
+        if lid in previous.index and previous.at[lid, 'adc_size'] == os.path.getsize(fs.adc_path):
+            keep.append(lid)
+        else:
+            todo.append(fs)
+    lids, rows = [], []
+    for result in map_bins(bin_summary, todo, workers=workers, chunksize=chunksize, ordered=False):
+        if result.error is None:
+            lids.append(result.lid)
+            rows.append(result.value)
+    parts = [df for df in [previous.loc[keep], _summary_frame(lids, rows)] if len(df)]
+    if parts:
+        summary = pd.concat(parts)
+    else:
+        summary = _summary_frame([], [])
+    summary = summary.reset_index().sort_values(['timestamp', 'lid']).set_index('lid')
+    if cache is not None:
+        tmp_path = cache + '.tmp'
+        summary.to_csv(tmp_path)
+        os.replace(tmp_path, cache)
+    return summary
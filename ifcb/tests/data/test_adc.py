@@ -1,11 +1,15 @@
 import unittest
 import shutil
 import os
+import gc
+import weakref
+
+import numpy as np
 
 from ifcb.tests.utils import test_dir
 from .fileset_info import list_test_filesets, TEST_FILES
 
-from ifcb.data.adc import AdcFile
+from ifcb.data.adc import AdcFile, AdcFragment, parse_adc_file, adc_line_offsets, read_adc_lines, ADC_INDEX_SUFFIX
 
 def list_adcs():
     for fs in list_test_filesets():
@@ -41,3 +45,70 @@ class TestAdcFile(unittest.TestCase):
             s = adc.schema
             assert target[s.ROI_WIDTH] == w
             assert target[s.ROI_HEIGHT] == h
+    def test_typed_parse(self):
+        for adc in list_adcs():
+            df = adc.to_dataframe()
+            typed = parse_adc_file(adc.path, typed=True)
+            s = adc.schema
+            assert list(typed.columns) == list(df.columns)
+            assert np.all(typed.index == df.index)
+            assert typed[s.ROI_WIDTH].dtype == np.int32
+            assert typed[s.START_BYTE].dtype == np.int64
+            assert np.allclose(typed.values, df.values)
+
+    def test_parse_url(self):
+        for adc in list_adcs():
+            url = 'file://' + os.path.abspath(adc.path)
+            for typed in [False, True]:
+                for columns in [None, [0, 1, 2, 100]]:
+                    expected = parse_adc_file(adc.path, typed=typed, columns=columns)
+                    df = parse_adc_file(url, typed=typed, columns=columns)
+                    assert list(df.columns) == list(expected.columns)
+                    assert list(df.dtypes) == list(expected.dtypes)
+                    assert np.all(df.index == expected.index)
+                    assert np.allclose(df.values, expected.values, equal_nan=True)
+
+class TestAdcFragment(unittest.TestCase):
+    def test_line_offsets(self):
+        for adc in list_adcs():
+            offsets = adc_line_offsets(adc.path)
+            assert offsets[-1] == adc.getsize()
+            assert len(offsets) - 1 == len(adc)
+    def test_fragment(self):
+        for adc in list_adcs():
+            df = adc.to_dataframe()
+            n = len(df)
+            for start, end in [(1, 3), (n - 1, n + 1), (2, None), (n // 2, n // 2 + 1)]:
+                frag = AdcFragment(adc.path, start, end)
+                expected = df.loc[start:end - 1 if end is not None else n]
+                assert np.all(frag.csv.index == expected.index)
+                assert list(frag.csv.columns) == list(df.columns)
+                assert np.allclose(frag.csv.values, expected.values, equal_nan=True)
+    def test_fragment_out_of_range(self):
+        for adc in list_adcs():
+            frag = AdcFragment(adc.path, len(adc) + 5, len(adc) + 7)
+            assert len(frag) == 0
+    def test_bad_start(self):
+        for adc in list_adcs():
+            with self.assertRaises(ValueError):
+                read_adc_lines(adc.path, 0, 3)
+    def test_not_retained(self):
+        for adc in list_adcs():
+            frag = AdcFragment(adc.path, 1, 3)
+            assert frag.csv is frag.csv
+            ref = weakref.ref(frag)
+            del frag
+            gc.collect()
+            assert ref() is None
+    def test_sidecar(self):
+        for adc in list_adcs():
+            with test_dir() as d:
+                path = os.path.join(d, os.path.basename(adc.path))
+                shutil.copy(adc.path, path)
+                offsets = adc_line_offsets(path, sidecar=True)
+                assert os.path.exists(path + ADC_INDEX_SUFFIX)
+                # a changed file invalidates the index
+                with open(path, 'ab') as fout:
+                    fout.write(b'\n')
+                new_offsets = adc_line_offsets(path, sidecar=True)
+                assert new_offsets[-1] == offsets[-1] + 1
@@ -0,0 +1,92 @@
+import unittest
+import os
+import shutil
+
+from ifcb.tests.utils import test_dir
+from ifcb.data.files import DataDirectory, time_filter
+
+from .fileset_info import TEST_FILES, data_dir, WHITELIST
+
+class TestFilesetCatalog(unittest.TestCase):
+    def test_matches_walk(self):
+        with test_dir() as d:
+            db = os.path.join(d, 'catalog.db')
+            for kw in [{}, { 'whitelist': WHITELIST }, { 'blacklist': ['skip','invalid','empty'] }]:
+                walked = DataDirectory(data_dir(), **kw)
+                cataloged = DataDirectory(data_dir(), catalog=db, **kw)
+                assert [fs.basepath for fs in cataloged.list_filesets()] == [fs.basepath for fs in walked.list_filesets()]
+                assert len(cataloged) == len(walked)
+    def test_order(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            src = DataDirectory(data_dir(), whitelist=WHITELIST)['D20130526T095207_IFCB013'].fileset
+            # filesets with invalid and duplicate names are listed too
+            for reldir in ['', 'a', os.path.join('a', 'x'), 'b']:
+                os.makedirs(os.path.join(root, reldir), exist_ok=True)
+                for basename in ['D20130526T095207_IFCB013', 'D20130527T000000_IFCB013', 'junk']:
+                    for ext in ['adc', 'hdr', 'roi']:
+                        shutil.copy(src.basepath + '.' + ext, os.path.join(root, reldir, basename + '.' + ext))
+            walked = DataDirectory(root, whitelist=['a', 'x', 'b'])
+            cataloged = DataDirectory(root, whitelist=['a', 'x', 'b'], catalog=os.path.join(d, 'catalog.db'))
+            expected = [fs.basepath for fs in walked.list_filesets()]
+            assert len(expected) == 12
+            assert [fs.basepath for fs in cataloged.list_filesets()] == expected
+            assert len(cataloged) == 12
+            assert [fs.lid for fs in cataloged.query()] == [fs.lid for fs in walked.query()]
+    def test_lookup(self):
+        with test_dir() as d:
+            dd = DataDirectory(data_dir(), whitelist=WHITELIST, catalog=os.path.join(d, 'catalog.db'))
+            for lid in TEST_FILES:
+                assert lid in dd.catalog
+                assert dd.has_key(lid)
+                b = dd[lid]
+                assert b.lid == lid
+                assert os.path.exists(b.fileset.adc_path)
+                assert dd.catalog.getsizes(lid) == b.fileset.getsizes()
+            assert not dd.has_key('D20000101T000000_IFCB000')
+            with self.assertRaises(KeyError):
+                dd['D20000101T000000_IFCB000']
+    def test_filter(self):
+        with test_dir() as d:
+            dd = DataDirectory(data_dir(), whitelist=WHITELIST, filter=time_filter(start='2013-01-01', end='2020-01-01'), catalog=os.path.join(d, 'catalog.db'))
+            assert [fs.lid for fs in dd.list_filesets()] == ['D20130526T095207_IFCB013']
+            assert len(dd) == 1
+            assert not dd.has_key('IFCB5_2012_028_081515')
+    def test_incremental_update(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(data_dir(), root)
+            dd = DataDirectory(root, whitelist=WHITELIST, catalog=os.path.join(d, 'catalog.db'))
+            assert len(dd) == 2
+            assert dd.update_catalog() == 0, 'unchanged directories should not be listed'
+            # add a fileset deep in the tree
+            src = dd['D20130526T095207_IFCB013'].fileset
+            daydir = os.path.dirname(src.basepath)
+            new_base = os.path.join(daydir, 'D20130526T105207_IFCB013')
+            for ext in ['adc', 'hdr', 'roi']:
+                shutil.copy(src.basepath + '.' + ext, new_base + '.' + ext)
+            assert dd.update_catalog() == 1
+            assert len(dd) == 3
+            assert dd.has_key('D20130526T105207_IFCB013')
+            # remove a directory
+            shutil.rmtree(os.path.join(root, 'data'))
+            dd.update_catalog()
+            assert len(dd) == 2
+            assert not dd.has_key('IFCB5_2012_028_081515')
+    def test_persistence(self):
+        with test_dir() as d:
+            db = os.path.join(d, 'catalog.db')
+            dd = DataDirectory(data_dir(), whitelist=WHITELIST, catalog=db)
+            assert len(dd) == 2
+            dd.catalog.close()
+            dd = DataDirectory(data_dir(), whitelist=WHITELIST, catalog=db)
+            assert dd.update_catalog() == 0
+            # different settings invalidate the catalog
+            dd = DataDirectory(data_dir(), catalog=db)
+            assert len(dd) == 1
+    def test_query(self):
+        with test_dir() as d:
+            walked = DataDirectory(data_dir(), whitelist=WHITELIST)
+            cataloged = DataDirectory(data_dir(), whitelist=WHITELIST, catalog=os.path.join(d, 'catalog.db'))
+            for args in [(), ('2013-01-01',), (None, '2013-01-01'), (None, None, 5), (None, None, 99)]:
+                assert [fs.lid for fs in cataloged.query(*args)] == [fs.lid for fs in walked.query(*args)]
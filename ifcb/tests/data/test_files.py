@@ -1,8 +1,13 @@
 import unittest
+from unittest import mock
 import os
 import sys
+import shutil
 
 import numpy as np
+import pandas as pd
+
+from ifcb.tests.utils import test_dir
 
 from ifcb.data import files
 from .fileset_info import TEST_FILES, data_dir, WHITELIST, list_test_filesets, list_test_bins
@@ -29,6 +34,17 @@ class TestListUtils(unittest.TestCase):
         assert len(paths) == 5
         partial_paths = list(files.list_filesets(self.data_dir, whitelist=WHITELIST, validate=False,require_roi_files=False))
         assert len(partial_paths) == 6
+    def test_list_filesets_workers(self):
+        for kw in [{}, { 'whitelist': WHITELIST }, { 'validate': False, 'require_roi_files': False }]:
+            serial = list(files.list_filesets(self.data_dir, **kw))
+            threaded = list(files.list_filesets(self.data_dir, workers=4, **kw))
+            assert serial == threaded
+    def test_directory_validator(self):
+        lid = 'D20130526T095207_IFCB013'
+        for reldir in ['', 'data', os.path.join('data', 'D2013'), os.path.join('D2013', 'D20130526'),
+                       os.path.join('skip', 'D2013'), os.path.join('D2014', 'data')]:
+            valid = files.directory_validator(reldir, whitelist=WHITELIST)
+            assert valid(lid) == files.validate_path(os.path.join(reldir, lid), whitelist=WHITELIST)
 
 class TestDataDirectory(unittest.TestCase):
     def setUp(self):
@@ -169,3 +185,59 @@ class TestFilesetFragmentBin(TestFilesetBin):
         # pass this test, which would fail because superclass
         # test expects the image index to be complete
         pass
+
+class TestQuery(unittest.TestCase):
+    def _copy_fileset(self, fs, root, reldir, lid):
+        d = os.path.join(root, reldir)
+        os.makedirs(d, exist_ok=True)
+        for ext in ['adc', 'hdr', 'roi']:
+            shutil.copy(fs.basepath + '.' + ext, os.path.join(d, lid + '.' + ext))
+    def _make_tree(self, root):
+        src = files.DataDirectory(data_dir(), whitelist=WHITELIST)['D20130526T095207_IFCB013'].fileset
+        lids = ['D20130526T235959_IFCB013', 'D20130527T000000_IFCB013', 'D20130526T010203_IFCB014',
+                'D20140101T000000_IFCB013', 'D20121231T120000_IFCB013']
+        for lid in lids:
+            self._copy_fileset(src, root, os.path.join(lid[1:5], lid[:9]), lid)
+        return lids
+    def test_directory_time_range(self):
+        start, end, instrument = files.directory_time_range('D20130526')
+        assert start == pd.Timestamp('2013-05-26', tz='UTC')
+        assert end == pd.Timestamp('2013-05-27', tz='UTC')
+        assert instrument is None
+        start, end, _ = files.directory_time_range('D201312')
+        assert end == pd.Timestamp('2014-01-01', tz='UTC')
+        start, end, instrument = files.directory_time_range('IFCB5_2012_028')
+        assert start == pd.Timestamp('2012-01-28', tz='UTC')
+        assert instrument == 5
+        assert files.directory_time_range('2012')[0] == pd.Timestamp('2012-01-01', tz='UTC')
+        assert files.directory_time_range('data') is None
+        assert files.directory_time_range('1234') is None
+        assert files.directory_time_range('D1234') is not None
+        assert files.directory_time_range('D201313') is None
+    def test_query_order(self):
+        with test_dir() as root:
+            lids = self._make_tree(root)
+            dd = files.DataDirectory(root)
+            result = [fs.lid for fs in dd.query()]
+            assert result == sorted(lids, key=lambda lid: lid[1:16])
+            result = [fs.lid for fs in dd.query('2013-05-26', '2013-05-27')]
+            assert result == ['D20130526T010203_IFCB014', 'D20130526T235959_IFCB013']
+            result = [fs.lid for fs in dd.query('2013-05-26', '2013-05-27', instrument=13)]
+            assert result == ['D20130526T235959_IFCB013']
+    def test_query_prunes(self):
+        with test_dir() as root:
+            self._make_tree(root)
+            listed = []
+            scan_directory = files.scan_directory
+            def recording_scan(path, **kw):
+                listed.append(os.path.relpath(path, root))
+                return scan_directory(path, **kw)
+            with mock.patch.object(files, 'scan_directory', recording_scan):
+                list(files.DataDirectory(root).query('2013-05-27', '2013-06-01'))
+            assert '2014' not in listed
+            assert os.path.join('2013', 'D20130526') not in listed
+            assert os.path.join('2013', 'D20130527') in listed
+    def test_query_matches_filter(self):
+        dd = files.DataDirectory(data_dir(), whitelist=WHITELIST)
+        filtered = files.DataDirectory(data_dir(), whitelist=WHITELIST, filter=files.time_filter(start='2013-01-01'))
+        assert [fs.lid for fs in dd.query(start='2013-01-01')] == [fs.lid for fs in filtered.list_filesets()]
@@ -61,3 +61,20 @@ class TestH5Utils(unittest.TestCase):
             in_df['new_col'] = np.arange(len(in_df)) # different type column
         with roundtrip():
             in_df.index.name = 'hello'
+    @withfile
+    def test_hdf2pd_selection(self, F):
+        in_df = pd.DataFrame({ 'a': np.arange(10), 'b': np.arange(10) * 2.0, 'c': np.arange(10) * 3 })
+        in_df.index = in_df.index + 1
+        with hdfopen(F, replace=True) as g:
+            pd2hdf(g, in_df)
+        with hdfopen(F) as g:
+            out_df = hdf2pd(g, columns=['c', 'a'])
+            assert_frame_equal(in_df[['c', 'a']], out_df, check_index_type='equiv')
+            out_df = hdf2pd(g, columns=['b'], rows=slice(2, 5))
+            assert_frame_equal(in_df[['b']].iloc[2:5], out_df, check_index_type='equiv')
+            out_df = hdf2pd(g, rows=slice(7, None))
+            assert_frame_equal(in_df.iloc[7:], out_df, check_index_type='equiv')
+            with self.assertRaises(KeyError):
+                hdf2pd(g, columns=['d'])
+            with self.assertRaises(TypeError):
+                hdf2pd(g, rows=[1, 2])
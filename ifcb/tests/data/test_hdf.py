@@ -11,10 +11,12 @@ from ifcb.data.h5utils import hdf2pd, hdfopen
 from ifcb.data.adc import AdcFile
 from ifcb.data.roi import RoiFile
 from ifcb.data.hdr import parse_hdr_file
-from ifcb.data.hdf import roi2hdf, hdr2hdf, adc2hdf, fileset2hdf, hdf2fileset, HdfBin, filesetbin2hdf, bin2hdf
-from ifcb.data.files import FilesetBin
+from ifcb.data.hdf import roi2hdf, hdr2hdf, adc2hdf, fileset2hdf, hdf2fileset, HdfBin, HdfRoi, filesetbin2hdf, bin2hdf
+from ifcb.data.hdf import ROI_LAYOUT_DATASETS, ROI_LAYOUT_PACKED
+from ifcb.data.hdf import bins2hdf, hdf2file, hdf2filesets
+from ifcb.data.files import FilesetBin, DataDirectory
 
-from .fileset_info import list_test_filesets, list_test_bins
+from .fileset_info import list_test_filesets, list_test_bins, data_dir, TEST_FILES, WHITELIST
 from .bins import assert_bin_equals
 
 def test_adc_roundtrip(adc, path, group=None):
@@ -31,11 +33,27 @@ def test_hdr_roundtrip(hdr, path, group=None):
 def test_roi_roundtrip(roi, path, group=None):
     with hdfopen(path, group) as h:
         index = h.attrs['index']
-        assert np.all(index == roi.keys())
+        assert np.all(index == list(roi.keys()))
+        if h.attrs.get('layout', ROI_LAYOUT_DATASETS) == ROI_LAYOUT_DATASETS:
+            for roi_number in index:
+                assert np.all(roi[roi_number] == h[str(roi_number)])
+            for roi_number in index:
+                assert np.all(roi[roi_number] == h[h['images'][roi_number]])
+        else:
+            assert h['pixels'].chunks is not None
+            offsets, heights, widths = h['offsets'][()], h['heights'][()], h['widths'][()]
+            pixels = h['pixels'][()]
+            for i, roi_number in enumerate(index):
+                o, height, width = offsets[i], heights[i], widths[i]
+                assert np.all(roi[roi_number] == pixels[o:o+height*width].reshape((height, width)))
+        hroi = HdfRoi(h)
+        assert list(hroi.keys()) == list(index)
         for roi_number in index:
-            assert np.all(roi[roi_number] == h[str(roi_number)])
+            assert roi_number in hroi
+            assert np.all(roi[roi_number] == hroi[roi_number])
+        packed = hroi.pack()
         for roi_number in index:
-            assert np.all(roi[roi_number] == h[h['images'][roi_number]])
+            assert np.all(roi[roi_number] == packed[roi_number])
     
 class TestAdcHdf(unittest.TestCase):
     @withfile
@@ -48,10 +66,32 @@ class TestAdcHdf(unittest.TestCase):
 class TestRoiHdf(unittest.TestCase):
     @withfile
     def test_roundtrip(self, path):
+        for layout in [ROI_LAYOUT_PACKED, ROI_LAYOUT_DATASETS]:
+            for fs in list_test_filesets():
+                with RoiFile(fs.adc_path, fs.roi_path) as roi:
+                    roi2hdf(roi, path, layout=layout)
+                    test_roi_roundtrip(roi, path)
+    @withfile
+    def test_missing_key(self, path):
         for fs in list_test_filesets():
             with RoiFile(fs.adc_path, fs.roi_path) as roi:
-                roi2hdf(roi, path)
-                test_roi_roundtrip(roi, path)
+                roi2hdf(roi, path, layout=ROI_LAYOUT_PACKED)
+            with hdfopen(path) as h:
+                hroi = HdfRoi(h)
+                assert 0 not in hroi
+                with self.assertRaises(KeyError):
+                    hroi[0]
+    @withfile
+    def test_empty(self, path):
+        roi2hdf({}, path, layout=ROI_LAYOUT_PACKED)
+        with hdfopen(path) as h:
+            hroi = HdfRoi(h)
+            assert len(hroi) == 0
+            assert len(hroi.pack()) == 0
+    @withfile
+    def test_bad_layout(self, path):
+        with self.assertRaises(ValueError):
+            roi2hdf({}, path, layout=99)
 
 class TestHdrHdf(unittest.TestCase):
     @withfile
@@ -112,6 +152,15 @@ class TestHdfBin(unittest.TestCase):
             with FilesetBin(fs) as out_bin:
                 bin2hdf(out_bin, path)
                 with HdfBin(path) as in_bin:
+                    assert in_bin.images.layout == ROI_LAYOUT_DATASETS
+                    assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_packed_layout(self, path):
+        for fs in list_test_filesets():
+            with FilesetBin(fs) as out_bin:
+                bin2hdf(out_bin, path, layout=ROI_LAYOUT_PACKED)
+                with HdfBin(path) as in_bin:
+                    assert in_bin.images.layout == ROI_LAYOUT_PACKED
                     assert_bin_equals(in_bin, out_bin)
     @withfile
     def test_multiple_open_group(self, path):
@@ -128,3 +177,100 @@ class TestHdfBin(unittest.TestCase):
         for out_bin in list_test_bins():
             with HdfBin(path, out_bin.lid) as in_bin:
                 assert_bin_equals(in_bin, out_bin)
+
+class TestBulkHdf(unittest.TestCase):
+    def setUp(self):
+        self.dd = DataDirectory(data_dir(), whitelist=WHITELIST)
+    def assert_archive(self, path):
+        with h5.File(path, 'r') as h:
+            assert sorted(h.keys()) == sorted(TEST_FILES)
+            for lid in h.keys():
+                assert h[lid].attrs['complete']
+        for out_bin in list_test_bins():
+            with HdfBin(path, out_bin.lid) as in_bin:
+                assert in_bin.images.layout == ROI_LAYOUT_PACKED
+                assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_directory(self, path):
+        for workers in [0, 2]:
+            if os.path.exists(path):
+                os.remove(path)
+            stats = self.dd.to_hdf(path, workers=workers)
+            assert stats == { 'written': 2, 'skipped': 0, 'failed': {} }
+            self.assert_archive(path)
+    @withfile
+    def test_bins(self, path):
+        bins = [b.read() for b in list_test_bins()]
+        stats = bins2hdf(bins, path, workers=0)
+        assert stats['written'] == 2
+        self.assert_archive(path)
+    @withfile
+    def test_resume(self, path):
+        bins2hdf(self.dd, path, workers=0)
+        with h5.File(path, 'a') as h:
+            del h['IFCB5_2012_028_081515'].attrs['complete']
+            del h['IFCB5_2012_028_081515/roi']
+        stats = bins2hdf(self.dd, path, workers=0)
+        assert stats == { 'written': 1, 'skipped': 1, 'failed': {} }
+        self.assert_archive(path)
+    @withfile
+    def test_archive(self, path):
+        bins2hdf(self.dd, path, workers=0, archive=True)
+        for fs in list_test_filesets():
+            with h5.File(path, 'r') as h:
+                with open(fs.adc_path, 'rb') as adc_in:
+                    assert bytearray(h[fs.lid]['archive/adc']) == bytearray(adc_in.read())
+
+class TestHdfAdcColumns(unittest.TestCase):
+    @withfile
+    def test_adc_columns(self, path):
+        for out_bin in list_test_bins():
+            out_bin.to_hdf(path)
+            with HdfBin(path) as in_bin:
+                s = in_bin.schema
+                cols = [s.ROI_WIDTH, s.TRIGGER]
+                assert_frame_equal(in_bin.adc_columns(cols), out_bin.adc[cols], check_index_type='equiv', check_column_type='equiv')
+                assert_frame_equal(in_bin.adc_columns(cols, rows=slice(1, 4)), out_bin.adc[cols].iloc[1:4], check_index_type='equiv', check_column_type='equiv')
+
+class TestRestore(unittest.TestCase):
+    def assert_restored(self, fs, basepath):
+        for ext in ['adc', 'hdr', 'roi']:
+            with open(getattr(fs, ext + '_path'), 'rb') as fin:
+                original = fin.read()
+            with open(basepath + '.' + ext, 'rb') as fin:
+                assert fin.read() == original, ext
+    @withfile
+    def test_hdf2fileset(self, path):
+        for layout in [ROI_LAYOUT_PACKED, ROI_LAYOUT_DATASETS]:
+            for fs in list_test_filesets():
+                fileset2hdf(fs, path, archive=True, layout=layout)
+                with test_dir() as d:
+                    basepath = os.path.join(d, fs.lid)
+                    # a small buffer exercises streaming
+                    hdf2fileset(path, basepath, buffer_size=1000)
+                    self.assert_restored(fs, basepath)
+    @withfile
+    def test_hdf2file(self, path):
+        data = np.arange(10000, dtype=np.uint32).view(np.uint8)
+        with h5.File(path, 'w') as f:
+            f.create_dataset('plain', data=data)
+            f.create_dataset('chunked', data=data, chunks=(300,), compression='gzip')
+        with test_dir() as d:
+            out = os.path.join(d, 'out')
+            with h5.File(path, 'r') as f:
+                for name in ['plain', 'chunked']:
+                    for buffer_size in [1, 1000, 1 << 20]:
+                        hdf2file(f[name], out, buffer_size=buffer_size)
+                        with open(out, 'rb') as fin:
+                            assert fin.read() == data.tobytes()
+    @withfile
+    def test_hdf2filesets(self, path):
+        bins2hdf(DataDirectory(data_dir(), whitelist=WHITELIST), path, workers=0, archive=True)
+        with test_dir() as d:
+            basepaths = hdf2filesets(path, d)
+            assert sorted(os.path.basename(bp) for bp in basepaths) == sorted(TEST_FILES)
+            for fs in list_test_filesets():
+                self.assert_restored(fs, os.path.join(d, fs.lid))
+            assert hdf2filesets(path, d, lids=['IFCB5_2012_028_081515']) == [os.path.join(d, 'IFCB5_2012_028_081515')]
+            with self.assertRaises(KeyError):
+                hdf2filesets(path, d, lids=['D20000101T000000_IFCB000'])
@@ -0,0 +1,121 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ifcb.data.imagecache import ImageCache, set_image_cache, cached_image, RAW
+from ifcb.data.zip import bin2zip, ZipBin
+from ifcb.data.hdf import bin2hdf, HdfBin
+from ifcb.data.roi import RoiFile
+
+from ifcb.tests.utils import withfile
+
+from .fileset_info import list_test_bins
+
+def image(n, value=0):
+    return np.full((n,), value, dtype=np.uint8)
+
+class TestImageCache(unittest.TestCase):
+    def test_lru(self):
+        cache = ImageCache(max_bytes=30)
+        for k in 'abc':
+            cache.put(k, image(10))
+        assert cache.get('a') is not None # a is now most recently used
+        cache.put('d', image(10))
+        assert 'b' not in cache
+        assert all(k in cache for k in 'acd')
+        assert cache.nbytes == 30
+        cache.put('e', image(25))
+        assert len(cache) == 1 and cache.nbytes == 25
+        stats = cache.stats()
+        assert stats['evictions'] == 4
+        assert stats['hits'] == 1
+        assert stats['misses'] == 0
+    def test_too_large(self):
+        cache = ImageCache(max_bytes=10)
+        im = cache.put('a', image(11))
+        assert len(im) == 11
+        assert len(cache) == 0
+    def test_read_only(self):
+        cache = ImageCache()
+        im = image(10)
+        cached = cache.put('a', im)
+        assert not cached.flags.writeable
+        assert im.flags.writeable, 'the array passed in is not modified'
+        assert np.shares_memory(cached, im), 'whole arrays are not copied'
+    def test_views(self):
+        # views into larger buffers are copied, so they are
+        # charged for what they hold in memory
+        cache = ImageCache(max_bytes=30)
+        buf = image(1000)
+        for k in range(3):
+            view = buf[k*10:(k+1)*10]
+            cached = cache.put(k, view)
+            assert not np.shares_memory(cached, buf)
+            assert np.all(cached == view)
+        assert len(cache) == 3 and cache.nbytes == 30
+    def test_get_or_load(self):
+        cache = ImageCache()
+        loads = []
+        def load():
+            loads.append(1)
+            return image(4, 7)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for im in executor.map(lambda _: cache.get_or_load('a', load), range(50)):
+                assert np.all(im == 7)
+        assert len(loads) >= 1
+        stats = cache.stats()
+        assert stats['hits'] + stats['misses'] == 50
+        assert stats['misses'] == len(loads)
+    def test_disabled(self):
+        set_image_cache(None)
+        assert cached_image('lid', 1, RAW, lambda: image(3)).flags.writeable
+
+class TestBinImageCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ImageCache()
+        set_image_cache(self.cache)
+    def tearDown(self):
+        set_image_cache(None)
+    def test_roi_file(self):
+        for b in list_test_bins():
+            targets = list(b.images)
+            for _ in range(2):
+                for t in targets:
+                    im = b.images[t]
+                    assert not im.flags.writeable
+            stats = self.cache.stats()
+            assert stats['hits'] >= len(targets)
+        b.roi_file.copy = True
+        assert b.images[targets[0]].flags.writeable
+    def test_mmap(self):
+        for b in list_test_bins():
+            roi = RoiFile(b.adc_file, b.fileset.roi_path, use_mmap=True)
+            for k in roi:
+                assert not np.shares_memory(roi[k], roi._inroi)
+            roi.close()
+    @withfile
+    def test_shared(self, path):
+        for b in list_test_bins():
+            expected = { k: np.array(im) for k, im in b.images.items() }
+            bin2hdf(b, path)
+            self.cache.clear()
+            with HdfBin(path) as h:
+                for k, im in h.images.items():
+                    assert np.all(im == expected[k])
+            misses = self.cache.stats()['misses']
+            for k in expected:
+                assert np.all(b.images[k] == expected[k])
+            assert self.cache.stats()['misses'] == misses
+    @withfile
+    def test_zip(self, path):
+        for b in list_test_bins():
+            bin2zip(b, path)
+            with ZipBin(path) as z:
+                targets = list(z.images)
+                before = self.cache.stats()['hits']
+                first = [z.images[t] for t in targets]
+                second = [z.images[t] for t in targets]
+                assert self.cache.stats()['hits'] - before >= len(targets)
+                for a, b_ in zip(first, second):
+                    assert a is b_
@@ -0,0 +1,32 @@
+import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ifcb.data.imageio import format_image, read_image, encode_images, png_options
+
+from .fileset_info import list_test_bins
+
+class TestEncodeImages(unittest.TestCase):
+    def setUp(self):
+        self.items = [item for b in list_test_bins() for item in b.images.items()]
+    def test_order(self):
+        expected = [(k, format_image(im).getvalue()) for k, im in self.items]
+        for workers in [1, 4, None]:
+            assert list(encode_images(self.items, workers=workers)) == expected
+        assert list(encode_images(self.items, workers=2, processes=True)) == expected
+        with ThreadPoolExecutor(2) as executor:
+            assert list(encode_images(iter(self.items), workers=executor)) == expected
+    def test_options(self):
+        _, image = self.items[0]
+        sizes = {}
+        for level in [0, 9]:
+            for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_HUFFMAN_ONLY]:
+                options = png_options(compress_level=level, compress_type=strategy)
+                [(_, png)] = encode_images([(0, image)], **options)
+                assert np.all(read_image(format_image(image, **options)) == image)
+                sizes[(level, strategy)] = len(png)
+        assert sizes[(0, zlib.Z_DEFAULT_STRATEGY)] > sizes[(9, zlib.Z_DEFAULT_STRATEGY)]
+        assert sizes[(9, zlib.Z_HUFFMAN_ONLY)] != sizes[(9, zlib.Z_DEFAULT_STRATEGY)]
+        assert png_options() == {}
@@ -1,6 +1,11 @@
 import unittest
+import os
+from unittest import mock
 
-from ifcb.data.matlab import bin2mat, MatBin
+import numpy as np
+from scipy.io import loadmat
+
+from ifcb.data.matlab import bin2mat, MatBin, IMAGES_VAR, _write_image_cells
 
 from ifcb.tests.utils import withfile
 
@@ -15,3 +20,53 @@ class TestMatBin(unittest.TestCase):
                 bin2mat(out_bin, path)
                 with MatBin(path) as in_bin:
                     assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_lazy(self, path):
+        for out_bin in list_test_bins():
+            bin2mat(out_bin, path)
+            with mock.patch('ifcb.data.matlab.loadmat', wraps=loadmat) as m:
+                in_bin = MatBin(path)
+                assert len(in_bin.adc) == len(out_bin.adc)
+                assert in_bin.headers.keys() == out_bin.headers.keys()
+                assert len(in_bin.images) == len(out_bin.images)
+                assert m.call_count == 1
+                assert IMAGES_VAR not in m.call_args.kwargs['variable_names']
+                for k in in_bin.images:
+                    assert np.all(in_bin.images[k] == out_bin.images[k])
+                assert m.call_count == 2
+            with self.assertRaises(KeyError):
+                in_bin.images[0]
+            assert 0 not in in_bin.images
+            assert_bin_equals(MatBin(path, lazy=False), out_bin)
+    @withfile
+    def test_streaming(self, path):
+        for out_bin in list_test_bins():
+            for b in [out_bin, out_bin.read()]:
+                bin2mat(b, path, batch_size=4)
+                in_bin = MatBin(path)
+                assert_bin_equals(in_bin, out_bin)
+                mat = loadmat(path, squeeze_me=True)
+                assert len(mat[IMAGES_VAR]) == len(out_bin.images)
+    @withfile
+    def test_streaming_open_error(self, path):
+        b = list_test_bins()[0]
+        with mock.patch('ifcb.data.matlab.open', side_effect=PermissionError, create=True):
+            with self.assertRaises(PermissionError):
+                bin2mat(b, path, batch_size=4)
+        assert not os.path.exists(path)
+    @withfile
+    def test_streaming_size_limit(self, path):
+        for out_bin in list_test_bins():
+            with open(path, 'wb') as fout:
+                _write_image_cells(fout, out_bin.images.values())
+            size = os.path.getsize(path) - 8
+            with mock.patch('ifcb.data.matlab.MAX_ELEMENT_SIZE', size):
+                bin2mat(out_bin, path, batch_size=4)
+            os.remove(path)
+            with mock.patch('ifcb.data.matlab.MAX_ELEMENT_SIZE', size - 1):
+                with self.assertRaises(ValueError):
+                    bin2mat(out_bin, path, batch_size=4)
+                assert not os.path.exists(path)
+                with open(path, 'wb') as fout:
+                    with self.assertRaises(ValueError):
+                        _write_image_cells(fout, out_bin.images.values())
@@ -0,0 +1,80 @@
+import unittest
+
+import numpy as np
+
+from ifcb.tests.utils import withfile
+
+from ifcb.data.packed import PackedImages, pack_images
+from ifcb.data.hdf import HdfBin
+from ifcb.data.matlab import MatBin
+from ifcb.data.roi import RoiFile
+
+from .fileset_info import TEST_FILES, list_test_bins, list_test_filesets
+from .bins import assert_bin_equals
+
+class TestPackedImages(unittest.TestCase):
+    def test_pack_roi_file(self):
+        for b in list_test_bins():
+            d = TEST_FILES[b.lid]
+            packed = b.images.pack()
+            assert len(packed) == d['n_rois']
+            assert list(packed.keys()) == d['roi_numbers']
+            assert packed.shape(d['roi_number']) == d['roi_shape']
+            for k in d['roi_numbers']:
+                assert np.all(packed[k] == b.images[k])
+            assert 0 not in packed
+    def test_pack_dictlike(self):
+        images = {
+            3: np.arange(6, dtype=np.uint8).reshape((2, 3)),
+            1: np.ones((4, 1), dtype=np.uint8),
+        }
+        packed = pack_images(images)
+        assert list(packed.keys()) == [1, 3]
+        assert packed.buffer.size == 10
+        for k, v in images.items():
+            assert np.all(packed[k] == v)
+            assert not packed[k].flags.writeable
+        assert pack_images(packed) is packed
+        assert len(pack_images({})) == 0
+    def test_views(self):
+        for b in list_test_bins():
+            packed = b.images.pack()
+            for k, im in packed.items():
+                assert np.shares_memory(im, packed.buffer)
+    def test_pack_errors(self):
+        class Broken(dict):
+            def pack(self):
+                raise AttributeError('broken')
+        with self.assertRaises(AttributeError):
+            pack_images(Broken({1: np.ones((2, 2), dtype=np.uint8)}))
+    def test_pack_mmap(self):
+        for fs in list_test_filesets():
+            for copy in [False, True]:
+                roi = RoiFile(fs.adc_path, fs.roi_path, use_mmap=True, copy=copy)
+                packed = roi.pack()
+                assert np.shares_memory(packed.buffer, roi._inroi) != copy
+                roi.close()
+    def test_bad_lengths(self):
+        with self.assertRaises(ValueError):
+            PackedImages([1, 2], np.zeros(4, dtype=np.uint8), [0], [(2, 2)])
+
+class TestPackedBin(unittest.TestCase):
+    def test_read(self):
+        for b in list_test_bins():
+            r = b.read()
+            assert isinstance(r.images, PackedImages)
+            assert_bin_equals(b, r)
+    @withfile
+    def test_to_hdf(self, path):
+        for b in list_test_bins():
+            r = b.read()
+            r.to_hdf(path)
+            with HdfBin(path) as h:
+                assert_bin_equals(b, h)
+    @withfile
+    def test_to_mat(self, path):
+        for b in list_test_bins():
+            r = b.read()
+            r.to_mat(path)
+            with MatBin(path) as m:
+                assert_bin_equals(b, m)
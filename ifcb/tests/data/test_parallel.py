@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+
+from ifcb.data.files import DataDirectory
+from ifcb.data.parallel import map_bins
+from ifcb.data.adc import SCHEMA_VERSION_1
+
+from .fileset_info import TEST_FILES, data_dir, WHITELIST
+
+def n_images(b):
+    return len(b.images)
+
+def fail_on_v1(b):
+    if b.schema is SCHEMA_VERSION_1:
+        raise ValueError('v1 not supported')
+    return b.lid
+
+class TestBinMap(unittest.TestCase):
+    def setUp(self):
+        self.dd = DataDirectory(data_dir(), whitelist=WHITELIST)
+        self.lids = [fs.lid for fs in self.dd.list_filesets()]
+    def test_map(self):
+        for workers in [0, 2]:
+            for chunksize in [1, 3]:
+                results = list(self.dd.map(n_images, workers=workers, chunksize=chunksize))
+                assert [r.lid for r in results] == self.lids
+                for r in results:
+                    assert r.error is None
+                    assert r.value == TEST_FILES[r.lid]['n_rois']
+    def test_unordered(self):
+        results = list(self.dd.map(n_images, workers=2, ordered=False))
+        assert sorted(r.lid for r in results) == sorted(self.lids)
+    def test_errors(self):
+        for workers in [0, 2]:
+            bm = self.dd.map(fail_on_v1, workers=workers)
+            results = list(bm)
+            assert len(results) == len(self.lids)
+            failed = [r for r in results if r.error is not None]
+            assert len(failed) == 1
+            assert failed[0].value is None
+            assert 'v1 not supported' in failed[0].error
+            assert bm.completed == len(self.lids)
+            assert bm.failed == 1
+            assert bm.throughput > 0
+    def test_fileset_errors(self):
+        filesets = list(self.dd.list_filesets())
+        with mock.patch('ifcb.data.parallel.Fileset', side_effect=OSError('unreadable')):
+            results = list(map_bins(n_images, filesets, workers=0))
+        assert [r.lid for r in results] == [fs.basepath for fs in filesets]
+        for r in results:
+            assert r.value is None
+            assert 'unreadable' in r.error
+    def test_filesets(self):
+        filesets = list(self.dd.list_filesets())[:1]
+        results = list(map_bins(n_images, filesets, workers=0))
+        assert [r.lid for r in results] == self.lids[:1]
+        with self.assertRaises(ValueError):
+            map_bins(n_images, filesets, chunksize=0)
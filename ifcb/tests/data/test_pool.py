@@ -0,0 +1,114 @@
+import unittest
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ifcb.data.files import DataDirectory
+from ifcb.data.pool import BinPool
+
+from ifcb.tests.utils import test_dir
+
+from .fileset_info import list_test_bins, data_dir, WHITELIST
+
+class TestBinPool(unittest.TestCase):
+    def test_reuse(self):
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST, pool=4)
+        for b in list_test_bins():
+            pooled = dd[b.lid]
+            assert dd[b.lid] is pooled
+            assert not pooled.isopen()
+            for k in b.images:
+                assert np.all(pooled.images[k] == b.images[k])
+            assert pooled.roi_file.ismapped()
+            assert pooled.headers == b.headers
+        stats = dd.pool.stats()
+        assert stats['hits'] == 2 and stats['misses'] == 2
+        assert stats['open'] == 2
+        dd.pool.clear()
+        assert len(dd.pool) == 0
+        assert not pooled.roi_file.ismapped()
+    def test_as_single(self):
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST, pool=4)
+        for b in list_test_bins():
+            k = list(b.images)[0]
+            assert np.all(dd[b.lid].as_single(k).images[k] == b.images[k])
+            dd[b.lid].images[k]
+            assert np.all(dd[b.lid].as_single(k).images[k] == b.images[k])
+            with dd[b.lid] as pooled:
+                assert np.all(pooled.images[k] == b.images[k])
+    def test_limits(self):
+        pool = BinPool(max_bins=1, max_open=1)
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST, pool=pool)
+        lids = [b.lid for b in list_test_bins()]
+        first = dd[lids[0]]
+        first.images[list(first.images)[0]]
+        second = dd[lids[1]]
+        # eviction closes the bin
+        assert dd._pool_key(lids[0]) not in pool
+        assert not first.roi_file.ismapped()
+        assert pool.stats()['evictions'] == 1
+        pool = BinPool(max_bins=2, max_open=1)
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST, pool=pool)
+        first = dd[lids[0]]
+        image = first.images[list(first.images)[0]]
+        second = dd[lids[1]]
+        assert pool.n_open() == 1 # not yet read
+        second.images[list(second.images)[0]]
+        assert dd[lids[1]] is second
+        assert pool.n_open() == 1
+        assert not first.roi_file.ismapped() and second.roi_file.ismapped()
+        # images read before the mapping was closed remain valid
+        assert np.all(image == list_test_bins()[0].images[list(first.images)[0]])
+        # and the bin can still be read
+        assert len(list(first.images.items())) == len(first.images)
+        pool.close()
+        assert pool.n_open() == 0 and len(pool) == 2
+    def test_threads(self):
+        pool = BinPool(max_bins=2, max_open=1)
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST, pool=pool)
+        expected = { (b.lid, k): np.array(im) for b in list_test_bins() for k, im in b.images.items() }
+        def read(key):
+            lid, k = key
+            return np.all(dd[lid].images[k] == expected[key])
+        keys = list(expected) * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert all(executor.map(read, keys))
+        assert pool.n_open() <= 2
+    def test_changed_files(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(data_dir(), root)
+            dd = DataDirectory(root, whitelist=WHITELIST, pool=4)
+            lid = list_test_bins()[0].lid
+            b = dd[lid]
+            b.images[list(b.images)[0]]
+            st = os.stat(b.fileset.adc_path)
+            os.utime(b.fileset.adc_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            assert dd[lid] is not b
+            assert not b.roi_file.ismapped()
+            for ext in ['adc', 'hdr', 'roi']:
+                os.remove(b.fileset.basepath + '.' + ext)
+            with self.assertRaises(KeyError):
+                dd[lid]
+            assert dd._pool_key(lid) not in dd.pool
+    def test_shared(self):
+        pool = BinPool()
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST, pool=pool)
+        lid = list_test_bins()[0].lid
+        b = dd[lid]
+        # filters apply to pooled bins
+        filtered = DataDirectory(data_dir(), whitelist=WHITELIST, filter=lambda fs: fs.lid != lid, pool=pool)
+        assert not filtered.has_key(lid)
+        with self.assertRaises(KeyError):
+            filtered[lid]
+        # bins under other roots are not shared
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(data_dir(), root)
+            other = DataDirectory(root, whitelist=WHITELIST, pool=pool)
+            assert other[lid] is not b
+            assert other[lid].fileset.basepath.startswith(root)
+            assert dd[lid] is b
+            pool.clear()
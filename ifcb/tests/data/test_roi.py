@@ -5,7 +5,8 @@ from contextlib import contextmanager
 import numpy as np
 
 from .fileset_info import TEST_FILES, list_test_filesets
-from ifcb.data.roi import RoiFile
+from ifcb.data.roi import RoiFile, read_images
+from ifcb.data.files import FilesetBin
 
 class TestRoi(unittest.TestCase):
     def setUp(self):
@@ -44,3 +45,89 @@ class TestRoi(unittest.TestCase):
             no = 0
             assert no not in roi
 
+    def test_read_many(self):
+        for lid, info, roi in self.fsinfo():
+            targets = list(reversed(info['roi_numbers']))
+            images = roi.read_many(targets)
+            assert not roi.isopen() or roi.use_mmap
+            assert len(images) == len(targets)
+            for t, im in zip(targets, images):
+                assert np.all(im == roi[t])
+            with self.assertRaises(KeyError):
+                roi.read_many([0])
+    def test_iter_images(self):
+        for lid, info, roi in self.fsinfo():
+            for batch_size in [1, 4, 1000]:
+                pairs = list(roi.iter_images(batch_size=batch_size))
+                assert [t for t, _ in pairs] == info['roi_numbers']
+                for t, im in pairs:
+                    assert np.all(im == roi[t])
+    def test_iter_images_with(self):
+        for lid, info, roi in self.fsinfo():
+            targets = []
+            for t, im in roi.iter_images(batch_size=1):
+                with roi:
+                    assert np.all(roi[t] == im)
+                targets.append(t)
+            assert targets == info['roi_numbers']
+            assert not roi.isopen()
+    def test_read_images_gap(self):
+        for lid, info, roi in self.fsinfo():
+            _, offsets, widths, heights = roi._layout()
+            with open(roi.path, 'rb') as inroi:
+                coalesced = read_images(inroi, offsets, heights, widths)
+                separate = read_images(inroi, offsets, heights, widths, max_gap=-1)
+            for a, b in zip(coalesced, separate):
+                assert np.all(a == b)
+
+class TestMmapRoi(TestRoi):
+    def fsinfo(self):
+        for lid, info in TEST_FILES.items():
+            fs = self.data[lid]
+            roi_file = RoiFile(fs.adc_path, fs.roi_path, use_mmap=True)
+            yield lid, info, roi_file
+    def test_not_with(self):
+        for lid, info, roi in self.fsinfo():
+            assert not roi.isopen()
+            k = roi.keys()[0]
+            mapping = roi[k]
+            assert not roi.isopen(), 'lazy mapping is not an open file'
+            assert roi[k].base is mapping.base, 'mapping should persist until close'
+            with roi:
+                assert roi.isopen()
+                assert np.all(roi[k] == mapping)
+            assert not roi.isopen()
+            roi.close()
+            assert not roi.isopen()
+    def test_as_single_after_read(self):
+        for fs in self.data.values():
+            b = FilesetBin(fs, use_mmap=True)
+            k = list(b.images)[0]
+            image = b.images[k]
+            b.close()
+            assert b.roi_file._inroi is None, 'close should release the mapping'
+            with b:
+                assert np.all(b.images[k] == image)
+            assert np.all(b.as_single(k).images[k] == image)
+    def test_matches_read(self):
+        for lid, info in TEST_FILES.items():
+            fs = self.data[lid]
+            with RoiFile(fs.adc_path, fs.roi_path) as roi, RoiFile(fs.adc_path, fs.roi_path, use_mmap=True) as mroi:
+                for k in roi:
+                    assert np.all(roi[k] == mroi[k])
+    def test_views_outlive_close(self):
+        for lid, info, roi in self.fsinfo():
+            with roi:
+                image = roi[info['roi_number']]
+            assert not image.flags.writeable
+            A = info['roi_slice']
+            c = info['roi_slice_coords']
+            assert np.all(image[tuple(c)] == A)
+    def test_copy(self):
+        for lid, info in TEST_FILES.items():
+            fs = self.data[lid]
+            with RoiFile(fs.adc_path, fs.roi_path, use_mmap=True, copy=True) as roi:
+                image = roi[info['roi_number']]
+                assert image.flags.writeable
+                image[0, 0] = 0
+                assert np.all(image[1:] == roi[info['roi_number']][1:])
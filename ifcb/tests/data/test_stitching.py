@@ -1,11 +1,20 @@
 import unittest
+import gc
+import weakref
+from unittest import mock
+import os
+import shutil
 
 import numpy as np
 
 from ifcb.data.files import DataDirectory, FilesetBin
-from ifcb.data.stitching import Stitcher, InfilledImages
+from ifcb.data.stitching import Stitcher, InfilledImages, infill, infill_image
+from ifcb.data import stitching
+from ifcb.data.stitching import stitch_images, boundary_mask, dilate, find_boundary, chop_boundary_edges
 
-from .fileset_info import TEST_FILES, TEST_DATA_DIR
+from ifcb.tests.utils import test_dir
+
+from .fileset_info import TEST_FILES, TEST_DATA_DIR, list_test_bins, data_dir, WHITELIST
 
 class TestStitcher(unittest.TestCase):
     @unittest.skip('deprecated use of numpy indexing in test code')
@@ -20,6 +29,15 @@ class TestStitcher(unittest.TestCase):
                 assert target in s, 'stitched target missing'
                 assert s[target].shape == tf['stitched_roi_shape'], 'stitched roi shape wrong'
                 assert np.all(s[target][coords] == tf['stitched_roi_slice']), 'stitched roi data wrong'
+    def test_not_retained(self):
+        for b in list_test_bins():
+            s = Stitcher(b)
+            list(s.iter_stitched())
+            s.excluded_targets()
+            ref = weakref.ref(s)
+            del s
+            gc.collect()
+            assert ref() is None, 'Stitcher kept alive by a cache'
     def test_infilled_keys(self):
         dd = DataDirectory(TEST_DATA_DIR)
         for lid, tf in TEST_FILES.items():
@@ -46,3 +64,150 @@ class TestStitcher(unittest.TestCase):
                     assert roi_corners[rn] == corners
 
         
+    def test_iter_stitched(self):
+        dd = DataDirectory(TEST_DATA_DIR)
+        for lid, tf in TEST_FILES.items():
+            if 'stitched_roi_number' in tf:
+                b = dd[lid]
+                s = Stitcher(b)
+                target = tf['stitched_roi_number']
+                coords = tuple(tf['stitched_roi_coords'])
+                for batch_size in [1, 256]:
+                    stitched = dict(s.iter_stitched(batch_size=batch_size))
+                    assert list(stitched) == list(s.keys())
+                    for k, im in stitched.items():
+                        assert im.shape == s.shape(k)
+                        assert np.all(im.data == s[k].data)
+                        assert np.all(im.mask == s[k].mask)
+                    assert stitched[target].shape == tf['stitched_roi_shape']
+                    assert np.all(stitched[target][coords] == tf['stitched_roi_slice'])
+                with self.assertRaises(KeyError):
+                    s[target + 1]
+
+def reference_infill(raw_stitch):
+    # infill as computed with scipy.ndimage correlation, before boundary_mask
+    boundary = find_boundary(dilate(raw_stitch.mask))
+    boundary = chop_boundary_edges(boundary)
+    if np.sum(boundary) > 0:
+        infill_value = int(round(np.mean(raw_stitch[boundary])))
+        fill_image = np.full(raw_stitch.shape, dtype=np.uint8, fill_value=infill_value)
+    else:
+        fill_image = np.zeros(raw_stitch.shape, dtype=np.uint8)
+    infill = np.ma.array(fill_image, mask=np.logical_not(raw_stitch.mask))
+    return raw_stitch.filled(0) + infill.filled(0)
+
+def synthetic_stitches(n, seed=0):
+    # overlapping pairs of random boxes, as in revision 1 stitched ROIs
+    rng = np.random.default_rng(seed)
+    for _ in range(n):
+        ah, aw, bh, bw = rng.integers(5, 60, size=4)
+        by, bx = rng.integers(-bh + 3, ah - 3), rng.integers(-bw + 3, aw - 3)
+        sy, sx = min(0, by), min(0, bx)
+        shape = (max(ah, by + bh) - sy, max(aw, bx + bw) - sx)
+        boxes = [(-sy, -sx, ah - sy, aw - sx), (by - sy, bx - sx, by + bh - sy, bx + bw - sx)]
+        images = [rng.integers(0, 256, size=(h, w), dtype=np.uint8) for h, w in [(ah, aw), (bh, bw)]]
+        yield stitch_images(shape, boxes, images)
+
+class TestInfill(unittest.TestCase):
+    def test_boundary_mask(self):
+        rng = np.random.default_rng(0)
+        for shape in [(2, 2), (3, 7), (40, 30)]:
+            for p in [0, 0.2, 0.8, 1]:
+                mask = rng.random(shape) < p
+                expected = chop_boundary_edges(find_boundary(dilate(mask)))
+                assert np.all(boundary_mask(mask) == expected)
+    def test_infill(self):
+        stitches = list(synthetic_stitches(200))
+        for b in list_test_bins():
+            stitches += [im for _, im in Stitcher(b).iter_stitched()]
+        for raw_stitch in stitches:
+            infilled = infill(raw_stitch)
+            assert infilled.dtype == np.uint8
+            assert np.all(infilled == reference_infill(raw_stitch))
+            assert np.all(infilled[~raw_stitch.mask] == raw_stitch.data[~raw_stitch.mask])
+            assert np.all(infill_image(raw_stitch).filled(0) + raw_stitch.filled(0) == infilled)
+    def test_fully_masked(self):
+        raw_stitch = np.ma.array(np.zeros((4, 5), dtype=np.uint8), mask=True)
+        assert np.all(infill(raw_stitch) == 0)
+        assert np.all(infill_image(raw_stitch).filled(0) == 0)
+
+class TestInfilledImages(unittest.TestCase):
+    def test_membership(self):
+        for b in list_test_bins():
+            ii = InfilledImages(b)
+            s = Stitcher(b)
+            keys = list(ii.keys())
+            excluded = set(k + 1 for k in s)
+            assert keys == [k for k in b.images if k not in excluded]
+            assert len(ii) == len(keys)
+            for k in b.images:
+                assert (k in ii) == (k not in excluded)
+            for k in [0, -1, max(b.images) + 1, 'x', 3.0, None]:
+                assert k not in ii
+            for k in keys:
+                if k in s:
+                    assert ii[k].shape == s.shape(k)
+                else:
+                    assert np.all(ii[k] == b.images[k])
+
+class TestStitchCache(unittest.TestCase):
+    def _stitched_bin(self, root):
+        dd = DataDirectory(root, whitelist=WHITELIST)
+        for b in dd:
+            if len(Stitcher(b)) > 0:
+                return b
+    def test_cache(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(data_dir(), root)
+            cache = os.path.join(d, 'cache')
+            b = self._stitched_bin(root)
+            expected = { k: im for k, im in InfilledImages(b, cache=False).items() }
+            path = stitching.stitch_cache_path(b, cache)
+            assert not os.path.exists(path)
+            calls = []
+            for _ in range(2):
+                with mock.patch.object(Stitcher, 'iter_stitched', autospec=True, side_effect=Stitcher.iter_stitched) as m:
+                    ii = InfilledImages(b, cache=cache)
+                    for k, im in ii.items():
+                        assert np.all(im == expected[k])
+                    calls.append(m.call_count)
+                assert os.path.exists(path)
+            # computed on first use only
+            assert calls == [1, 0]
+            # a changed source file invalidates the cache
+            st = os.stat(b.fileset.roi_path)
+            os.utime(b.fileset.roi_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            with mock.patch.object(Stitcher, 'iter_stitched', autospec=True, side_effect=Stitcher.iter_stitched) as m:
+                ii = InfilledImages(b, cache=cache)
+                for k in Stitcher(b):
+                    assert np.all(ii[k] == expected[k])
+                assert m.call_count == 1
+    def test_interrupted_write(self):
+        with test_dir() as cache:
+            b = self._stitched_bin(data_dir())
+            path = stitching.stitch_cache_path(b, cache)
+            with mock.patch('ifcb.data.hdf.roi2hdf', side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    stitching.write_stitch_cache(path, np.zeros(4, dtype=np.int64), {})
+            assert os.listdir(cache) == []
+    def test_failed_write(self):
+        with test_dir() as cache:
+            b = self._stitched_bin(data_dir())
+            expected = { k: infill(im) for k, im in Stitcher(b).items() }
+            with mock.patch('ifcb.data.hdf.roi2hdf', side_effect=OSError('disk full')):
+                ii = InfilledImages(b, cache=cache)
+                for k in Stitcher(b):
+                    assert np.all(ii[k] == expected[k])
+            assert os.listdir(cache) == []
+    def test_configured_cache(self):
+        with test_dir() as cache:
+            b = self._stitched_bin(data_dir())
+            try:
+                stitching.set_stitch_cache(cache)
+                for k in Stitcher(b):
+                    InfilledImages(b)[k]
+                assert os.path.exists(stitching.stitch_cache_path(b, cache))
+            finally:
+                stitching.set_stitch_cache(None)
+            assert InfilledImages(b).cache is None
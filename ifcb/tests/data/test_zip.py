@@ -1,6 +1,13 @@
 import unittest
+from unittest import mock
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
 
-from ifcb.data.zip import bin2zip, ZipBin
+import numpy as np
+
+from ifcb.data.zip import bin2zip, bin2zip_stream, iter_bin2zip, ZipBin
+from ifcb.data.adc import SCHEMA_VERSION_2
+from ifcb.data.imageio import _encode, read_image
 from ifcb.data.files import FilesetBin
 
 from ifcb.tests.utils import withfile
@@ -17,3 +24,108 @@ class TestZipBin(unittest.TestCase):
                 bin2zip(out_bin, path)
                 with ZipBin(path) as in_bin:
                     assert_bin_equals(in_bin, out_bin)
+
+class UnseekableStream(object):
+    def __init__(self):
+        self.buf = BytesIO()
+    def write(self, data):
+        return self.buf.write(data)
+    def flush(self):
+        pass
+
+class TestZipStreaming(unittest.TestCase):
+    @withfile
+    def test_outputs_match(self, path):
+        for b in list_test_bins():
+            bin2zip(b, path)
+            with open(path, 'rb') as fin:
+                file_bytes = fin.read()
+            # the members are the same, regardless of the output
+            stream = UnseekableStream()
+            bin2zip(b, stream)
+            chunks = list(iter_bin2zip(b, chunk_size=1000))
+            assert len(chunks) > 1
+            for data in [bin2zip_stream(b).getvalue(), stream.buf.getvalue(), b''.join(chunks)]:
+                with ZipFile(BytesIO(data)) as zin, ZipFile(BytesIO(file_bytes)) as zexpected:
+                    assert zin.testzip() is None
+                    assert zin.namelist() == zexpected.namelist()
+                    for name in zin.namelist():
+                        assert zin.read(name) == zexpected.read(name)
+    def test_lazy(self):
+        b = next(b for b in list_test_bins() if b.schema == SCHEMA_VERSION_2)
+        with mock.patch('ifcb.data.imageio._encode', wraps=_encode) as m:
+            chunks = iter_bin2zip(b, chunk_size=1)
+            next(chunks)
+            assert m.call_count == 0, 'images encoded before first chunk'
+            list(chunks)
+            assert m.call_count == len(b.images)
+    def test_parallel(self):
+        for b in list_test_bins():
+            # member timestamps can differ between runs, so compare members
+            def members(data):
+                with ZipFile(BytesIO(data)) as z:
+                    return [(n, z.read(n)) for n in z.namelist()]
+            expected = bin2zip_stream(b).getvalue()
+            assert members(bin2zip_stream(b, workers=4).getvalue()) == members(expected)
+            assert members(b''.join(iter_bin2zip(b, workers=2, processes=True))) == members(expected)
+            assert bin2zip_stream(b, workers=2, compress_level=0).getvalue() != expected
+    @withfile
+    def test_roundtrip_v2(self, path):
+        for out_bin in list_test_bins():
+            if out_bin.schema != SCHEMA_VERSION_2:
+                continue
+            bin2zip(out_bin, path)
+            with ZipBin(path) as in_bin:
+                assert_bin_equals(in_bin, out_bin)
+
+class TestZipBinIndex(unittest.TestCase):
+    @withfile
+    def test_images(self, path):
+        for out_bin in list_test_bins():
+            bin2zip(out_bin, path)
+            with ZipFile(path) as z:
+                expected = { n: read_image(BytesIO(z.read(n))) for n in z.namelist() if n.endswith('.png') }
+            for use_mmap in [False, True]:
+                with ZipBin(path, use_mmap=use_mmap) as in_bin:
+                    images = in_bin.images
+                    assert len(images) == len(expected)
+                    assert list(images.keys()) == sorted(images.keys())
+                    for k in images.keys():
+                        assert k in images
+                        arcname = out_bin.pid.with_target(k, namespace=False) + '.png'
+                        assert np.all(images[k] == expected[arcname])
+                    assert 0 not in images
+                    with self.assertRaises(KeyError):
+                        images[0]
+                    targets = list(reversed(list(images.keys())))
+                    for workers in [1, 3]:
+                        for k, im in zip(targets, images.read_many(targets, workers=workers)):
+                            assert np.all(im == images[k])
+    @withfile
+    def test_typed_adc(self, path):
+        for out_bin in list_test_bins():
+            bin2zip(out_bin, path)
+            with ZipBin(path) as in_bin:
+                s = in_bin.schema
+                assert in_bin.adc[s.ROI_WIDTH].dtype == np.int32
+                assert in_bin.adc[s.START_BYTE].dtype == np.int64
+                assert len(in_bin.adc) == len(out_bin.adc)
+    @withfile
+    def test_deflated(self, path):
+        out_bin = list_test_bins()[0]
+        data = bin2zip_stream(out_bin).getvalue()
+        with ZipFile(BytesIO(data)) as zin, ZipFile(path, 'w', compression=ZIP_DEFLATED) as zout:
+            for name in zin.namelist():
+                zout.writestr(name, zin.read(name))
+        with ZipBin(path) as in_bin, ZipBin(path, use_mmap=True) as mapped:
+            for k in in_bin.images:
+                assert np.all(in_bin.images[k] == mapped.images[k])
+    @withfile
+    def test_closed(self, path):
+        out_bin = list_test_bins()[0]
+        bin2zip(out_bin, path)
+        in_bin = ZipBin(path)
+        k = list(in_bin.images.keys())[0]
+        in_bin.close()
+        with self.assertRaises(ValueError):
+            in_bin.images[k]
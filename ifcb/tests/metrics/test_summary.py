@@ -0,0 +1,75 @@
+import unittest
+from unittest import mock
+import os
+import shutil
+
+import numpy as np
+
+from ifcb.tests.utils import test_dir
+from ifcb.tests.data.fileset_info import list_test_bins, data_dir, WHITELIST
+from ifcb.data.files import DataDirectory
+from ifcb.data.adc import parse_adc_file
+from ifcb.metrics import summary
+from ifcb.metrics.summary import bin_summary, SUMMARY_COLUMNS
+
+METRICS = ['n_triggers', 'ml_analyzed', 'look_time', 'run_time', 'inhibit_time', 'trigger_rate', 'temperature', 'humidity']
+
+def assert_metrics_equal(row, b):
+    for name in METRICS:
+        assert np.isclose(row[name], getattr(b, name), equal_nan=True), name
+
+class TestSummary(unittest.TestCase):
+    def test_bin_summary(self):
+        for b in list_test_bins():
+            s = bin_summary(b)
+            assert sorted(s.keys()) == sorted(SUMMARY_COLUMNS)
+            assert s['timestamp'] == b.timestamp
+            assert_metrics_equal(s, b)
+    def test_adc_unchanged(self):
+        for b in list_test_bins():
+            columns = list(b.adc.columns)
+            b.ml_analyzed
+            assert list(b.adc.columns) == columns
+    def test_parse_columns(self):
+        for b in list_test_bins():
+            s = b.schema
+            cols = [s.TRIGGER, s.ROI_WIDTH, 99]
+            adc = parse_adc_file(b.fileset.adc_path, columns=cols)
+            assert list(adc.columns) == [s.TRIGGER, s.ROI_WIDTH]
+            assert adc.index.equals(b.adc.index)
+            assert adc[s.ROI_WIDTH].equals(b.adc[s.ROI_WIDTH])
+    def test_directory_summary(self):
+        dd = DataDirectory(data_dir(), whitelist=WHITELIST)
+        bins = { b.lid: b for b in dd }
+        for workers in [0, 2]:
+            df = dd.summary(workers=workers)
+            assert sorted(df.index) == sorted(bins)
+            assert df['timestamp'].is_monotonic_increasing
+            for lid, row in df.iterrows():
+                assert_metrics_equal(row, bins[lid])
+    def test_cache(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(data_dir(), root)
+            cache = os.path.join(d, 'summary.csv')
+            dd = DataDirectory(root, whitelist=WHITELIST)
+            first = dd.summary(workers=0, cache=cache)
+            assert len(first) == 2
+            with mock.patch.object(summary, 'bin_summary', side_effect=bin_summary) as m:
+                second = dd.summary(workers=0, cache=cache)
+                assert m.call_count == 0
+                assert np.allclose(second[METRICS].values, first[METRICS].values, equal_nan=True)
+                assert second['timestamp'].equals(first['timestamp'])
+                # a new bin is computed, and only that bin
+                src = dd['D20130526T095207_IFCB013'].fileset.basepath
+                new_base = os.path.join(os.path.dirname(src), 'D20130526T105207_IFCB013')
+                for ext in ['adc', 'hdr', 'roi']:
+                    shutil.copy(src + '.' + ext, new_base + '.' + ext)
+                third = dd.summary(workers=0, cache=cache)
+                assert m.call_count == 1
+                assert list(third.index) == ['IFCB5_2012_028_081515', 'D20130526T095207_IFCB013', 'D20130526T105207_IFCB013']
+                # a removed bin is dropped
+                for ext in ['adc', 'hdr', 'roi']:
+                    os.remove(new_base + '.' + ext)
+                assert len(dd.summary(workers=0, cache=cache)) == 2
+                assert m.call_count == 1